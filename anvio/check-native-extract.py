@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# check-native-extract.py
+# Checks extract-reads.py --native (native_extract.py) against the reads anvio extracts for each gene.
+#
+# With no arguments, builds small fixtures in a temporary directory: two sorted, indexed BAMs written with pysam and
+# a contigs db holding genes_in_contigs, then extracts every gene with native_extract, in batches of BATCH_GENES and
+# all at once. Each gene's reads must be those anvi-get-short-reads-mapping-to-a-gene keeps: every read the BAM
+# index returns for the gene's window (start - leeway to stop + leeway), one per read name and sample. The fixtures
+# cover windows touching and overlapping each other, reads ending at a window's start or starting at its end, a
+# window clipped at the start of its contig, mates sharing a read name, and the same read in both BAMs; besides
+# those hand-placed reads, RANDOM_READS random reads per BAM are compared against a gene-by-gene fetch.
+#
+# With --compare NATIVE_DIR ANVIO_DIR, compares the fastas of two extract-reads.py output directories instead, e.g.
+# of the same genes extracted with and without --native. Reads are compared by sample, strand, contig and sequence,
+# as anvio and the native mode may number them in a different order.
+
+import argparse
+import collections
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+import pysam
+
+import native_extract
+
+LEEWAY = 35
+BATCH_GENES = 2
+RANDOM_READS = 500
+READ_LENGTH = 50
+
+CONTIGS = [('c1', 2000), ('c2', 1000)]
+
+# gene_callers_id: (contig, start, stop)
+GENES = {
+    '1': ('c1', 100, 300),
+    '2': ('c1', 320, 500),  # Its window overlaps gene 1's, so both are fetched as one region
+    '3': ('c1', 1500, 1700),
+    '4': ('c2', 10, 200),  # Its window is clipped at 0
+    '5': ('c2', 800, 900),  # No hand-placed reads
+}
+MISSING_GENE = '99'
+
+# (bam, read name, contig, position, reverse). Reads are READ_LENGTH long, and all map.
+HAND_READS = [
+    ('a', 'spans-1-2', 'c1', 280, False),  # In the windows of genes 1 and 2
+    ('b', 'spans-1-2', 'c1', 280, False),  # The same read in the other BAM, kept for both samples
+    ('a', 'starts-at-end-of-1', 'c1', 335, False),  # Gene 1's window ends at 335; only in gene 2
+    ('a', 'ends-at-start-of-1', 'c1', 15, False),  # Ends at 65, where gene 1's window starts; in no gene
+    ('a', 'mates', 'c1', 150, False),  # Mates with one read name: kept once, as the mate fetched last
+    ('a', 'mates', 'c1', 200, True),
+    ('a', 'between-genes', 'c1', 1000, False),
+    ('b', 'before-3', 'c1', 1420, True),  # Ends at 1470, inside gene 3's window from 1465
+    ('b', 'contig-start', 'c2', 0, True),  # In gene 4's clipped window
+]
+
+# gene: {(bam, read name, position)} of the hand-placed reads
+EXPECTED = {
+    '1': {('a', 'spans-1-2', 280), ('b', 'spans-1-2', 280), ('a', 'mates', 200)},
+    '2': {('a', 'spans-1-2', 280), ('b', 'spans-1-2', 280), ('a', 'starts-at-end-of-1', 335)},
+    '3': {('b', 'before-3', 1420)},
+    '4': {('b', 'contig-start', 0)},
+    '5': set(),
+}
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def write_bam(path, reads):
+    # Write [(name, contig, position, reverse, sequence)] to a coordinate-sorted, indexed bam
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': name, 'LN': length} for name, length in CONTIGS]}
+    contig_ids = {name: i for i, (name, length) in enumerate(CONTIGS)}
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for name, contig, position, reverse, sequence in sorted(reads, key=lambda read: (contig_ids[read[1]], read[2])):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = name
+            read.reference_id = contig_ids[contig]
+            read.reference_start = position
+            read.cigarstring = '%sM' % len(sequence)
+            read.query_sequence = sequence
+            read.query_qualities = pysam.qualitystring_to_array('I' * len(sequence))
+            read.mapping_quality = 60
+            read.flag = 16 if reverse else 0
+            bam.write(read)
+    pysam.index(path)
+
+
+def write_contigs_db(path):
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE genes_in_contigs (gene_callers_id INTEGER, contig TEXT, start INTEGER, stop INTEGER)')
+    con.executemany('INSERT INTO genes_in_contigs VALUES (?, ?, ?, ?)',
+                    [(int(gene), contig, start, stop) for gene, (contig, start, stop) in GENES.items()])
+    con.commit()
+    con.close()
+
+
+def build_fixtures(fixture_dir):
+    # Write a.bam, b.bam and contigs.db. Returns the bams, the db, and {(bam, name, position): sequence} of the
+    # hand-placed reads.
+    rng = random.Random(0)
+    reads = {'a': [], 'b': []}
+    hand_sequences = {}
+    for bam, name, contig, position, reverse in HAND_READS:
+        sequence = hand_sequences.get((name, position)) or random_sequence(rng, READ_LENGTH)
+        hand_sequences[(name, position)] = sequence
+        reads[bam].append(('hand-' + name, contig, position, reverse, sequence))
+    for bam in reads:
+        for i in range(RANDOM_READS):
+            contig, length = rng.choice(CONTIGS)
+            read_length = rng.randint(20, 150)
+            # Some names repeat, as mates do
+            reads[bam].append(('random-%s' % rng.randrange(RANDOM_READS * 3 // 4), contig,
+                               rng.randrange(length - read_length), rng.random() < 0.5,
+                               random_sequence(rng, read_length)))
+
+    bams = []
+    for bam in sorted(reads):
+        bams.append(os.path.join(fixture_dir, bam + '.bam'))
+        write_bam(bams[-1], reads[bam])
+    db = os.path.join(fixture_dir, 'contigs.db')
+    write_contigs_db(db)
+    expected_sequences = {
+        (bam, name, position): hand_sequences[(name, position)] for bam, name, contig, position, reverse in HAND_READS
+    }
+    return bams, db, expected_sequences
+
+
+def anvio_reads(bams, db, gene, leeway):
+    # A gene's reads as anvi-get-short-reads-mapping-to-a-gene collects them: one fetch of the gene's window per bam,
+    # keeping the last read of each name per sample. Returns a Counter of (sample, reverse, contig, sequence).
+    con = sqlite3.connect(db)
+    contig, start, stop = con.execute(
+        'SELECT contig, start, stop FROM genes_in_contigs WHERE gene_callers_id = ?', (int(gene),)).fetchone()
+    con.close()
+
+    reads = collections.Counter()
+    for bam in bams:
+        sample_id = os.path.splitext(os.path.basename(bam))[0]
+        sample_reads = {}
+        with pysam.AlignmentFile(bam, 'rb') as bam_file:
+            for read in bam_file.fetch(contig, max(start - leeway, 0), stop + leeway):
+                sample_reads[read.query_name] = (read.is_reverse, read.query_sequence)
+        reads.update((sample_id, str(reverse), contig, sequence) for reverse, sequence in sample_reads.values())
+    return reads
+
+
+def read_fasta(path):
+    # Counter of (sample, reverse, contig, sequence) of an extracted fasta. Exits if the reads aren't numbered
+    # 0, 1, 2... in order, as anvio numbers them.
+    reads = collections.Counter()
+    header, sequence = None, []
+    with open(path) as f:
+        lines = [line.strip() for line in f] + ['>']
+    for line in lines:
+        if not line.startswith('>'):
+            sequence.append(line)
+            continue
+        if header is not None:
+            number, sample, reverse, contig = header.split('|')
+            if int(number) != sum(reads.values()):
+                exit('%s: read %s is numbered %s' % (path, sum(reads.values()), number))
+            reads[(sample.split(':', 1)[1], reverse.split(':', 1)[1], contig.split(':', 1)[1], ''.join(sequence))] += 1
+        header, sequence = line[1:], []
+    return reads
+
+
+def describe(reads):
+    # Read counts by sample, contig and strand
+    counts = collections.Counter()
+    for (sample, reverse, contig, sequence), count in reads.items():
+        counts[(sample, contig, reverse)] += count
+    return ', '.join('%s from %s:%s%s' % (count, sample, contig, ' (reverse)' if reverse == 'True' else '')
+                     for (sample, contig, reverse), count in sorted(counts.items()))
+
+
+def compare(gene, found, expected):
+    # Error messages for a gene whose reads differ from those expected
+    if found == expected:
+        return []
+    return ['gene %s: %s reads expected, %s found. Missing: %s. Extra: %s' % (
+        gene, sum(expected.values()), sum(found.values()), describe(expected - found) or 'none',
+        describe(found - expected) or 'none')]
+
+
+def check_fixtures():
+    errors = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bams, db, hand_sequences = build_fixtures(tmp_dir)
+        genes = sorted(GENES) + [MISSING_GENE]
+        windows, missing = native_extract.gene_windows(db, genes, LEEWAY)
+        if missing != [MISSING_GENE]:
+            errors.append('genes missing from the contigs db: %s, expected %s' % (missing, [MISSING_GENE]))
+
+        for batch_genes in (BATCH_GENES, len(windows)):
+            output_dir = os.path.join(tmp_dir, 'batches-of-%s' % batch_genes)
+            os.mkdir(output_dir)
+            read_counts = {}
+            for batch in native_extract.batches(windows, batch_genes):
+                read_counts.update(native_extract.extract_batch(bams, batch, output_dir))
+            if sorted(os.listdir(output_dir)) != sorted(gene + '.fa' for gene in GENES):
+                errors.append('batches of %s: wrote %s' % (batch_genes, sorted(os.listdir(output_dir))))
+                continue
+
+            for gene in sorted(GENES):
+                found = read_fasta(os.path.join(output_dir, gene + '.fa'))
+                if read_counts[gene] != sum(found.values()):
+                    errors.append('gene %s: %s reads counted, %s written' % (gene, read_counts[gene], sum(found.values())))
+                errors += compare(gene, found, anvio_reads(bams, db, gene, LEEWAY))
+
+                # The hand-placed reads, known by their sequences
+                hand_found = {key for key, sequence in hand_sequences.items()
+                              if any(read[0] == key[0] and read[3] == sequence for read in found)}
+                if hand_found != EXPECTED[gene]:
+                    errors.append('gene %s: hand-placed reads %s, expected %s' % (
+                        gene, sorted(hand_found), sorted(EXPECTED[gene])))
+        print('Checked %s genes in batches of %s and all at once, with %s hand-placed reads and %s random reads per bam' % (
+            len(GENES), BATCH_GENES, len(HAND_READS), RANDOM_READS))
+    return errors
+
+
+def compare_dirs(native_dir, anvio_dir):
+    errors = []
+    native_genes = {name[:-3] for name in os.listdir(native_dir) if name.endswith('.fa')}
+    anvio_genes = {name[:-3] for name in os.listdir(anvio_dir) if name.endswith('.fa')}
+    for gene in sorted(native_genes ^ anvio_genes):
+        errors.append('gene %s: only in %s' % (gene, native_dir if gene in native_genes else anvio_dir))
+    genes = sorted(native_genes & anvio_genes)
+    for gene in genes:
+        errors += compare(gene, read_fasta(os.path.join(native_dir, gene + '.fa')),
+                          read_fasta(os.path.join(anvio_dir, gene + '.fa')))
+    print('Compared %s genes' % len(genes))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Check the native extraction mode of extract-reads.py against anvio's reads per gene, on synthetic fixtures,
+        or compare the fastas of two output directories.
+    ''')
+    parser.add_argument('--compare', nargs=2, metavar=('NATIVE_DIR', 'ANVIO_DIR'),
+        help='Compare the fastas extracted with --native to those extracted with anvio')
+    args = parser.parse_args()
+
+    errors = compare_dirs(*args.compare) if args.compare else check_fixtures()
+    for error in errors:
+        print(error, file=sys.stderr)
+    if errors:
+        exit('%s differences' % len(errors))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 #!/bin/bash
 
 
-if [ ! -f /app/gene_list ]; then
-	echo "gene list not found."
+if [ ! -d /app/gene_lists ]; then
+	echo "error mounting gene lists directory."
 	exit 1
 fi
 if [ ! -d /app/bams ]; then
@@ -18,13 +18,7 @@ if [ ! -d /output ]; then
 	exit 1
 fi
 
-while read p
-do
-	gene=$(cut -d$'\t' -f3 <<<"$p")
-	anvi-get-short-reads-mapping-to-a-gene \
-		-i /app/bams/*.bam \
-		-c /app/db.db \
-		--gene-caller-id $gene \
-		--leeway 35 \
-		-o "/output/${gene}.fa"
-done < /app/gene_list
+python3 /app/extract-reads.py \
+	${CONCURRENCY:+--concurrency $CONCURRENCY} \
+	${NATIVE:+--native} \
+	/app/gene_lists/*
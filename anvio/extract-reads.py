@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# extract-reads.py
+# Runs anvi-get-short-reads-mapping-to-a-gene for every gene of every gene list, from one shared work queue,
+# with at most CONCURRENCY extractions at a time.
+#
+# Each gene's reads are written to OUTPUT_DIR/GENE.fa. The fasta is written as GENE.fa.tmp and renamed once the
+# extraction succeeds, so genes with a .fa already in the output directory are complete and are skipped:
+# rerunning after an interruption picks up where the last run left off. Temporary files left by an interrupted run
+# are removed at startup, as the output directory is the input of the next stage.
+#
+# The start time, duration and exit status of each extraction are appended to OUTPUT_DIR/extract-times.tsv.
+#
+# With --native, the reads are extracted with pysam instead of anvio, BATCH_GENES neighbouring genes per pass
+# over each BAM (see native_extract.py). Each gene's time is then that of its whole batch.
+
+import argparse
+import glob
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+COMMAND = 'anvi-get-short-reads-mapping-to-a-gene -i {bams} -c {db} --gene-caller-id {gene} --leeway {leeway} -o {output}'
+TIMES_FILE = 'extract-times.tsv'
+
+# Suffix of a fasta being written. It doesn't end in .fa, so the next stages never pick it up.
+TMP_SUFFIX = '.fa.tmp'
+
+# Genes extracted per pass over the bams in --native mode
+BATCH_GENES = 1000
+
+
+def read_gene_list(filename):
+    # Gene caller ids of a gene list: the third tab separated column, or the whole line if it has no tabs
+    # (the same as `cut -f3`)
+    genes = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            fields = line.split('\t')
+            gene = fields[2] if len(fields) > 2 else (line if len(fields) == 1 else '')
+            if gene.strip():
+                genes.append(gene.strip())
+    return genes
+
+
+def gene_queue(gene_lists):
+    # All genes of the gene lists, in order, without duplicates
+    genes = []
+    seen = set()
+    for filename in gene_lists:
+        for gene in read_gene_list(filename):
+            if gene not in seen:
+                seen.add(gene)
+                genes.append(gene)
+    return genes
+
+
+def command_args(command, bams, db, gene, leeway, output):
+    # The command template split into arguments. {bams} on its own expands to one argument per bam file.
+    args = []
+    for arg in shlex.split(command):
+        if arg == '{bams}':
+            args.extend(bams)
+        else:
+            args.append(arg.format(bams=' '.join(bams), db=db, gene=gene, leeway=leeway, output=output))
+    return args
+
+
+def extract(command, bams, db, gene, leeway, output_dir):
+    # Extract one gene's reads. Returns [(gene, start time, seconds, exit status, command output)].
+    output = os.path.join(output_dir, gene + '.fa')
+    tmp_output = os.path.join(output_dir, gene + TMP_SUFFIX)
+    if os.path.exists(tmp_output):
+        os.remove(tmp_output)
+
+    start = time.time()
+    try:
+        process = subprocess.run(
+            command_args(command, bams, db, gene, leeway, tmp_output),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        )
+    except OSError as e:
+        # The command couldn't be started, e.g. it isn't on the PATH: status 127, as from a shell
+        return [(gene, start, time.time() - start, 127, repr(e))]
+    seconds = time.time() - start
+
+    if process.returncode == 0 and os.path.exists(tmp_output):
+        os.rename(tmp_output, output)
+        status = 0
+    else:
+        status = process.returncode or 1
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+    return [(gene, start, seconds, status, process.stdout.decode(errors='replace'))]
+
+
+def extract_native(bams, windows, output_dir):
+    # Extract a batch of genes with native_extract. Returns [(gene, start time, seconds, exit status, output)].
+    import native_extract
+
+    start = time.time()
+    try:
+        read_counts = native_extract.extract_batch(bams, windows, output_dir)
+    except Exception as e:
+        seconds = time.time() - start
+        return [(window[3], start, seconds, 1, repr(e)) for window in windows]
+    seconds = time.time() - start
+    return [(gene, start, seconds, 0, '%s reads' % count) for gene, count in read_counts.items()]
+
+
+def remove_stale_tmp(output_dir):
+    # Remove the temporary fastas of an interrupted run
+    stale = glob.glob(os.path.join(output_dir, '*' + TMP_SUFFIX))
+    for path in stale:
+        os.remove(path)
+    if stale:
+        print('Removed %s temporary files of an interrupted run' % len(stale))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Extract the short reads mapping to each gene of the gene lists, running up to CONCURRENCY
+        extractions at a time. Genes already extracted to the output directory are skipped.
+    ''')
+    parser.add_argument('gene_lists', metavar='GENE_LIST', nargs='+', help='Gene list files')
+    parser.add_argument('--bams-dir', default='/app/bams', help='Directory of .bam files (default /app/bams)')
+    parser.add_argument('--db', default='/app/db.db', help='anvio contigs database (default /app/db.db)')
+    parser.add_argument('--output-dir', default='/output', help='Output directory (default /output)')
+    parser.add_argument('--concurrency', type=int, default=os.cpu_count(),
+        help='Extractions run at the same time (default: number of CPUs)')
+    parser.add_argument('--leeway', type=int, default=35, help='Passed to anvio as --leeway (default 35)')
+    parser.add_argument('--command', default=COMMAND,
+        help='Command run for each gene, with {bams}, {db}, {gene}, {leeway} and {output} filled in. '
+             'Defaults to the anvio command: %s' % COMMAND.replace('%', '%%'))
+    parser.add_argument('--native', action='store_true',
+        help='Extract reads with pysam instead of anvio, batching neighbouring genes into one pass per bam')
+    parser.add_argument('--batch-genes', type=int, default=BATCH_GENES,
+        help='Genes per batch with --native (default %s)' % BATCH_GENES)
+    args = parser.parse_args()
+
+    bams = sorted(glob.glob(os.path.join(args.bams_dir, '*.bam')))
+    if not bams:
+        exit('No .bam files found in %s' % args.bams_dir)
+
+    remove_stale_tmp(args.output_dir)
+    genes = gene_queue(args.gene_lists)
+    todo = [gene for gene in genes if not os.path.exists(os.path.join(args.output_dir, gene + '.fa'))]
+    print('%s genes in %s gene lists, %s already extracted, %s to go' % (
+        len(genes), len(args.gene_lists), len(genes) - len(todo), len(todo)))
+
+    missing = []
+    if args.native:
+        try:
+            import native_extract
+        except ImportError:
+            exit('--native requires pysam. Install it with `pip install pysam`.')
+        windows, missing = native_extract.gene_windows(args.db, todo, args.leeway)
+        for gene in missing:
+            sys.stderr.write('Gene %s not found in %s, skipping.\n' % (gene, args.db))
+        todo = [window[3] for window in windows]
+        executor = ProcessPoolExecutor(args.concurrency)
+        jobs = [
+            (extract_native, bams, batch, args.output_dir)
+            for batch in native_extract.batches(windows, args.batch_genes)
+        ]
+    else:
+        executor = ThreadPoolExecutor(args.concurrency)
+        jobs = [(extract, args.command, bams, args.db, gene, args.leeway, args.output_dir) for gene in todo]
+
+    failed = len(missing)
+    extracted = 0
+    done = 0
+    run_start = time.time()
+    with open(os.path.join(args.output_dir, TIMES_FILE), 'a') as times, executor:
+        futures = [executor.submit(*job) for job in jobs]
+        for future in as_completed(futures):
+            for gene, start, seconds, status, output in future.result():
+                done += 1
+                times.write('%s\t%s\t%.2f\t%s\n' % (
+                    gene, time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)), seconds, status))
+                if status == 0:
+                    extracted += 1
+                else:
+                    failed += 1
+                    sys.stderr.write('Gene %s failed (exit status %s):\n%s\n' % (gene, status, output))
+                print('[%s/%s] %s: %.1f s%s' % (done, len(todo), gene, seconds, ' FAILED' if status else ''))
+            times.flush()
+
+    print('Extracted %s genes in %.1f s, %s failed' % (extracted, time.time() - run_start, failed))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
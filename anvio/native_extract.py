@@ -0,0 +1,106 @@
+# native_extract.py
+#
+# Extraction mode for extract-reads.py (--native) that reads the BAMs with pysam directly, instead of running
+# anvi-get-short-reads-mapping-to-a-gene once per gene.
+#
+# Gene coordinates are read from the contigs database's genes_in_contigs table, and genes are sorted by contig
+# and position. A batch of genes is extracted in one pass per BAM: the gene windows (start - leeway to
+# stop + leeway, as anvio fetches them) are merged into regions, each region is fetched once, and every read is
+# sent to each gene whose window it overlaps. Neighbouring genes share their reads instead of seeking to them again.
+#
+# Each gene's fasta is written the way anvio writes it: reads are kept per sample (the BAM's file name without
+# .bam) by read name, and headers are
+#   NNNNNNNN|sample_id:SAMPLE|reverse:True|contig_name:CONTIG
+# numbered from 0 within the gene.
+
+import os
+import sqlite3
+
+import pysam
+
+
+def gene_windows(db, genes, leeway):
+    # [(contig, window start, window end, gene)] of the genes found in the contigs db, sorted by position,
+    # and the genes that weren't found
+    con = sqlite3.connect(db)
+    calls = {
+        str(gene): (contig, start, stop)
+        for gene, contig, start, stop in con.execute('SELECT gene_callers_id, contig, start, stop FROM genes_in_contigs')
+    }
+    con.close()
+
+    windows = sorted(
+        (calls[gene][0], max(calls[gene][1] - leeway, 0), calls[gene][2] + leeway, gene)
+        for gene in genes if gene in calls
+    )
+    return windows, [gene for gene in genes if gene not in calls]
+
+
+def batches(windows, batch_genes):
+    # Consecutive runs of batch_genes windows, so each batch covers a narrow stretch of the contigs
+    return [windows[i:i + batch_genes] for i in range(0, len(windows), batch_genes)]
+
+
+def regions(windows):
+    # Merge one contig's sorted windows into [(start, end, windows)] regions, each fetched once
+    merged = []
+    for window in windows:
+        if merged and window[1] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], window[2])
+            merged[-1][2].append(window)
+        else:
+            merged.append([window[1], window[2], [window]])
+    return merged
+
+
+def overlapping_genes(reads, windows):
+    # (gene, read) for every read and every window it overlaps. reads are sorted by reference_start, as
+    # pysam fetches them, and windows by start. Windows ending before the current read starts are dropped,
+    # so only the few windows around the read are checked.
+    next_window = 0
+    active = []
+    for read in reads:
+        read_start, read_end = read.reference_start, read.reference_end
+        if read_end is None:
+            continue
+        while next_window < len(windows) and windows[next_window][1] < read_end:
+            active.append(windows[next_window])
+            next_window += 1
+        active = [window for window in active if window[2] > read_start]
+        for window in active:
+            if window[1] < read_end:
+                yield window[3], read
+
+
+def write_fasta(output_dir, gene, samples):
+    # Write a gene's reads to GENE.fa, as GENE.fa.tmp until it is complete (see extract-reads.py)
+    output = os.path.join(output_dir, gene + '.fa')
+    tmp_output = os.path.join(output_dir, gene + '.fa.tmp')
+    read_count = 0
+    with open(tmp_output, 'w') as f:
+        for sample_id, reads in samples.items():
+            for sequence, reverse, contig in reads.values():
+                f.write('>%08d|sample_id:%s|reverse:%s|contig_name:%s\n%s\n' % (
+                    read_count, sample_id, reverse, contig, sequence))
+                read_count += 1
+    os.rename(tmp_output, output)
+    return read_count
+
+
+def extract_batch(bams, windows, output_dir):
+    # Extract a batch of genes with one pass over each bam. Returns {gene: reads written}.
+    data = {window[3]: {} for window in windows}
+    contigs = {}
+    for window in windows:
+        contigs.setdefault(window[0], []).append(window)
+
+    for bam in bams:
+        sample_id = os.path.splitext(os.path.basename(bam))[0]
+        with pysam.AlignmentFile(bam, 'rb') as bam_file:
+            for contig, contig_windows in contigs.items():
+                for start, end, region_windows in regions(contig_windows):
+                    for gene, read in overlapping_genes(bam_file.fetch(contig, start, end), region_windows):
+                        data[gene].setdefault(sample_id, {})[read.query_name] = (
+                            read.query_sequence, read.is_reverse, contig)
+
+    return {gene: write_fasta(output_dir, gene, samples) for gene, samples in data.items()}
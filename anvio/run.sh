@@ -27,18 +27,14 @@ if [ ! -d ${OUTPUT_DIR} ]; then
 	exit 1
 fi
 
-port_offest=0
-for gene_list in $(ls $GENE_LIST_DIR)
-do
-	port=$((port_offset+${STARTING_PORT}))
-	((port_offset++))
-	docker run \
-		--name ${gene_list} \
-		-v ${GENE_LIST_DIR}/${gene_list}:/app/gene_list:z \
-		-v ${BAMS_DIR}:/app/bams:z \
-		-v ${DB}:/app/db.db:z \
-		-v ${OUTPUT_DIR}:/output:z \
-		-w /app \
-		-p $port:${CONTAINER_PORT} \
-		${IMAGE} &
-done
+# One container works through all the gene lists, running up to CONCURRENCY extractions at a time
+docker run \
+	--name ${IMAGE} \
+	-v ${GENE_LIST_DIR}:/app/gene_lists:z \
+	-v ${BAMS_DIR}:/app/bams:z \
+	-v ${DB}:/app/db.db:z \
+	-v ${OUTPUT_DIR}:/output:z \
+	-e CONCURRENCY=${CONCURRENCY} \
+	-e NATIVE=${NATIVE} \
+	-w /app \
+	${IMAGE} &
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+#Convert a directory of fasta files to sharded tables, in parallel
+#Usage: python fastasToTab.py [--workers N] [--shards N] FASTA_DIR OUTPUT_DIR
+#
+#Rows are identical to those of faToTab.py, which is run once per file: the fasta path and record description,
+#then the sequence length and GC content. Shard i gets every i-th file (sorted by name) and is written to
+#OUTPUT_DIR/fasta-table.NNN.tsv. Each shard can be loaded by its own populate.py.
+
+import argparse
+import multiprocessing
+import os
+
+GC_BASES = (b'G', b'C', b'g', b'c', b'S', b's')
+
+
+def gc(seq):
+	#Same result as Bio.SeqUtils.GC, counting bytes instead of building a Seq
+	try:
+		return sum(seq.count(base) for base in GC_BASES) * 100.0 / len(seq)
+	except ZeroDivisionError:
+		return 0.0
+
+
+def fasta_records(f):
+	#(description, sequence) of each record, parsed the way Bio.SeqIO's fasta parser does
+	description = None
+	lines = []
+	for line in f:
+		if line.startswith(b'>'):
+			if description is not None:
+				yield description, b''.join(lines).replace(b' ', b'').replace(b'\r', b'')
+			description = line[1:].rstrip().decode()
+			lines = []
+		elif description is not None:
+			lines.append(line.rstrip())
+	if description is not None:
+		yield description, b''.join(lines).replace(b' ', b'').replace(b'\r', b'')
+
+
+def fasta_rows(path):
+	with open(path, 'rb') as f:
+		for description, seq in fasta_records(f):
+			line = str(path)+'_'+description
+			lines = line.replace('|','\t').replace('.fa','').replace('sample_id:','').replace('sample_id:','').replace('reverse:','').replace('contig_name:','')
+			yield '{}\t{}\t{}\n'.format(lines, len(seq), gc(seq))
+
+
+def convert_shard(task):
+	(shard, paths, output_dir) = task
+	shard_path = os.path.join(output_dir, 'fasta-table.%03d.tsv' % shard)
+	rows = 0
+	with open(shard_path, 'w') as out:
+		for path in paths:
+			for row in fasta_rows(path):
+				out.write(row)
+				rows += 1
+	return shard_path, len(paths), rows
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Convert a directory of fasta files to sharded tables, in parallel.')
+	parser.add_argument('fasta_dir', metavar='FASTA_DIR')
+	parser.add_argument('output_dir', metavar='OUTPUT_DIR')
+	parser.add_argument('--workers', type=int, default=os.cpu_count(),
+		help='Number of worker processes (default: number of CPUs)')
+	parser.add_argument('--shards', type=int,
+		help='Number of output tables (default: number of workers)')
+	args = parser.parse_args()
+
+	shards = args.shards or args.workers
+	# Only the gene fastas, not extract-reads.py's temporary fastas or timings
+	paths = [
+		os.path.join(args.fasta_dir, name) for name in sorted(os.listdir(args.fasta_dir))
+		if name.endswith('.fa') and not name.startswith('.')
+	]
+	tasks = [(shard, paths[shard::shards], args.output_dir) for shard in range(shards)]
+
+	print('Converting {} fasta files into {} tables with {} workers'.format(len(paths), shards, args.workers))
+	pool = multiprocessing.Pool(args.workers)
+	for shard_path, files, rows in pool.imap_unordered(convert_shard, tasks):
+		print('{}: {} files, {} rows'.format(shard_path, files, rows))
+	pool.close()
+	pool.join()
+
+
+if __name__ == '__main__':
+	main()
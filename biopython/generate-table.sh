@@ -1,5 +1,5 @@
 #!/bin/bash
 
-for file in $(ls /fastas); do
-	python /biopython/faToTab.py /fastas/${file} >> /output/fasta-table.tsv
-done
+# Writes /output/fasta-table.NNN.tsv, one table per shard. Set WORKERS / SHARDS to override the defaults
+# (number of CPUs, and one shard per worker).
+python /biopython/fastasToTab.py ${WORKERS:+--workers $WORKERS} ${SHARDS:+--shards $SHARDS} /fastas /output
@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# Tables are created from sql/create-tables.sql, or the .sql file given as the first argument
+SQL_FILE=${1:-./sql/create-tables.sql}
+
 if [ -f ../config ]; then
 	. ../config
 else
@@ -23,7 +26,7 @@ docker exec -it ${CONTAINER_NAME} mysql -u 'root' -p"${MYSQL_ROOT_PASS}" -e " \
 	flush privileges;"
 
 echo "Creating tables."
-docker cp ./sql/create-tables.sql ${CONTAINER_NAME}:/create-tables.sql
+docker cp ${SQL_FILE} ${CONTAINER_NAME}:/create-tables.sql
 docker exec -it ${CONTAINER_NAME} bin/bash -c "cat /create-tables.sql | sed 's/#MYSQL_DB#/${MYSQL_DB}/' | mysql -u"${MYSQL_USER}" -p"${MYSQL_PASS}
 
 echo "Done."
@@ -0,0 +1,107 @@
+-- MySQL Workbench Forward Engineering
+
+SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;
+SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;
+SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='ONLY_FULL_GROUP_BY,STRICT_TRANS_TABLES,NO_ZERO_IN_DATE,NO_ZERO_DATE,ERROR_FOR_DIVISION_BY_ZERO,NO_ENGINE_SUBSTITUTION';
+
+-- -----------------------------------------------------
+-- Schema mydb
+-- -----------------------------------------------------
+-- -----------------------------------------------------
+-- Schema #MYSQL_DB#
+-- -----------------------------------------------------
+
+-- -----------------------------------------------------
+-- Schema #MYSQL_DB#
+-- -----------------------------------------------------
+CREATE SCHEMA IF NOT EXISTS `#MYSQL_DB#` DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci ;
+USE `#MYSQL_DB#` ;
+
+-- -----------------------------------------------------
+-- Table `#MYSQL_DB#`.`ecotypes`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `#MYSQL_DB#`.`ecotypes` (
+	  `id` SMALLINT UNSIGNED NOT NULL AUTO_INCREMENT,
+	  `name` VARCHAR(191) NULL,
+	  PRIMARY KEY (`id`),
+	  UNIQUE INDEX `name_UNIQUE` (`name` ASC) VISIBLE)
+	ENGINE = InnoDB
+	DEFAULT CHARACTER SET = utf8mb4
+	COLLATE = utf8mb4_0900_ai_ci;
+
+
+-- -----------------------------------------------------
+-- Table `#MYSQL_DB#`.`genes`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `#MYSQL_DB#`.`genes` (
+	  `gene_id` MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT,
+	  `length` SMALLINT UNSIGNED NOT NULL,
+	  `ecotype_id` SMALLINT UNSIGNED NOT NULL,
+	  PRIMARY KEY (`gene_id`),
+	  INDEX `genes_ecotypes_fk_idx` (`ecotype_id` ASC) VISIBLE,
+	  CONSTRAINT `genes_ecotypes_fk`
+            FOREIGN KEY (`ecotype_id`)
+	    REFERENCES `#MYSQL_DB#`.`ecotypes` (`id`)
+	)
+	ENGINE = InnoDB
+	DEFAULT CHAR SET = utf8mb4
+	COLLATE=utf8mb4_0900_ai_ci;
+
+
+-- -----------------------------------------------------
+-- Table `#MYSQL_DB#`.`stations`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `#MYSQL_DB#`.`stations` (
+	  `id` SMALLINT UNSIGNED NOT NULL AUTO_INCREMENT,
+	  `name` VARCHAR(12) NOT NULL,
+	  PRIMARY KEY (`id`),
+	  UNIQUE INDEX `name_UNIQUE` (`name` ASC) VISIBLE)
+	ENGINE = InnoDB
+	DEFAULT CHARACTER SET = utf8mb4
+	COLLATE = utf8mb4_0900_ai_ci;
+
+
+-- -----------------------------------------------------
+-- Table `#MYSQL_DB#`.`gene_reads`
+-- Clustered variant: ecotype_id is copied from genes so reads of an ecotype and station are stored together,
+-- in primary key order, and are read with one range scan. Partitioned by ecotype. Partitioned tables can't have
+-- foreign keys, so gene_id, station_id and ecotype_id are not checked against their tables.
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `#MYSQL_DB#`.`gene_reads` (
+	  `ecotype_id` SMALLINT UNSIGNED NOT NULL,
+	  `station_id` SMALLINT UNSIGNED NOT NULL,
+	  `gene_id` MEDIUMINT UNSIGNED NOT NULL,
+	  `read_number` INT UNSIGNED NOT NULL,
+	  `contig_id` SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+	  `read_length` SMALLINT UNSIGNED NOT NULL,
+	  `gc_content` DECIMAL(4,2) NOT NULL,
+	  PRIMARY KEY (`ecotype_id`, `station_id`, `gene_id`, `read_number`)
+        )
+	ENGINE = InnoDB
+	DEFAULT CHARACTER SET = utf8mb4
+	COLLATE = utf8mb4_0900_ai_ci
+	PARTITION BY KEY (`ecotype_id`) PARTITIONS 16;
+
+
+-- -----------------------------------------------------
+-- Table `#MYSQL_DB#`.`ingest_ledger`
+-- Last committed byte offset of each shard of a file loaded by populate.py
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `#MYSQL_DB#`.`ingest_ledger` (
+	  `file_name` VARCHAR(191) NOT NULL,
+	  `file_size` BIGINT UNSIGNED NOT NULL,
+	  `shard_start` BIGINT UNSIGNED NOT NULL,
+	  `shard_end` BIGINT UNSIGNED NOT NULL,
+	  `byte_offset` BIGINT UNSIGNED NOT NULL,
+	  `rows_committed` BIGINT UNSIGNED NOT NULL DEFAULT 0,
+	  `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+	  PRIMARY KEY (`file_name`, `shard_start`))
+	ENGINE = InnoDB
+	DEFAULT CHARACTER SET = utf8mb4
+	COLLATE = utf8mb4_0900_ai_ci;
+
+-- -----------------------------------------------------
+
+	SET SQL_MODE=@OLD_SQL_MODE;
+	SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS;
+	SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS;
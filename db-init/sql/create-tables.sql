@@ -91,6 +91,24 @@ CREATE TABLE IF NOT EXISTS `#MYSQL_DB#`.`gene_reads` (
 	DEFAULT CHARACTER SET = utf8mb4
 	COLLATE = utf8mb4_0900_ai_ci;
 
+
+-- -----------------------------------------------------
+-- Table `#MYSQL_DB#`.`ingest_ledger`
+-- Last committed byte offset of each shard of a file loaded by populate.py
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `#MYSQL_DB#`.`ingest_ledger` (
+	  `file_name` VARCHAR(191) NOT NULL,
+	  `file_size` BIGINT UNSIGNED NOT NULL,
+	  `shard_start` BIGINT UNSIGNED NOT NULL,
+	  `shard_end` BIGINT UNSIGNED NOT NULL,
+	  `byte_offset` BIGINT UNSIGNED NOT NULL,
+	  `rows_committed` BIGINT UNSIGNED NOT NULL DEFAULT 0,
+	  `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+	  PRIMARY KEY (`file_name`, `shard_start`))
+	ENGINE = InnoDB
+	DEFAULT CHARACTER SET = utf8mb4
+	COLLATE = utf8mb4_0900_ai_ci;
+
 -- -----------------------------------------------------
 
 	SET SQL_MODE=@OLD_SQL_MODE;
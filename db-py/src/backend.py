@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+# backend.py
+#
+# The database the scripts use, chosen with DB_BACKEND:
+#   mysql    the MySQL server of MYSQL_DB, MYSQL_USER and MYSQL_PASS, e.g. the db-init container (default)
+#   sqlite   an embedded SQLite database, in the file DB_PATH
+#   duckdb   an embedded DuckDB database, in the file DB_PATH. Tables are stored by column, and rarefy.py reads its
+#            scans of gene_reads straight into numpy arrays (fetch_arrays), in process, with no server or network
+#            hop. Requires duckdb (`pip install duckdb`).
+# Embedded databases don't need the db-init container. `python src/backend.py init` creates their tables, in the
+# standard layout of create-tables.sql.
+#
+# MySQL connections are the connector's own. Embedded connections are wrapped so the scripts' %s placeholders work
+# with them too, and the functions below give each database's SQL where the dialects differ.
+
+import argparse
+from mysql.connector import connect
+import os
+import pandas as pd
+import sqlite3
+
+BACKENDS = ('mysql', 'sqlite', 'duckdb')
+DB_DIR = '/app/output'
+
+# Databases that can bulk load a .tsv file (populate.py --method load)
+LOAD_BACKENDS = ('mysql', 'duckdb')
+
+EMBEDDED_DDL = {
+    'sqlite': '''
+        CREATE TABLE IF NOT EXISTS ecotypes (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS contigs (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            ecotype_id INTEGER REFERENCES ecotypes (id)
+        );
+        CREATE TABLE IF NOT EXISTS genes (
+            gene_id INTEGER PRIMARY KEY,
+            length INTEGER NOT NULL,
+            ecotype_id INTEGER NOT NULL REFERENCES ecotypes (id)
+        );
+        CREATE INDEX IF NOT EXISTS genes_ecotypes_fk_idx ON genes (ecotype_id);
+        CREATE TABLE IF NOT EXISTS stations (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS gene_reads (
+            id INTEGER PRIMARY KEY,
+            contig_id INTEGER NOT NULL DEFAULT 0,
+            gene_id INTEGER NOT NULL REFERENCES genes (gene_id),
+            station_id INTEGER NOT NULL REFERENCES stations (id),
+            read_number INTEGER NOT NULL,
+            read_length INTEGER NOT NULL,
+            gc_content DECIMAL(4,2) NOT NULL,
+            UNIQUE (gene_id, read_number, station_id)
+        );
+        CREATE INDEX IF NOT EXISTS gene_reads_stations_fk_idx ON gene_reads (station_id);
+        CREATE INDEX IF NOT EXISTS gene_reads_genes_fk_idx ON gene_reads (gene_id);
+        CREATE TABLE IF NOT EXISTS ingest_ledger (
+            file_name TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            shard_start INTEGER NOT NULL,
+            shard_end INTEGER NOT NULL,
+            byte_offset INTEGER NOT NULL,
+            rows_committed INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (file_name, shard_start)
+        );
+    ''',
+    # Ids come from sequences. There are no foreign keys or secondary indexes, which only slow a columnar store's
+    # loads down; the unique key of gene_reads is kept for INSERT OR IGNORE.
+    'duckdb': '''
+        CREATE SEQUENCE IF NOT EXISTS ecotypes_id;
+        CREATE TABLE IF NOT EXISTS ecotypes (
+            id USMALLINT PRIMARY KEY DEFAULT nextval('ecotypes_id'),
+            name VARCHAR UNIQUE
+        );
+        CREATE SEQUENCE IF NOT EXISTS contigs_id;
+        CREATE TABLE IF NOT EXISTS contigs (
+            id USMALLINT PRIMARY KEY DEFAULT nextval('contigs_id'),
+            name VARCHAR NOT NULL UNIQUE,
+            ecotype_id USMALLINT
+        );
+        CREATE TABLE IF NOT EXISTS genes (
+            gene_id UINTEGER PRIMARY KEY,
+            length USMALLINT NOT NULL,
+            ecotype_id USMALLINT NOT NULL
+        );
+        CREATE SEQUENCE IF NOT EXISTS stations_id;
+        CREATE TABLE IF NOT EXISTS stations (
+            id USMALLINT PRIMARY KEY DEFAULT nextval('stations_id'),
+            name VARCHAR NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS gene_reads (
+            contig_id USMALLINT NOT NULL DEFAULT 0,
+            gene_id UINTEGER NOT NULL,
+            station_id USMALLINT NOT NULL,
+            read_number UINTEGER NOT NULL,
+            read_length UINTEGER NOT NULL,
+            gc_content DECIMAL(4,2) NOT NULL,
+            UNIQUE (gene_id, read_number, station_id)
+        );
+        CREATE TABLE IF NOT EXISTS ingest_ledger (
+            file_name VARCHAR NOT NULL,
+            file_size UBIGINT NOT NULL,
+            shard_start UBIGINT NOT NULL,
+            shard_end UBIGINT NOT NULL,
+            byte_offset UBIGINT NOT NULL,
+            rows_committed UBIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (file_name, shard_start)
+        );
+    ''',
+}
+
+
+class EmbeddedCursor:
+    # Cursor of an embedded database, taking %s placeholders like the MySQL connector's.
+    # rowcount is the number of rows written by the last INSERT, UPDATE or DELETE.
+    def __init__(self, dialect, cur):
+        self.dialect = dialect
+        self._cur = cur
+        self.rowcount = -1
+
+    def execute(self, sql, params=None):
+        if params is None:
+            self._cur.execute(sql)
+        else:
+            self._cur.execute(sql.replace('%s', '?'), params)
+        self.rowcount = self._cur.rowcount
+        if self.dialect == 'duckdb' and sql.split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            # DuckDB returns the count as the statement's result
+            (self.rowcount,) = self._cur.fetchone()
+
+    def executemany(self, sql, rows):
+        self._cur.executemany(sql.replace('%s', '?'), rows)
+        self.rowcount = self._cur.rowcount
+
+    def close(self):
+        self._cur.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+class EmbeddedConnection:
+    # Connection to an embedded database. SQLite starts a transaction before each write, as the MySQL connector
+    # does. DuckDB commits each statement on its own; its cursors are connections of their own, and it only lets
+    # one process open the database, so there are no other writers to isolate a read from.
+    def __init__(self, dialect, con):
+        self.dialect = dialect
+        self._con = con
+
+    def cursor(self, **kwargs):
+        return EmbeddedCursor(self.dialect, self._con.cursor())
+
+    def start_transaction(self, **kwargs):
+        if self.dialect == 'sqlite':
+            self._con.execute('BEGIN')
+
+    def commit(self):
+        self._con.commit()
+
+    def rollback(self):
+        if self.dialect != 'duckdb':
+            self._con.rollback()
+
+    def close(self):
+        self._con.close()
+
+
+def backend_name():
+    name = os.getenv('DB_BACKEND') or 'mysql'
+    if name not in BACKENDS:
+        exit('Unknown DB_BACKEND "%s". Use one of: %s' % (name, ', '.join(BACKENDS)))
+    return name
+
+
+def db_path(name):
+    return os.getenv('DB_PATH') or os.path.join(DB_DIR, 'rarefaction.%s' % name)
+
+
+def connect_db(local_infile=False):
+    name = backend_name()
+    if name == 'sqlite':
+        return EmbeddedConnection(name, sqlite3.connect(db_path(name), timeout=60, check_same_thread=False))
+    if name == 'duckdb':
+        try:
+            import duckdb
+        except ImportError:
+            exit('DB_BACKEND=duckdb requires duckdb. Install it with `pip install duckdb`.')
+        return EmbeddedConnection(name, duckdb.connect(db_path(name)))
+
+    return connect(
+        database=os.getenv('MYSQL_DB'),
+        user=os.getenv('MYSQL_USER'),
+        password=os.getenv('MYSQL_PASS'),
+        allow_local_infile=local_infile,
+    )
+
+
+def dialect(con):
+    return getattr(con, 'dialect', 'mysql')
+
+
+def insert_ignore(con):
+    # INSERT skipping rows that would duplicate a unique key
+    return 'INSERT IGNORE' if dialect(con) == 'mysql' else 'INSERT OR IGNORE'
+
+
+def upsert(con, key, columns):
+    # Clause to follow an INSERT ... VALUES, updating `columns` of rows whose `key` already exists
+    if dialect(con) == 'mysql':
+        return 'ON DUPLICATE KEY UPDATE ' + ', '.join('%s=VALUES(%s)' % (column, column) for column in columns)
+    return 'ON CONFLICT (%s) DO UPDATE SET %s' % (
+        key, ', '.join('%s=excluded.%s' % (column, column) for column in columns))
+
+
+def insert_frame(cur, verb, table, columns, rows, suffix=''):
+    # DuckDB: insert rows with a single INSERT ... SELECT over them as a DataFrame, rather than one statement per
+    # row. Returns the number of rows inserted.
+    cur.register('insert_rows', pd.DataFrame.from_records(rows, columns=columns))
+    cur.execute('%s INTO %s (%s) SELECT %s FROM insert_rows %s' % (
+        verb, table, ', '.join(columns), ', '.join(columns), suffix))
+    cur.unregister('insert_rows')
+    return cur.rowcount
+
+
+def insert_many(con, cur, table, columns, rows, verb='INSERT', suffix=''):
+    # Insert rows (tuples of columns) with one parameterized statement for the whole list, followed by suffix
+    # (e.g. an upsert clause). The MySQL connector sends them as multi-row INSERTs.
+    if dialect(con) == 'duckdb':
+        return insert_frame(cur, verb, table, columns, rows, suffix)
+    cur.executemany('%s INTO %s (%s) VALUES (%s) %s' % (
+        verb, table, ', '.join(columns), ', '.join(['%s'] * len(columns)), suffix), rows)
+    return cur.rowcount
+
+
+def update_from_sql(con, table, key, source, source_key, columns):
+    # UPDATE columns of table from the rows of source matching on table.key = source.source_key, in one statement
+    if dialect(con) == 'mysql':
+        return 'UPDATE %s JOIN %s ON %s.%s = %s.%s SET %s' % (
+            table, source, source, source_key, table, key,
+            ', '.join('%s.%s = %s.%s' % (table, column, source, column) for column in columns))
+    return 'UPDATE %s SET %s FROM %s WHERE %s.%s = %s.%s' % (
+        table, ', '.join('%s = %s.%s' % (column, source, column) for column in columns), source,
+        source, source_key, table, key)
+
+
+def load_tsv_sql(con, path, table, columns):
+    # Statement loading a .tsv file of the given columns into table, skipping duplicate keys
+    if dialect(con) == 'duckdb':
+        return '''
+            INSERT OR IGNORE INTO %s (%s)
+            SELECT * FROM read_csv('%s', delim='\\t', header=false, quote='', all_varchar=true)
+        ''' % (table, ', '.join(columns), path)
+    return """
+        LOAD DATA LOCAL INFILE '%s'
+        IGNORE INTO TABLE `%s`
+        FIELDS TERMINATED BY '\\t'
+        LINES TERMINATED BY '\\n'
+    """ % (path, table) + '(' + ', '.join(columns) + ')'
+
+
+def fetch_arrays(con, sql):
+    # DuckDB: the query's result as one numpy array per column, without going through Python rows.
+    # None for other databases.
+    if dialect(con) != 'duckdb':
+        return None
+    cur = con.cursor()
+    cur.execute(sql)
+    arrays = list(cur.fetchnumpy().values())
+    cur.close()
+    return arrays
+
+
+def bytes_sent(con):
+    # Bytes the MySQL server has sent over this connection so far. None for embedded databases, which run in
+    # process and transfer nothing.
+    if dialect(con) != 'mysql':
+        return None
+    cur = con.cursor()
+    cur.execute("SHOW SESSION STATUS LIKE 'Bytes_sent'")
+    (name, value) = cur.fetchone()
+    cur.close()
+    return int(value)
+
+
+def init_db():
+    name = backend_name()
+    if name == 'mysql':
+        exit('MySQL tables are created by db-init')
+    con = connect_db()
+    cur = con.cursor()
+    for statement in EMBEDDED_DDL[name].split(';'):
+        if statement.strip():
+            cur.execute(statement)
+    con.commit()
+    cur.close()
+    con.close()
+    print('Tables created in %s' % db_path(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Create the tables of an embedded database (DB_BACKEND sqlite or duckdb), in the file DB_PATH.
+    ''')
+    parser.add_argument('command', choices=('init',))
+    parser.parse_args()
+    init_db()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# benchmark-schema.py
+# Compares the two gene_reads layouts (see schema.py) on the same reads: load time, table size, and the time of
+# rarefy.py's queries (raw reads and --source summary) over every ecotype, POOL_SIZE stations at a time.
+#
+# Rows are read from a biopython .tsv, as for populate.py, and loaded with LOAD DATA batches into two scratch tables,
+# bench_gene_reads_standard and bench_gene_reads_clustered, which are dropped afterwards unless --keep is given.
+# The genes, ecotypes and stations tables must already be populated. The standard table has the same keys as
+# create-tables.sql, except the foreign key to contigs, which the loader doesn't fill in.
+
+import argparse
+import backend
+import json
+import populate
+import schema
+import tempfile
+import time
+
+POOL_SIZE = 30
+LAYOUTS = ('standard', 'clustered')
+
+STANDARD_GENE_READS_DDL = '''
+    CREATE TABLE IF NOT EXISTS `%s` (
+        `id` INT UNSIGNED NOT NULL AUTO_INCREMENT,
+        `contig_id` SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+        `gene_id` MEDIUMINT UNSIGNED NOT NULL,
+        `station_id` SMALLINT UNSIGNED NOT NULL,
+        `read_number` INT UNSIGNED NOT NULL,
+        `read_length` INT UNSIGNED NOT NULL,
+        `gc_content` DECIMAL(4,2) NOT NULL,
+        PRIMARY KEY (`id`),
+        UNIQUE INDEX `%s_gene_read_station_unique` (`gene_id` ASC, `read_number` ASC, `station_id` ASC),
+        INDEX `%s_stations_fk_idx` (`station_id` ASC),
+        INDEX `%s_contigs_fk_idx` (`contig_id` ASC),
+        INDEX `%s_genes_fk_idx` (`gene_id` ASC),
+        CONSTRAINT `%s_stations_fk` FOREIGN KEY (`station_id`) REFERENCES stations (`id`),
+        CONSTRAINT `%s_genes_fk` FOREIGN KEY (`gene_id`) REFERENCES genes (`gene_id`)
+    )
+    ENGINE = InnoDB
+    DEFAULT CHARACTER SET = utf8mb4
+    COLLATE = utf8mb4_0900_ai_ci
+'''
+
+
+def table_name(layout):
+    return 'bench_gene_reads_' + layout
+
+
+def create_table(con, layout):
+    table = table_name(layout)
+    cur = con.cursor()
+    cur.execute('DROP TABLE IF EXISTS `%s`' % table)
+    if layout == 'clustered':
+        cur.execute(schema.CLUSTERED_GENE_READS_DDL % table)
+    else:
+        cur.execute(STANDARD_GENE_READS_DDL % ((table,) * 7))
+    cur.close()
+
+
+def read_rows(filename, stations, genes, limit):
+    # (standard rows, clustered rows) of the first `limit` lines of the .tsv whose station and gene are known
+    standard = []
+    clustered = []
+    with open(filename) as f:
+        for line in f:
+            if limit and len(standard) == limit:
+                break
+            record = line.strip().split('\t')
+            stationId = stations.get(record[populate.STATION_COL])
+            if stationId is None:
+                continue
+            row = populate.gene_read_row(record, stationId, genes)
+            if row is None:
+                continue
+            clustered.append(row)
+            standard.append(populate.gene_read_row(record, stationId))
+    return standard, clustered
+
+
+def load_table(con, layout, rows, batchSize):
+    # Seconds taken to LOAD DATA the rows in batches, each sorted and committed like populate.py's
+    table = table_name(layout)
+    tmpFile = tempfile.NamedTemporaryFile('w', prefix='bench_', suffix='.tsv')
+    cur = con.cursor()
+    startTime = time.monotonic()
+    for start in range(0, len(rows), batchSize):
+        batch = sorted(rows[start:start + batchSize])
+        tmpFile.seek(0)
+        tmpFile.truncate()
+        rowFormat = '\t'.join(['%s'] * len(batch[0])) + '\n'
+        for row in batch:
+            tmpFile.write(rowFormat % row)
+        tmpFile.flush()
+        cur.execute('''
+            LOAD DATA LOCAL INFILE '%s'
+            IGNORE INTO TABLE `%s`
+            FIELDS TERMINATED BY '\\t'
+            LINES TERMINATED BY '\\n'
+        ''' % (tmpFile.name, table) + populate.gene_reads_columns(batch))
+        con.commit()
+    elapsed = time.monotonic() - startTime
+    cur.close()
+    tmpFile.close()
+    return elapsed
+
+
+def table_size(con, layout):
+    # (data bytes, index bytes) as reported by InnoDB, after refreshing its statistics
+    cur = con.cursor()
+    cur.execute('ANALYZE TABLE `%s`' % table_name(layout))
+    cur.fetchall()
+    cur.execute(
+        'SELECT data_length, index_length FROM information_schema.tables '
+        'WHERE table_schema = DATABASE() AND table_name = %s',
+        (table_name(layout),)
+    )
+    (data, index) = cur.fetchone()
+    cur.close()
+    return int(data), int(index)
+
+
+def rarefy_queries(layout, ecotypeIds, stationIds):
+    # The raw and summary queries rarefy.py runs for a pool of stations, against the layout's table
+    table = table_name(layout)
+    if layout == 'clustered':
+        reads, ecotypeColumn = '`%s` gr' % table, 'gr.ecotype_id'
+    else:
+        reads, ecotypeColumn = '`%s` gr JOIN genes g ON g.gene_id = gr.gene_id' % table, 'g.ecotype_id'
+    where = 'WHERE %s IN (%s) AND gr.station_id IN (%s)' % (
+        ecotypeColumn, ', '.join(str(x) for x in ecotypeIds), ', '.join(str(x) for x in stationIds))
+    return {
+        'raw': 'SELECT %s, gr.gene_id, gr.station_id, gr.read_length FROM %s %s' % (ecotypeColumn, reads, where),
+        'summary': 'SELECT %s, gr.station_id, gr.gene_id, gr.read_length, COUNT(*) FROM %s %s '
+                   'GROUP BY %s, gr.station_id, gr.gene_id, gr.read_length' % (
+                       ecotypeColumn, reads, where, ecotypeColumn),
+    }
+
+
+def time_queries(con, layout, ecotypeIds, stationIds, repeat):
+    # Best of `repeat` total times, in seconds, of each query kind over every ecotype and pool of stations
+    best = {}
+    cur = con.cursor()
+    for i in range(repeat):
+        totals = {}
+        for ecotypeId in ecotypeIds:
+            for start in range(0, len(stationIds), POOL_SIZE):
+                for kind, sql in rarefy_queries(layout, [ecotypeId], stationIds[start:start + POOL_SIZE]).items():
+                    startTime = time.monotonic()
+                    cur.execute(sql)
+                    cur.fetchall()
+                    totals[kind] = totals.get(kind, 0) + time.monotonic() - startTime
+        for kind, total in totals.items():
+            best[kind] = min(best.get(kind, total), total)
+    cur.close()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Compare load and rarefy query times of the standard and clustered gene_reads layouts, using
+        scratch copies of the reads in a biopython .tsv.
+    ''')
+    parser.add_argument('input_filename', metavar='INPUT.TSV', help='The biopython output .tsv')
+    parser.add_argument('--rows', type=int, default=0, help='Load only the first ROWS reads (default: all)')
+    parser.add_argument('--batch-size', type=int, default=populate.BULK_BATCH_SIZE,
+            help='Rows per LOAD DATA batch (default %s)' % populate.BULK_BATCH_SIZE)
+    parser.add_argument('--repeat', type=int, default=3, help='Query runs per layout; the best is kept (default 3)')
+    parser.add_argument('--json', metavar='FILE', help='Also write the results to FILE as JSON')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch tables')
+    args = parser.parse_args()
+
+    con = populate.connect_db('load')
+    if backend.dialect(con) != 'mysql':
+        exit('benchmark-schema.py compares MySQL table layouts. Run it with DB_BACKEND=mysql.')
+    stations = populate.load_stations(con)
+    genes = populate.load_genes(con)
+    ecotypeIds = sorted(set(genes.values()))
+
+    print('Reading ' + args.input_filename)
+    rows = dict(zip(LAYOUTS, read_rows(args.input_filename, stations, genes, args.rows)))
+    stationIds = sorted({row[schema.GENE_READS_COLUMNS.index('station_id')] for row in rows['standard']})
+    print('%s reads, %s stations, %s ecotypes' % (len(rows['standard']), len(stationIds), len(ecotypeIds)))
+
+    results = {}
+    for layout in LAYOUTS:
+        create_table(con, layout)
+        print('Loading %s layout' % layout)
+        loadTime = load_table(con, layout, rows[layout], args.batch_size)
+        data, index = table_size(con, layout)
+        print('Querying %s layout' % layout)
+        queries = time_queries(con, layout, ecotypeIds, stationIds, args.repeat)
+        results[layout] = {
+            'load_seconds': loadTime,
+            'rows_per_second': len(rows[layout]) / loadTime if loadTime else 0,
+            'data_bytes': data,
+            'index_bytes': index,
+            'raw_query_seconds': queries.get('raw', 0),
+            'summary_query_seconds': queries.get('summary', 0),
+        }
+        if not args.keep:
+            cur = con.cursor()
+            cur.execute('DROP TABLE `%s`' % table_name(layout))
+            cur.close()
+
+    print()
+    print('%-24s %14s %14s' % ('', *LAYOUTS))
+    for key in results['standard']:
+        print('%-24s %14.2f %14.2f' % (key, results['standard'][key], results['clustered'][key]))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'reads': len(rows['standard']), 'stations': len(stationIds), 'layouts': results}, f, indent=2)
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# benchmark.py
+# Times the pipeline on a seeded synthetic dataset (see synthetic.py), so a change to rarefy.py, populate.py or the
+# biopython step can be compared against the code before it:
+#   fastas_to_tab   biopython/fastasToTab.py over the dataset's fastas (only with --fastas-to-tab)
+#   import_genes    import-genes-ecotypes.py
+#   ingest          populate.py, loading the dataset's biopython table
+#   rarefy          rarefy.py's pool fetch and sampling over every ecotype and station, timed per station and depth
+# Each step runs in a process of its own, and its wall time and peak RSS are recorded. The results are written as
+# JSON (--json), along with the dataset and the arguments of the run.
+#
+# --backend mysql runs against the database of MYSQL_DB / MYSQL_USER / MYSQL_PASS, e.g. the local container. Its
+# tables must be empty, or be emptied with --reset. --backend sqlite and duckdb use an embedded database (see
+# backend.py) in the benchmark directory instead, created afresh for each run.
+
+import argparse
+import backend
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+import json
+import multiprocessing
+import os
+import pandas as pd
+import platform
+import populate
+import rarefy
+import resource
+import schema
+import subprocess
+import sys
+import synthetic
+import time
+
+BENCHMARK_DIR = '/app/output/benchmark'
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TABLES = ('gene_reads', 'stations', 'genes', 'ecotypes')
+
+
+def peak_rss_mib(usage):
+    # ru_maxrss is in KiB on Linux
+    return usage.ru_maxrss / 1024
+
+
+def measured(function, *args):
+    # function(*args), with the seconds it took and the peak RSS of the process
+    start = time.monotonic()
+    result = function(*args)
+    return result, time.monotonic() - start, peak_rss_mib(resource.getrusage(resource.RUSAGE_SELF))
+
+
+def run_isolated(function, *args):
+    # Run function in a fresh process, so the peak RSS is the step's own
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(measured, function, *args).result()
+
+
+def run_command(command, log_path):
+    # Run a script, with its output in log_path. Returns the seconds it took and its peak RSS.
+    with open(log_path, 'w') as log:
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=SRC_DIR)
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - start
+    if not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+        exit('%s failed, see %s' % (' '.join(command), log_path))
+    return elapsed, peak_rss_mib(usage)
+
+
+def prepare_mysql(reset):
+    # The tables must be empty, so the run loads the whole dataset
+    con = populate.connect_db('insert')
+    cur = con.cursor()
+    counts = {}
+    for table in TABLES:
+        cur.execute('SELECT COUNT(*) FROM %s' % table)
+        (counts[table],) = cur.fetchone()
+    if any(counts.values()):
+        if not reset:
+            exit('The database is not empty (%s). Use --reset to empty it first.' % ', '.join(
+                '%s %s' % (count, table) for table, count in counts.items() if count))
+        print('Emptying %s' % ', '.join(TABLES))
+        populate.ensure_ledger(con)
+        for table in TABLES + ('ingest_ledger',):
+            cur.execute('DELETE FROM %s' % table)
+        con.commit()
+    cur.close()
+    con.close()
+
+
+def prepare_embedded(name, path):
+    # A new, empty embedded database at path, which the scripts then use
+    for filename in (path, path + '.wal'):
+        if os.path.exists(filename):
+            os.remove(filename)
+    os.environ['DB_BACKEND'] = name
+    os.environ['DB_PATH'] = path
+    backend.init_db()
+
+
+def rarefy_all(depths, replicates, seed, memory_budget):
+    # Rarefy every ecotype at every station and depth with rarefy.py's pools, fetch and sampling (--source db,
+    # one worker, no prefetch). Returns the seconds taken to fetch each pool and to compute each ecotype / station /
+    # depth, all replicates at once.
+    con = rarefy.connect_db()
+    clustered = schema.is_clustered(con)
+    cur = con.cursor()
+    cur.execute('SELECT id, name FROM ecotypes ORDER BY id')
+    ecotypes = cur.fetchall()
+    cur.execute('SELECT id, name FROM stations ORDER BY id')
+    stations = {id: name for id, name in cur.fetchall()}
+    cur.execute('SELECT gene_id, length, ecotype_id FROM genes')
+    all_gene_lengths = pd.DataFrame(cur.fetchall(), columns=['gene_id', 'length', 'ecotype_id'])
+    cur.close()
+
+    runs = []
+    for ecotype_id, name in ecotypes:
+        run = {'name': name, 'id': ecotype_id}
+        run['gene_lengths'] = all_gene_lengths[all_gene_lengths.ecotype_id == ecotype_id] \
+            .drop(columns='ecotype_id').set_index('gene_id')
+        run['lengths'] = run['gene_lengths']['length'].to_numpy()
+        runs.append(run)
+
+    read_counts = rarefy.station_read_counts(con, [run['id'] for run in runs], clustered)
+    pools = rarefy.station_pools(stations, read_counts, rarefy.POOL_BYTES_PER_READ, memory_budget * 2 ** 20)
+
+    fetches = []
+    computes = []
+    for station_pool, pool, fetch_seconds, fetch_wait in rarefy.fetched_pools(
+        con, 'db', runs, pools, clustered, read_counts, 0
+    ):
+        gene_idx, read_lengths, counts, pool_ranges = pool
+        fetches.append({'stations': len(station_pool), 'reads': len(gene_idx), 'seconds': fetch_seconds})
+        for run in runs:
+            for station_id in station_pool:
+                start, end = pool_ranges.get((run['id'], station_id), (0, 0))
+                for sample_depth in depths:
+                    compute_start = time.perf_counter()
+                    coverage = rarefy.rarefy_station(
+                        gene_idx[start:end], read_lengths[start:end], run['lengths'], run['id'], station_id,
+                        sample_depth, replicates, seed
+                    )
+                    computes.append({
+                        'ecotype': run['name'],
+                        'station': stations[station_id],
+                        'depth': sample_depth,
+                        'reads': end - start,
+                        'skipped': coverage is None,
+                        'seconds': time.perf_counter() - compute_start,
+                    })
+        del gene_idx, read_lengths, pool
+    con.close()
+    return {'fetches': fetches, 'computes': computes}
+
+
+def rarefy_summary(timings, replicates):
+    # Totals of rarefy_all's timings, and the mean seconds per station / depth / replicate, overall and by depth
+    computed = [compute for compute in timings['computes'] if not compute['skipped']]
+    per_replicate = lambda computes: (
+        sum(compute['seconds'] for compute in computes) / (len(computes) * len(replicates)) if computes else 0)
+    return {
+        'pools': len(timings['fetches']),
+        'fetch_seconds': sum(fetch['seconds'] for fetch in timings['fetches']),
+        'compute_seconds': sum(compute['seconds'] for compute in timings['computes']),
+        'station_depths': len(timings['computes']),
+        'skipped': len(timings['computes']) - len(computed),
+        'seconds_per_replicate': per_replicate(computed),
+        'seconds_per_replicate_by_depth': {
+            str(sample_depth): per_replicate([compute for compute in computed if compute['depth'] == sample_depth])
+            for sample_depth in sorted({compute['depth'] for compute in timings['computes']})
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Generate a seeded synthetic dataset, then time the biopython table conversion, ingest and rarefaction of it,
+        recording the wall time and peak memory of each step as JSON.
+    ''')
+    parser.add_argument('--backend', choices=backend.BACKENDS, default='sqlite',
+            help='mysql: the database of MYSQL_DB, MYSQL_USER and MYSQL_PASS. '
+                 'sqlite (default) or duckdb: an embedded database in the benchmark directory')
+    parser.add_argument('--dir', default=BENCHMARK_DIR,
+            help='Directory for the dataset, logs, embedded database and results (default %s)' % BENCHMARK_DIR)
+    parser.add_argument('--reset', action='store_true',
+            help='With --backend mysql, delete all ecotypes, genes, stations and reads from the database first')
+    data = parser.add_argument_group(title='dataset')
+    data.add_argument('--stations', type=int, default=20, help='Number of stations (default 20)')
+    data.add_argument('--genes', type=int, default=200, help='Number of genes (default 200)')
+    data.add_argument('--ecotypes', type=int, default=2, help='Number of ecotypes (default 2)')
+    data.add_argument('--reads-per-station', type=int, default=10000,
+            help='Average number of reads per station (default 10000)')
+    data.add_argument('--seed', type=int, default=1, help='Seed of the dataset and of the rarefaction (default 1)')
+    steps = parser.add_argument_group(title='steps')
+    steps.add_argument('--fastas-to-tab', metavar='PATH',
+            help='Path of biopython/fastasToTab.py, to time it too. It is skipped if not given')
+    steps.add_argument('--fastas-workers', type=int, default=os.cpu_count(),
+            help='--workers of fastasToTab.py (default: number of CPUs)')
+    steps.add_argument('--method', choices=('insert', 'executemany', 'load'), default='load',
+            help='--method of populate.py (default load, which SQLite falls back from to executemany)')
+    steps.add_argument('--jobs', type=int, default=1, help='--jobs of populate.py (default 1)')
+    steps.add_argument('--batch-size', type=int, default=populate.BULK_BATCH_SIZE,
+            help='Rows per batch and commit (default %s)' % populate.BULK_BATCH_SIZE)
+    steps.add_argument('--depths', type=int, nargs='+', default=[1000, 5000], metavar='DEPTH',
+            help='Sample depths to rarefy at (default 1000 5000)')
+    steps.add_argument('--replicates', nargs='+', default=['01', '02', '03'], metavar='REPLICANT',
+            help='Replicates to rarefy (default 01 02 03)')
+    steps.add_argument('--memory-budget', type=int, default=rarefy.MEMORY_BUDGET, metavar='MIB',
+            help='--memory-budget of rarefy.py (default %s)' % rarefy.MEMORY_BUDGET)
+    parser.add_argument('--json', metavar='FILE',
+            help='Where to write the results (default: DIR/benchmark-TIMESTAMP.json)')
+    args = parser.parse_args()
+
+    startTime = dt.now()
+    os.makedirs(args.dir, exist_ok=True)
+    logPath = lambda step: os.path.join(args.dir, step + '.log')
+    results = {
+        'started': startTime.isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'arguments': vars(args),
+        'steps': {},
+    }
+
+    if args.backend == 'mysql':
+        os.environ['DB_BACKEND'] = 'mysql'
+        prepare_mysql(args.reset)
+    else:
+        prepare_embedded(args.backend, os.path.join(args.dir, 'benchmark.' + args.backend))
+
+    print('Generating dataset')
+    dataset, seconds, rss = run_isolated(
+        synthetic.generate, os.path.join(args.dir, 'data'), args.stations, args.genes, args.ecotypes,
+        args.reads_per_station, args.seed, args.fastas_to_tab is not None
+    )
+    results['dataset'] = dataset
+    results['steps']['generate'] = {'seconds': seconds, 'peak_rss_mib': rss}
+    print('%s reads of %s genes in %s stations' % (dataset['reads'], dataset['genes'], dataset['stations']))
+
+    if args.fastas_to_tab:
+        print('Converting fastas')
+        tablesDir = os.path.join(args.dir, 'tables')
+        os.makedirs(tablesDir, exist_ok=True)
+        seconds, rss = run_command([
+            sys.executable, os.path.abspath(args.fastas_to_tab), '--workers', str(args.fastas_workers),
+            dataset['fasta_dir'], tablesDir
+        ], logPath('fastas_to_tab'))
+        results['steps']['fastas_to_tab'] = {
+            'seconds': seconds, 'peak_rss_mib': rss, 'rows_per_second': dataset['reads'] / seconds}
+
+    print('Importing genes')
+    seconds, rss = run_command([
+        sys.executable, os.path.join(SRC_DIR, 'import-genes-ecotypes.py'), dataset['genes_file']
+    ], logPath('import_genes'))
+    results['steps']['import_genes'] = {'seconds': seconds, 'peak_rss_mib': rss}
+
+    print('Loading reads')
+    seconds, rss = run_command([
+        sys.executable, os.path.join(SRC_DIR, 'populate.py'), '--method', args.method, '--jobs', str(args.jobs),
+        '--batch-size', str(args.batch_size), dataset['table_file']
+    ], logPath('ingest'))
+    results['steps']['ingest'] = {
+        'seconds': seconds, 'peak_rss_mib': rss, 'rows_per_second': dataset['reads'] / seconds}
+
+    print('Rarefying')
+    timings, seconds, rss = run_isolated(rarefy_all, args.depths, args.replicates, args.seed, args.memory_budget)
+    results['steps']['rarefy'] = {'seconds': seconds, 'peak_rss_mib': rss, **rarefy_summary(timings, args.replicates)}
+    results['rarefy_timings'] = timings
+
+    print()
+    print('%-16s %12s %14s %16s' % ('', 'seconds', 'peak RSS MiB', 'rows/s'))
+    for step, result in results['steps'].items():
+        print('%-16s %12.2f %14.1f %16s' % (
+            step, result['seconds'], result['peak_rss_mib'],
+            '%.0f' % result['rows_per_second'] if 'rows_per_second' in result else ''))
+    print('rarefy: %.2f s fetching %s pools, %.2f s computing, %.6f s per station / depth / replicate' % (
+        results['steps']['rarefy']['fetch_seconds'], results['steps']['rarefy']['pools'],
+        results['steps']['rarefy']['compute_seconds'], results['steps']['rarefy']['seconds_per_replicate']))
+
+    jsonPath = args.json or os.path.join(args.dir, 'benchmark-%s.json' % startTime.strftime('%Y%m%d-%H%M%S'))
+    with open(jsonPath, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to %s' % jsonPath)
+
+
+if __name__ == '__main__':
+    main()
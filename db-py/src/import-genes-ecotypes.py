@@ -6,7 +6,7 @@
 # Insert that data into `ecotypes` and `genes` mysql tables.
 
 import argparse
-from mysql.connector import connect
+import backend
 import os, sys
 
 GENE_ID_COL = 0
@@ -15,6 +15,10 @@ ECOTYPE_COL = 2
 
 ECOTYPES_TABLE_NAME = 'ecotypes'
 GENES_TABLE_NAME = 'genes'
+GENES_COLUMNS = ('gene_id', 'length', 'ecotype_id')
+
+# Genes per parameterized INSERT / upsert statement
+BATCH_SIZE = 10000
 
 def load_ecotypes(con):
     cur = con.cursor()
@@ -25,20 +29,32 @@ def load_ecotypes(con):
 
 
 def load_genes(con):
+    # Set of gene_ids, so each record is checked against it in constant time
     cur = con.cursor()
     cur.execute('SELECT gene_id FROM %s' % GENES_TABLE_NAME)
-    genes = [ int(gene[0]) for gene in cur.fetchall() ]
+    genes = { int(gene[0]) for gene in cur.fetchall() }
     cur.close()
     return genes
 
 
 def insert_ecotype(con, ecotype):
+    # Look the id up after inserting, as not every backend reports lastrowid
     cur = con.cursor()
-    cur.execute('INSERT INTO `%s` (name) VALUES (\'%s\')' % (ECOTYPES_TABLE_NAME, ecotype))
-    id = cur.lastrowid
+    cur.execute('INSERT INTO %s (name) VALUES (%%s)' % ECOTYPES_TABLE_NAME, (ecotype,))
     con.commit()
+    cur.execute('SELECT id FROM %s WHERE name = %%s' % ECOTYPES_TABLE_NAME, (ecotype,))
+    (id,) = cur.fetchone()
+    cur.close()
+    return int(id)
+
+
+def write_genes(con, rows, update=False):
+    # INSERT (or, if update, upsert) (gene_id, length, ecotype_id) rows, BATCH_SIZE rows per statement
+    cur = con.cursor()
+    suffix = backend.upsert(con, 'gene_id', GENES_COLUMNS[1:]) if update else ''
+    for start in range(0, len(rows), BATCH_SIZE):
+        backend.insert_many(con, cur, GENES_TABLE_NAME, GENES_COLUMNS, rows[start:start + BATCH_SIZE], suffix=suffix)
     cur.close()
-    return id
 
 
 def main():
@@ -64,27 +80,22 @@ def main():
     if not (os.access(filename, os.R_OK)):
         exit('Problem with input file %s. Ensure it exists and is readable.' % filename)
 
-    # Connect to MySQL DB
-    con = connect(
-        database=os.getenv('MYSQL_DB'),
-        user=os.getenv('MYSQL_USER'),
-        password=os.getenv('MYSQL_PASS'),
-        )
-    cur = con.cursor()
+    # Connect to the DB (see backend.py)
+    con = backend.connect_db()
 
     # Fetch ecotypes as {name: id,} from DB
     sys.stdout.write('Loading ecotypes: ')
     ecotypes = load_ecotypes(con) # name: id
     sys.stdout.write('%s ecotypes currently exist in the DB.\n' % len(ecotypes.keys()))
 
-    # Fetch genes as (gene_id,) from DB
+    # Fetch genes as {gene_id,} from DB
     sys.stdout.write('Loading genes: ')
     genes = load_genes(con)
     sys.stdout.write('%s genes currently exist in the DB.\n' % len(genes))
 
-    # entries formatted for insertion to db
-    sql_insert_values = []
-    sql_update_values = []
+    # (gene_id, length, ecotype_id) rows for insertion to db
+    insert_rows = []
+    update_rows = []
     # keep track of a unique list of genes found in records
     genes_found_in_file = {}
     warn_flag = 0
@@ -111,11 +122,11 @@ def main():
             if (record['gene_id'] not in genes):
 
                 # Three Columns:
-                sql_insert_values.append('(%s, %s, %s)' % (record['gene_id'], record['length'], ecotypeId))
+                insert_rows.append((record['gene_id'], record['length'], ecotypeId))
 
             # Current record matches an existing entry. If force_update is set, add to UPDATE list.
             elif (force_update):
-                sql_update_values.append('(%s, %s, %s)' % (record['gene_id'], record['length'], ecotypeId))
+                update_rows.append((record['gene_id'], record['length'], ecotypeId))
 
         # This gene_id exists elsewhere in the file
         else:
@@ -126,35 +137,24 @@ def main():
         duplicate_genes = [k for (k, v) in genes_found_in_file.items() if v > 1]
         print("WARNING: %s duplicate `gene_id`s found in %s." % (len(duplicate_genes), filename))
 
-    print('%s records to be inserted in the DB.' % len(sql_insert_values))
+    print('%s records to be inserted in the DB.' % len(insert_rows))
     if (force_update):
-        print('%s records to be updated in the DB.' % len(sql_update_values))
+        print('%s records to be updated in the DB.' % len(update_rows))
 
-    if (len(sql_insert_values) == 0 and len(sql_update_values) == 0):
+    if (len(insert_rows) == 0 and len(update_rows) == 0):
         print('Nothing to be done!')
         exit()
 
-    if (len(sql_insert_values)):
+    # All batches are committed together
+    if (len(insert_rows)):
         print("Inserting.")
-        insert_sql = """
-            INSERT INTO """ + GENES_TABLE_NAME + """
-                (gene_id, length, ecotype_id)
-                VALUES
-            """ + ', '.join(sql_insert_values)
-        cur.execute(insert_sql)
-
-    if (force_update and len(sql_update_values)):
+        write_genes(con, insert_rows)
+
+    if (force_update and len(update_rows)):
         print("Updating.")
-        update_sql = """
-            INSERT INTO """ + GENES_TABLE_NAME + """
-            (gene_id, length, ecotype_id)
-            VALUES
-        """ + ', '.join(sql_update_values) + """
-        ON DUPLICATE KEY UPDATE length=VALUES(length), ecotype_id=VALUES(ecotype_id)
-        """
-        cur.execute(update_sql)
+        write_genes(con, update_rows, update=True)
     con.commit()
-    cur.close()
+    con.close()
     print('Done.')
 
 
@@ -2,39 +2,60 @@
 
 # Map and insert ecotypes to the db, given a tsv with genotype, ecotype columns.
 # Assume contigs' name up to its first '_' is the genotype.
-# NOTE: This assumes that no ecotypes have been inserted into the db yet.
+# Ecotypes not yet in the db are inserted. The contigs are then updated in one statement, from a temporary
+# contig_id -> ecotype_id table filled in batches.
 
-from mysql.connector import connect
-import os, sys
+import backend
+import sys
 
 if len(sys.argv) !=2:
     exit('Usage: map-ecotypes-to-contigs.py INPUT.tsv')
 
 filename = sys.argv[1]
 
-def insert_ecotype(con, ecotype):
+# Rows per parameterized INSERT statement
+BATCH_SIZE = 10000
+
+def load_ecotypes(con):
     cur = con.cursor()
-    cur.execute('INSERT INTO ecotypes (name) VALUE (%s)', (ecotype,))
-    id = cur.lastrowid
+    cur.execute('SELECT id, name FROM ecotypes')
+    ecotypes = {name: int(id) for id, name in cur.fetchall()}
+    cur.close()
+
+    return ecotypes
+
+
+def insert_ecotypes(con, names):
+    # Insert ecotypes by name, and return all ecotypes as {name: id}, as not every backend reports lastrowid
+    cur = con.cursor()
+    backend.insert_many(con, cur, 'ecotypes', ('name',), [(name,) for name in names])
     con.commit()
     cur.close()
 
-    return id
+    return load_ecotypes(con)
 
 
-def update_contig(con, contigId, ecotypeId):
+def update_contigs(con, contigEcotypes):
+    # Set contigs' ecotype_id from [(contig_id, ecotype_id)] with one UPDATE joined to a temporary mapping table.
+    # The table lives on one cursor's connection, so every statement goes through it.
     cur = con.cursor()
-    cur.execute('UPDATE contigs SET ecotype_id = %s WHERE id = %s' % (ecotypeId, contigId))
+    cur.execute('DROP TABLE IF EXISTS contig_ecotypes')
+    cur.execute('CREATE TEMPORARY TABLE contig_ecotypes (contig_id INTEGER PRIMARY KEY, ecotype_id INTEGER NOT NULL)')
+    for start in range(0, len(contigEcotypes), BATCH_SIZE):
+        backend.insert_many(
+            con, cur, 'contig_ecotypes', ('contig_id', 'ecotype_id'), contigEcotypes[start:start + BATCH_SIZE]
+        )
+    cur.execute(backend.update_from_sql(con, 'contigs', 'id', 'contig_ecotypes', 'contig_id', ('ecotype_id',)))
+    updated = cur.rowcount
+    cur.execute('DROP TABLE contig_ecotypes')
     con.commit()
     cur.close()
 
+    return updated
+
 
-# Connect to MySQL DB
-con = connect(
-    database=os.getenv('MYSQL_DB'),
-    user=os.getenv('MYSQL_USER'),
-    password=os.getenv('MYSQL_PASS'),
-)
+# Connect to the DB (see backend.py)
+con = backend.connect_db()
 cur = con.cursor()
 
 # Process .tsv file
@@ -46,20 +67,32 @@ for line in open(filename, 'r'):
     # key: genotype, value: ecotype
     ecotypeGenotypeDict[record[0]] = record[1]
 
-# SELECT Contigs, execute UPDATEs / INSERTs
-insertedEcotypes = {} # name => id
+# SELECT Contigs, map them to ecotypes in memory
 sys.stdout.write('Loading Contigs: ')
 cur.execute('SELECT id, name FROM contigs')
-for contigId, contigName in cur.fetchall():
-    genotype = contigName.split('_')[0]
-    if genotype in ecotypeGenotypeDict:
-        ecotype = ecotypeGenotypeDict[genotype]
-        if ecotype not in insertedEcotypes: # Ecotype not yet in db
-            ecoId = insert_ecotype(con, ecotype)
-            insertedEcotypes[ecotype] = ecoId
-        else: # Ecotype already in db
-            ecoId = insertedEcotypes[ecotype]
-        update_contig(con, contigId, ecoId)
-    else:
-        print(genotype+' not in record dictionary')
+contigs = cur.fetchall()
+cur.close()
+print('%s contigs' % len(contigs))
+
+contigGenotypes = [(int(contigId), contigName.split('_')[0]) for contigId, contigName in contigs]
+for genotype in sorted({genotype for contigId, genotype in contigGenotypes} - set(ecotypeGenotypeDict)):
+    print(genotype+' not in record dictionary')
+
+# INSERT the ecotypes of mapped contigs that aren't in the db yet
+ecotypes = load_ecotypes(con) # name => id
+newEcotypes = sorted({
+    ecotypeGenotypeDict[genotype] for contigId, genotype in contigGenotypes if genotype in ecotypeGenotypeDict
+} - set(ecotypes))
+if newEcotypes:
+    print('Inserting %s ecotypes' % len(newEcotypes))
+    ecotypes = insert_ecotypes(con, newEcotypes)
 
+# UPDATE all mapped contigs at once
+contigEcotypes = [
+    (contigId, ecotypes[ecotypeGenotypeDict[genotype]])
+    for contigId, genotype in contigGenotypes if genotype in ecotypeGenotypeDict
+]
+print('Updating %s contigs' % len(contigEcotypes))
+updated = update_contigs(con, contigEcotypes)
+print('%s contigs changed' % updated)
+con.close()
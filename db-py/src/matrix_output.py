@@ -0,0 +1,99 @@
+# matrix_output.py
+#
+# Output layer for rarefy.py coverage matrices.
+#
+# While rarefy.py runs, each depth's coverage is staged in a memory-mapped (station, replicate, gene) float64 .npy
+# file in the output directory, so each station's results go to disk as soon as they are computed, and the
+# matrices never have to fit in memory. Once all stations are done, the staged matrices are written in the
+# requested format, a chunk of genes at a time, and the staging file is removed.
+#
+# Formats:
+#   tsv, tsv.gz, parquet    one gene x station matrix per depth and replicate: ECOTYPE_DEPTH_REPLICATE.FORMAT
+#   npz                     one file per depth: ECOTYPE_DEPTH.npz, holding `coverage`, a stacked
+#                           (replicate, gene, station) array, along with `gene_ids`, `stations` and `replicates`
+
+import gzip
+import numpy as np
+import os
+import pandas as pd
+from pathvalidate import (sanitize_filename as sfn, sanitize_filepath as sfp)
+
+FORMATS = ('tsv', 'tsv.gz', 'parquet', 'npz')
+
+# Coverage is staged in float64: float32 can't hold the 4 decimals of values of 1000 or more, which the tsv matrices
+# are written with. npz output is stored as float32, to keep it compact.
+STAGING_DTYPE = np.float64
+
+# Genes written per chunk of a tsv matrix
+WRITE_CHUNK_ROWS = 2000
+
+
+def check_format(fmt):
+    # Exit early, rather than after all the rarefying, if the format's optional dependency isn't installed
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            exit('--format parquet requires pyarrow. Install it with `pip install pyarrow`.')
+
+
+def output_file_name(output_dir, ecotype, sample_depth, replicate, fmt):
+    name = sfn(ecotype) + '_' + str(sample_depth)
+    if replicate is not None:
+        name += '_' + sfn(replicate)
+    return sfp(output_dir + '/' + name + '.' + fmt)
+
+
+def staging_file_name(output_dir, ecotype, sample_depth):
+    return sfp(output_dir + '/.' + sfn(ecotype) + '_' + str(sample_depth) + '.staging.npy')
+
+
+def open_staging(output_dir, ecotype, sample_depth, n_stations, n_replicates, n_genes):
+    # Zero-filled (station, replicate, gene) array on disk; one station's coverage is a contiguous block
+    shape = (n_stations, n_replicates, n_genes)
+    filename = staging_file_name(output_dir, ecotype, sample_depth)
+    if 0 in shape:
+        return np.zeros(shape, dtype=STAGING_DTYPE)
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=STAGING_DTYPE, shape=shape)
+
+
+def remove_staging(output_dir, ecotype, sample_depth):
+    filename = staging_file_name(output_dir, ecotype, sample_depth)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def write_tsv(f, staging, replicate_index, gene_index, station_names):
+    for start in range(0, max(len(gene_index), 1), WRITE_CHUNK_ROWS):
+        pd.DataFrame(
+            staging[:, replicate_index, start:start + WRITE_CHUNK_ROWS].T,
+            index=gene_index[start:start + WRITE_CHUNK_ROWS],
+            columns=station_names,
+        ).to_csv(f, sep='\t', header=(start == 0))
+
+
+def write_matrices(staging, output_dir, ecotype, sample_depth, replicates, gene_index, station_names, fmt):
+    # Write one depth's staged (station, replicate, gene) coverage in the given format
+    if fmt == 'npz':
+        file_out_name = output_file_name(output_dir, ecotype, sample_depth, None, fmt)
+        print('Writing to file: ' + file_out_name)
+        np.savez_compressed(
+            file_out_name,
+            coverage=staging.transpose(1, 2, 0).astype(np.float32),
+            gene_ids=gene_index.to_numpy(),
+            stations=np.array(station_names),
+            replicates=np.array(replicates),
+        )
+        return
+
+    for i, replicate in enumerate(replicates):
+        file_out_name = output_file_name(output_dir, ecotype, sample_depth, replicate, fmt)
+        print('Writing to file: ' + file_out_name)
+        if fmt == 'parquet':
+            pd.DataFrame(staging[:, i, :].T, index=gene_index, columns=station_names).to_parquet(file_out_name)
+        elif fmt == 'tsv.gz':
+            with gzip.open(file_out_name, 'wt') as file_out:
+                write_tsv(file_out, staging, i, gene_index, station_names)
+        else:
+            with open(file_out_name, 'w') as file_out:
+                write_tsv(file_out, staging, i, gene_index, station_names)
@@ -0,0 +1,141 @@
+# metrics.py
+#
+# Per-phase timers and counters of a run of rarefy.py or populate.py (--metrics FILE), and an optional profile of
+# the whole run (--profile).
+#
+# A FILE ending in .prom is (re)written at the end of the run in the Prometheus text format, e.g. for the
+# node_exporter textfile collector:
+#   rarefy_phase_seconds{phase="fetch"} 12.5
+#   rarefy_rows_fetched_total 1234567
+# Any other FILE gets JSON lines appended: `event` lines as the run goes (e.g. one per station and depth computed),
+# then one `run` line with every phase, counter and gauge. All lines of a run share its `run` start time.
+#
+# Peak RSS is that of the script's own process, and separately of its largest child (worker) process.
+#
+# --profile runs the script under cProfile and tracemalloc, and writes SCRIPT-TIMESTAMP.prof (load it with
+# `python -m pstats` or snakeviz) and SCRIPT-TIMESTAMP.tracemalloc.txt (the top allocation sites by size, and the
+# peak traced memory). Only the main process is profiled, not worker processes.
+
+import cProfile
+import contextlib
+from datetime import datetime as dt
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+# Allocation sites listed in a --profile tracemalloc report
+TRACEMALLOC_TOP = 25
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+class Metrics:
+    # Timers and counters of one run of a script. With no path, everything is still counted, but nothing is written.
+
+    def __init__(self, script, path=None):
+        self.script = script
+        self.path = path
+        self.prometheus = path is not None and path.endswith('.prom')
+        self.run = dt.now().isoformat(timespec='seconds')
+        self.start = time.monotonic()
+        self.phases = {}  # phase: seconds
+        self.counters = {}  # name: value
+        self.gauges = {}  # name: value, for rates and other values that aren't summed
+        self.file = open(path, 'a') if path is not None and not self.prometheus else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def event(self, event, **fields):
+        # One JSON line, written straight away so a long run can be followed. Ignored by the Prometheus format.
+        if self.file is not None:
+            self.file.write(json.dumps({'script': self.script, 'run': self.run, 'event': event, **fields}) + '\n')
+            self.file.flush()
+
+    def summary(self):
+        return {
+            'seconds': time.monotonic() - self.start,
+            'phases': self.phases,
+            'counters': self.counters,
+            'gauges': self.gauges,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'peak_child_rss_bytes': peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        }
+
+    def close(self):
+        summary = self.summary()
+        if self.file is not None:
+            self.event('run', **summary)
+            self.file.close()
+        elif self.prometheus:
+            write_prometheus(self.path, self.script, summary)
+
+
+def write_prometheus(path, script, summary):
+    # Written to a temporary file and renamed, so a collector never reads a partial file
+    lines = [
+        '# TYPE %s_seconds gauge' % script,
+        '%s_seconds %s' % (script, summary['seconds']),
+        '# TYPE %s_phase_seconds gauge' % script,
+    ]
+    lines += ['%s_phase_seconds{phase="%s"} %s' % (script, phase, seconds)
+              for phase, seconds in sorted(summary['phases'].items())]
+    for name, value in sorted(summary['counters'].items()):
+        lines += ['# TYPE %s_%s_total counter' % (script, name), '%s_%s_total %s' % (script, name, value)]
+    for name, value in sorted(summary['gauges'].items()):
+        lines += ['# TYPE %s_%s gauge' % (script, name), '%s_%s %s' % (script, name, value)]
+    lines += [
+        '# TYPE %s_peak_rss_bytes gauge' % script,
+        '%s_peak_rss_bytes %s' % (script, summary['peak_rss_bytes']),
+        '# TYPE %s_peak_child_rss_bytes gauge' % script,
+        '%s_peak_child_rss_bytes %s' % (script, summary['peak_child_rss_bytes']),
+    ]
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+@contextlib.contextmanager
+def profile(enabled, output_dir, script):
+    # Run the body under cProfile and tracemalloc if enabled, and dump both reports to output_dir
+    if not enabled:
+        yield
+        return
+
+    name = os.path.join(output_dir, '%s-%s' % (script, dt.now().strftime('%Y%m%d-%H%M%S')))
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(name + '.prof')
+        with open(name + '.tracemalloc.txt', 'w') as f:
+            f.write('Traced memory: %.1f MiB at the end, %.1f MiB at peak\n\n' % (current / 2 ** 20, peak / 2 ** 20))
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                f.write('%s\n' % stat)
+        print('Profile written to %s.prof and %s.tracemalloc.txt' % (name, name))
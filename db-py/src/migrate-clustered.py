@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# migrate-clustered.py
+# Converts an existing gene_reads table to the clustered layout of db-init/sql/create-tables-clustered.sql.
+#
+# Reads are copied into gene_reads_clustered one station at a time, in primary key order, with each read's
+# ecotype_id taken from genes. Reads of genes that aren't in the genes table are left behind. Once every station
+# is copied, the tables are swapped in one RENAME: the old table is kept as gene_reads_unclustered unless
+# --drop-old is given.
+#
+# Each station is copied in its own transaction, and stations already in gene_reads_clustered are skipped, so an
+# interrupted migration can be run again to finish it. Don't load reads while migrating.
+
+import argparse
+from mysql.connector import connect
+import os
+import schema
+import sys
+import time
+
+CLUSTERED_TABLE = 'gene_reads_clustered'
+OLD_TABLE = 'gene_reads_unclustered'
+
+
+def count_rows(con, table):
+    cur = con.cursor()
+    cur.execute('SELECT COUNT(*) FROM `%s`' % table)
+    (count,) = cur.fetchone()
+    cur.close()
+    return count
+
+
+def copied_stations(con):
+    # Stations with reads in the clustered table, read off the primary key
+    cur = con.cursor()
+    cur.execute('SELECT DISTINCT ecotype_id, station_id FROM `%s`' % CLUSTERED_TABLE)
+    stations = {station_id for ecotype_id, station_id in cur.fetchall()}
+    cur.close()
+    return stations
+
+
+def copy_station(con, station_id):
+    cur = con.cursor()
+    cur.execute('''
+        INSERT INTO `%s` (ecotype_id, station_id, gene_id, read_number, contig_id, read_length, gc_content)
+        SELECT g.ecotype_id, gr.station_id, gr.gene_id, gr.read_number, gr.contig_id, gr.read_length, gr.gc_content
+        FROM gene_reads gr
+        JOIN genes g ON g.gene_id = gr.gene_id
+        WHERE gr.station_id = %%s
+        ORDER BY g.ecotype_id, gr.gene_id, gr.read_number
+        ''' % CLUSTERED_TABLE, (station_id,))
+    copied = cur.rowcount
+    con.commit()
+    cur.close()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Convert gene_reads to the clustered layout: ecotype_id stored with each read, clustered on
+        (ecotype_id, station_id, gene_id, read_number) and partitioned by ecotype.
+    ''')
+    parser.add_argument('--drop-old', action='store_true',
+            help='Drop the old table once the new one is in place, instead of keeping it as %s' % OLD_TABLE)
+    args = parser.parse_args()
+
+    # Connect to MySQL DB
+    con = connect(
+        database=os.getenv('MYSQL_DB'),
+        user=os.getenv('MYSQL_USER'),
+        password=os.getenv('MYSQL_PASS'),
+    )
+    if schema.is_clustered(con):
+        exit('gene_reads already has the clustered layout.')
+
+    cur = con.cursor()
+    cur.execute('SELECT MAX(read_length) FROM gene_reads')
+    (maxLength,) = cur.fetchone()
+    if maxLength is not None and maxLength > 65535:
+        exit('Reads of up to %s bp are longer than the clustered layout\'s SMALLINT read_length allows.' % maxLength)
+
+    cur.execute(schema.CLUSTERED_GENE_READS_DDL % CLUSTERED_TABLE)
+    cur.execute('SELECT DISTINCT station_id FROM gene_reads')
+    stations = sorted(station_id for (station_id,) in cur.fetchall())
+    cur.close()
+
+    done = copied_stations(con)
+    todo = [station_id for station_id in stations if station_id not in done]
+    print('%s stations, %s already copied' % (len(stations), len(stations) - len(todo)))
+
+    startTime = time.monotonic()
+    for i, station_id in enumerate(todo):
+        copied = copy_station(con, station_id)
+        print('[T+%8d s] station %s: %s reads (%s/%s)' % (
+            time.monotonic() - startTime, station_id, copied, i + 1, len(todo)))
+
+    oldCount = count_rows(con, 'gene_reads')
+    newCount = count_rows(con, CLUSTERED_TABLE)
+    print('%s reads in gene_reads, %s copied' % (oldCount, newCount))
+    if newCount != oldCount:
+        sys.stderr.write('%s reads of genes missing from the genes table were not copied.\n' % (oldCount - newCount))
+
+    cur = con.cursor()
+    cur.execute('RENAME TABLE gene_reads TO `%s`, `%s` TO gene_reads' % (OLD_TABLE, CLUSTERED_TABLE))
+    print('gene_reads now has the clustered layout')
+    if args.drop_old:
+        cur.execute('DROP TABLE `%s`' % OLD_TABLE)
+        print('Dropped the old table')
+    else:
+        print('The old table was kept as %s' % OLD_TABLE)
+    cur.close()
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
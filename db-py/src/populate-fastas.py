@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# populate-fastas.py
+# Populates gene_reads straight from the anvio output fastas (one GENE_ID.fa per gene), without writing and
+# re-reading the biopython .tsv in between.
+#
+# The work is split into three stages, connected by bounded queues so no stage can run ahead of the others
+# by more than a few batches:
+#   parse       PARSERS processes read fasta files and compute the read length and GC content of each read
+#   transform   resolves station names to ids through an in-memory cache, inserting each batch's new stations at once
+#   load        WRITERS threads, each with its own connection, bulk insert batches into gene_reads
+#
+# Rows are the same as populate.py would insert from the biopython .tsv of the same fastas.
+# NOTE: does not insert genes or ecotypes as needed. Use import-genes-ecotypes.py first for that.
+
+import argparse
+import backend
+import multiprocessing
+import os, sys
+import queue
+import tempfile
+import threading
+import time
+
+import populate
+import schema
+
+# Batches waiting between stages
+QUEUE_BATCHES = 8
+
+GC_BASES = (b'G', b'C', b'g', b'c', b'S', b's')
+
+
+def gc_content(seq):
+    # Same as Bio.SeqUtils.GC, which the biopython step uses
+    if not seq:
+        return 0.0
+    return sum(seq.count(base) for base in GC_BASES) * 100.0 / len(seq)
+
+
+def fasta_records(f):
+    # (header, sequence) of each record of a binary fasta file, read the way Bio.SeqIO does
+    header = None
+    lines = []
+    for line in f:
+        if line.startswith(b'>'):
+            if header is not None:
+                yield header, b''.join(lines).replace(b' ', b'').replace(b'\r', b'')
+            header = line[1:].rstrip().decode()
+            lines = []
+        elif header is not None:
+            lines.append(line.rstrip())
+    if header is not None:
+        yield header, b''.join(lines).replace(b' ', b'').replace(b'\r', b'')
+
+
+def fasta_reads(filename):
+    # (gene_id, read_number, station, read_length, gc_content) of each read in an anvio GENE_ID.fa file.
+    # Headers look like 00000001|sample_id:STATION|reverse:False|contig_name:CONTIG
+    geneId = int(os.path.basename(filename).replace('.fa', ''))
+    with open(filename, 'rb') as f:
+        for header, seq in fasta_records(f):
+            fields = header.split('|')
+            station = fields[1].replace('sample_id:', '')
+            yield (geneId, int(fields[0]), station, len(seq), gc_content(seq))
+
+
+def parse_worker(files, parsed, batchSize):
+    # Parse stage: put batches of reads from the files in the queue, then None when done. None is sent even if a
+    # file can't be parsed, so the transform stage doesn't wait forever; the worker then exits non-zero.
+    batch = []
+    filename = None
+    try:
+        while True:
+            filename = files.get()
+            if filename is None:
+                break
+            for read in fasta_reads(filename):
+                batch.append(read)
+                if len(batch) == batchSize:
+                    parsed.put(batch)
+                    batch = []
+        if batch:
+            parsed.put(batch)
+    except Exception as e:
+        sys.stderr.write('Failed to parse %s: %s\n' % (filename, e))
+        sys.exit(1)
+    finally:
+        parsed.put(None)
+
+
+def transform(con, stations, batch, genes=None):
+    # Transform stage: the gene_read rows of a parsed batch, sorted by the unique key like populate.py's batches.
+    # If genes ({gene_id: ecotype_id}) is given, the rows are for the clustered layout and unknown genes are dropped.
+    # New stations of the batch are inserted together, and only their ids are looked up
+    newStations = {station for geneId, readNumber, station, readLength, gcContent in batch} - set(stations)
+    if newStations:
+        stations.update(populate.resolve_stations(con, newStations))
+
+    rows = []
+    for geneId, readNumber, station, readLength, gcContent in batch:
+        # gc_content can't be 100 in db
+        if gcContent == 100:
+            gcContent = '99.9'
+        if genes is None:
+            rows.append((geneId, readNumber, stations[station], readLength, gcContent))
+        elif geneId in genes:
+            rows.append((genes[geneId], stations[station], geneId, readNumber, readLength, gcContent))
+    rows.sort()
+    return rows
+
+
+def load_worker(method, loaded, counters, failures):
+    # Load stage: insert batches from the queue until None. After a failure the rest of the queue is
+    # drained without inserting, so the earlier stages don't block on a full queue.
+    con = None
+    tmpFile = None
+    try:
+        con = populate.connect_db(method)
+        if method == 'load':
+            tmpFile = tempfile.NamedTemporaryFile('w', prefix='gene_reads_', suffix='.tsv')
+        while True:
+            rows = loaded.get()
+            if rows is None:
+                break
+            inserted = populate.insert_batch(con, method, rows, tmpFile)
+            with counters['lock']:
+                counters['rows'] += len(rows)
+                counters['inserted'] += inserted
+    except Exception as e:
+        failures.append(e)
+        while loaded.get() is not None:
+            pass
+    finally:
+        if tmpFile is not None:
+            tmpFile.close()
+        if con is not None:
+            con.close()
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='''
+        Populate the gene_reads table directly from the anvio output fastas.
+        Stations are inserted as they are found.
+    ''')
+    parser.add_argument('fasta_dir', metavar='FASTA_DIR',
+            help='Directory of anvio output fastas, named GENE_ID.fa')
+    parser.add_argument('--method', choices=('executemany', 'load'), default='load',
+            help='executemany: parameterized INSERT IGNORE batches. '
+                 'load: LOAD DATA LOCAL INFILE batches (requires local_infile on the server, default).')
+    parser.add_argument('--batch-size', type=int, default=populate.BULK_BATCH_SIZE,
+            help='Rows per batch and commit (default %s)' % populate.BULK_BATCH_SIZE)
+    parser.add_argument('--parsers', type=int, default=os.cpu_count(),
+            help='Processes parsing fasta files (default: number of CPUs)')
+    parser.add_argument('--writers', type=int, default=2,
+            help='Writer connections inserting batches (default 2)')
+    parser.add_argument('--defer-indexes', action='store_true',
+            help='Drop the non-unique gene_reads indexes and their foreign keys during the load, and rebuild '
+                 'them afterwards. Do not use while other loaders are running.')
+
+    args = parser.parse_args()
+
+    # Writers can't share one line of progress dots; aggregated progress is printed instead
+    populate.PROGRESS = 0
+
+    filenames = [
+        os.path.join(args.fasta_dir, name) for name in sorted(os.listdir(args.fasta_dir))
+        if name.endswith('.fa') and not name.startswith('.')
+    ]
+    if not filenames:
+        exit('No .fa files found in %s' % args.fasta_dir)
+
+    # Connect to the DB (see backend.py)
+    con = populate.connect_db(args.method)
+    if args.method == 'load' and backend.dialect(con) not in backend.LOAD_BACKENDS:
+        print('%s can\'t load files, using --method executemany' % backend.dialect(con))
+        args.method = 'executemany'
+    if args.writers > 1 and backend.dialect(con) != 'mysql':
+        print('%s has a single writer, using --writers 1' % backend.dialect(con))
+        args.writers = 1
+
+    # Load existing Stations into memory
+    sys.stdout.write('Loading Stations: ')
+    stations = populate.load_stations(con)
+    print("%s initial stations" % len(stations))
+    genes = populate.load_genes(con) if schema.is_clustered(con) else None
+
+    if args.defer_indexes and genes is not None:
+        print('gene_reads has the clustered layout, which has no secondary indexes to defer')
+        args.defer_indexes = False
+    if args.defer_indexes and backend.dialect(con) != 'mysql':
+        print('--defer-indexes only applies to MySQL')
+        args.defer_indexes = False
+    if args.defer_indexes:
+        print('Dropping secondary indexes')
+        populate.drop_secondary_indexes(con)
+
+    # Parse stage
+    files = multiprocessing.Queue()
+    for filename in filenames:
+        files.put(filename)
+    for i in range(args.parsers):
+        files.put(None)
+    parsed = multiprocessing.Queue(QUEUE_BATCHES)
+    parsers = [
+        multiprocessing.Process(target=parse_worker, args=(files, parsed, args.batch_size))
+        for i in range(args.parsers)
+    ]
+
+    # Load stage
+    loaded = queue.Queue(QUEUE_BATCHES)
+    counters = {'lock': threading.Lock(), 'rows': 0, 'inserted': 0}
+    failures = []
+    writers = [
+        threading.Thread(target=load_worker, args=(args.method, loaded, counters, failures))
+        for i in range(args.writers)
+    ]
+
+    print('Processing %s fasta files with %s parsers and %s writers' % (len(filenames), args.parsers, args.writers))
+    startTime = time.monotonic()
+    lastProgress = startTime
+    for worker in parsers + writers:
+        worker.start()
+
+    # Transform stage, until every parser is done
+    try:
+        running = len(parsers)
+        while running:
+            try:
+                batch = parsed.get(timeout=populate.PROGRESS_INTERVAL)
+            except queue.Empty:
+                # A parser killed outright (e.g. out of memory) never sends its None
+                if not any(worker.is_alive() for worker in parsers):
+                    break
+                continue
+            if batch is None:
+                running -= 1
+                continue
+            loaded.put(transform(con, stations, batch, genes))
+
+            if time.monotonic() - lastProgress >= populate.PROGRESS_INTERVAL:
+                lastProgress = time.monotonic()
+                elapsed = lastProgress - startTime
+                print('[T+%8d s] %s rows read, %s inserted (%.0f rows/s)' % (
+                    elapsed, counters['rows'], counters['inserted'], counters['rows'] / elapsed))
+    except BaseException:
+        # Parsers may be blocked on a full queue that nothing reads any more
+        for worker in parsers:
+            worker.terminate()
+        raise
+    finally:
+        for writer in writers:
+            loaded.put(None)
+        for worker in parsers + writers:
+            worker.join()
+        if args.defer_indexes:
+            print('Rebuilding secondary indexes')
+            populate.restore_secondary_indexes(con)
+
+    elapsed = time.monotonic() - startTime
+    print('%s rows read, %s inserted in %.1f s (%.0f rows/s)' % (
+        counters['rows'], counters['inserted'], elapsed, counters['rows'] / elapsed if elapsed else 0))
+    con.close()
+
+    failedParsers = [worker for worker in parsers if worker.exitcode != 0]
+    if failedParsers:
+        exit('%s of %s parsers failed, so not every fasta file was loaded. Fix or remove the files reported above '
+             'and run again.' % (len(failedParsers), len(parsers)))
+    if failures:
+        exit('%s of %s writers failed: %s' % (len(failures), len(writers), failures[0]))
+
+
+if __name__ == "__main__":
+    main()
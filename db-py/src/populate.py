@@ -3,64 +3,291 @@
 # populate.py
 # Connects to existing gene_reads database and inserts entries based on the data contained in
 # an input.tsv file given as a commandline argument.
-# Checks for presence of stations as it goes and inserts them as needed.
+# Collects the input's distinct stations first, and inserts the new ones in one batch.
 # NOTE: does not insert genes or ecotypes as needed. Use import-genes-ecotypes.py first for that.
 
-from mysql.connector import connect, errors as mysqlErrors
+import argparse
+import backend
+import multiprocessing
+import multiprocessing.connection
+import metrics
+from mysql.connector import errors as mysqlErrors
 import os, sys
+import random
+import schema
+import tempfile
+import time
 
 POOL_SIZE = 50
 
+# Default number of rows per batch (and per commit) for the bulk load methods
+BULK_BATCH_SIZE = 50000
+
 # Establish order of table columns
 GENE_READNUM_COL = 0
 STATION_COL      = 1
 READ_LEN_COL     = 4
 GC_COL           = 5
 
+# Station names per SELECT when looking up the ids of new stations
+STATION_BATCH_SIZE = 1000
+
 # Print '.' or '+' for each Pool, depending on whether at least one row was inserted.
 PROGRESS = 1
 
+# Seconds between aggregated progress lines when running several writers (--jobs)
+PROGRESS_INTERVAL = 10
 
-def deadlock_safe_execute(cur, sql):
-    try:
-        cur.execute(sql)
-    except mysqlErrors.InternalError as e:
-        if e.errno == 1213:
-            deadlock_safe_execute(cur, sql)
+# Deadlocked statements are retried up to DEADLOCK_RETRIES times, backing off exponentially up to
+# DEADLOCK_BACKOFF_MAX seconds between attempts.
+DEADLOCK_RETRIES = 10
+DEADLOCK_BACKOFF = 0.05
+DEADLOCK_BACKOFF_MAX = 5
+
+# Non-unique secondary indexes of gene_reads, and the foreign keys that depend on them, as (index, fk, column, ref)
+# The unique (gene_id, read_number, station_id) index is always kept, since INSERT IGNORE relies on it.
+DEFERRABLE_INDEXES = (
+    ('gene_reads_stations_fk_idx', 'gene_reads_stations_fk', 'station_id', 'stations (id)'),
+    ('gene_reads_contigs_fk_idx', 'gene_reads_contigs_fk', 'contig_id', 'contigs (id)'),
+    ('gene_reads_genes_fk_idx', 'gene_reads_genes_fk', 'gene_id', 'genes (gene_id)'),
+)
+
+
+def deadlock_safe_execute(cur, sql, params=None, many=False):
+    for attempt in range(DEADLOCK_RETRIES + 1):
+        try:
+            if many:
+                cur.executemany(sql, params)
+            else:
+                cur.execute(sql, params)
+            return
+        except mysqlErrors.InternalError as e:
+            # Only a deadlock is retried. Anything else fails the batch, which must not be checkpointed.
+            if e.errno != 1213 or attempt == DEADLOCK_RETRIES:
+                raise
+
+            # Back off with jitter, so deadlocked writers don't retry in lockstep
+            time.sleep(random.uniform(0.5, 1) * min(DEADLOCK_BACKOFF * 2 ** attempt, DEADLOCK_BACKOFF_MAX))
+
+
+def print_progress(cur):
+    if PROGRESS:
+        if cur.rowcount <= 0:
+            sys.stdout.write('.')
         else:
-            print(e)
+            sys.stdout.write('+')
+        sys.stdout.flush()
 
 
-def insert_gene_reads(con, sqlValues):
+def gene_reads_columns(rows):
+    # Column list for inserting rows, which have the layout of gene_read_row
+    return '(' + ', '.join(schema.row_columns(rows[0])) + ')'
+
+
+def insert_gene_reads(con, sqlValues, columns):
     cur = con.cursor()
     sql = """
-        INSERT IGNORE INTO `gene_reads`
-            (gene_id, read_number, station_id, read_length, gc_content)
+        %s INTO gene_reads
+            %s
         VALUES
-    """ + ', '.join(sqlValues)
+    """ % (backend.insert_ignore(con), columns) + ', '.join(sqlValues)
 
     deadlock_safe_execute(cur, sql)
+    print_progress(cur)
+    inserted = max(cur.rowcount, 0)
+    cur.close()
+    return inserted
 
-    if PROGRESS:
-        if cur.lastrowid == 0:
-            sys.stdout.write('.')
+
+def executemany_gene_reads(con, rows):
+    cur = con.cursor()
+    if backend.dialect(con) == 'duckdb':
+        backend.insert_frame(cur, backend.insert_ignore(con), 'gene_reads', schema.row_columns(rows[0]), rows)
+    else:
+        placeholders = '(' + ', '.join(['%s'] * len(rows[0])) + ')'
+        sql = backend.insert_ignore(con) + ' INTO gene_reads ' + gene_reads_columns(rows) + ' VALUES ' + placeholders
+        deadlock_safe_execute(cur, sql, rows, many=True)
+    print_progress(cur)
+    inserted = max(cur.rowcount, 0)
+    cur.close()
+    return inserted
+
+
+def load_data_gene_reads(con, rows, tmpFile):
+    # Write the batch as a transformed tsv and hand it to the database in a single LOAD DATA (or, for DuckDB,
+    # read_csv) statement
+    tmpFile.seek(0)
+    tmpFile.truncate()
+    rowFormat = '\t'.join(['%s'] * len(rows[0])) + '\n'
+    for row in rows:
+        tmpFile.write(rowFormat % row)
+    tmpFile.flush()
+
+    cur = con.cursor()
+    sql = backend.load_tsv_sql(con, tmpFile.name, 'gene_reads', schema.row_columns(rows[0]))
+
+    deadlock_safe_execute(cur, sql)
+    print_progress(cur)
+    inserted = max(cur.rowcount, 0)
+    cur.close()
+    return inserted
+
+
+def insert_batch(con, method, rows, tmpFile=None, checkpoint=None):
+    # Insert and commit one batch of gene_read_row tuples with the given method. Returns the number of rows inserted.
+    # If a checkpoint is given, it is written to the ledger in the same transaction as the batch, and only once the
+    # batch has been inserted. A failed batch is rolled back and its error raised.
+    try:
+        if method == 'insert':
+            inserted = insert_gene_reads(con, [
+                '(' + ', '.join(["\'%s\'"] * len(row)) % row + ')' for row in rows
+            ], gene_reads_columns(rows))
+        elif method == 'executemany':
+            inserted = executemany_gene_reads(con, rows)
         else:
-            sys.stdout.write('+')
+            inserted = load_data_gene_reads(con, rows, tmpFile)
+    except BaseException:
+        con.rollback()
+        raise
+
+    if checkpoint is not None:
+        record_checkpoint(con, *checkpoint)
     con.commit()
+    return inserted
+
+
+def ensure_ledger(con):
+    # The ledger is part of create-tables.sql, but databases created before it was added won't have it.
+    # Embedded databases get it from backend.py init.
+    if backend.dialect(con) != 'mysql':
+        return
+    cur = con.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS `ingest_ledger` (
+            `file_name` VARCHAR(191) NOT NULL,
+            `file_size` BIGINT UNSIGNED NOT NULL,
+            `shard_start` BIGINT UNSIGNED NOT NULL,
+            `shard_end` BIGINT UNSIGNED NOT NULL,
+            `byte_offset` BIGINT UNSIGNED NOT NULL,
+            `rows_committed` BIGINT UNSIGNED NOT NULL DEFAULT 0,
+            `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (`file_name`, `shard_start`)
+        ) ENGINE = InnoDB
+    """)
+    cur.close()
+
+
+def load_checkpoints(con, fileName, fileSize):
+    # Shards recorded for this file as [(start, end, offset, rows committed)], or None if there are none.
+    # Exits if the file changed size since the shards were recorded.
+    cur = con.cursor()
+    cur.execute(
+        'SELECT shard_start, shard_end, byte_offset, rows_committed, file_size FROM ingest_ledger '
+        'WHERE file_name = %s ORDER BY shard_start',
+        (fileName,)
+    )
+    ledger = cur.fetchall()
+    cur.close()
+    if not ledger:
+        return None
+    if any(int(size) != fileSize for start, end, offset, rows, size in ledger):
+        exit('%s has changed size since it was checkpointed. Run without --resume to load it again.' % fileName)
+    return [(int(start), int(end), int(offset), int(rows)) for start, end, offset, rows, size in ledger]
+
+
+def reset_checkpoints(con, fileName, fileSize, shards):
+    cur = con.cursor()
+    cur.execute('DELETE FROM ingest_ledger WHERE file_name = %s', (fileName,))
+    cur.executemany(
+        'INSERT INTO ingest_ledger (file_name, file_size, shard_start, shard_end, byte_offset, rows_committed) '
+        'VALUES (%s, %s, %s, %s, %s, %s)',
+        [(fileName, fileSize, start, end, offset, rows) for start, end, offset, rows in shards]
+    )
+    con.commit()
+    cur.close()
+
+
+def record_checkpoint(con, fileName, shardStart, byteOffset, rowsCommitted):
+    cur = con.cursor()
+    cur.execute(
+        'UPDATE ingest_ledger SET byte_offset = %s, rows_committed = %s, updated_at = CURRENT_TIMESTAMP '
+        'WHERE file_name = %s AND shard_start = %s',
+        (byteOffset, rowsCommitted, fileName, shardStart)
+    )
+    cur.close()
+
+
+def drop_secondary_indexes(con):
+    # Drop non-unique indexes (and the foreign keys using them) so the load only maintains the primary and
+    # unique keys. They are rebuilt in one sorted pass by restore_secondary_indexes.
+    cur = con.cursor()
+    cur.execute('ALTER TABLE `gene_reads` ' + ', '.join(
+        'DROP FOREIGN KEY `%s`' % fk for index, fk, column, ref in DEFERRABLE_INDEXES
+    ))
+    cur.execute('ALTER TABLE `gene_reads` ' + ', '.join(
+        'DROP INDEX `%s`' % index for index, fk, column, ref in DEFERRABLE_INDEXES
+    ))
+    cur.close()
+
+
+def restore_secondary_indexes(con):
+    cur = con.cursor()
+    cur.execute('ALTER TABLE `gene_reads` ' + ', '.join(
+        'ADD INDEX `%s` (`%s` ASC)' % (index, column) for index, fk, column, ref in DEFERRABLE_INDEXES
+    ))
+    # Without foreign key checks the constraints are added in place, rather than by copying the table
+    cur.execute('SET foreign_key_checks = 0')
+    cur.execute('ALTER TABLE `gene_reads` ' + ', '.join(
+        'ADD CONSTRAINT `%s` FOREIGN KEY (`%s`) REFERENCES %s' % (fk, column, ref)
+        for index, fk, column, ref in DEFERRABLE_INDEXES
+    ))
+    cur.execute('SET foreign_key_checks = 1')
     cur.close()
 
 
-def insert_station(con, station):
+def resolve_stations(con, names):
+    # Ids of the given station names as {name: id}. Names missing from the table are inserted with one
+    # INSERT IGNORE, in sorted order so concurrent loaders lock them in the same order, and only these names are
+    # looked up afterwards. Stations another loader inserted meanwhile are picked up the same way.
+    names = sorted(set(names))
+    stations = {}
+    if not names:
+        return stations
     cur = con.cursor()
-    cur.execute('INSERT INTO `stations` (name) VALUE (\'%s\')' % station)
-    id = cur.lastrowid
+    backend.insert_many(con, cur, 'stations', ('name',), [(name,) for name in names], verb=backend.insert_ignore(con))
     con.commit()
+    for start in range(0, len(names), STATION_BATCH_SIZE):
+        chunk = names[start:start + STATION_BATCH_SIZE]
+        cur.execute('SELECT id, name FROM stations WHERE name IN (%s)' % ', '.join(['%s'] * len(chunk)), chunk)
+        for id, name in cur.fetchall():
+            stations[name] = id # name: id
     cur.close()
-    return id
+    return stations
+
+
+def scan_stations(filename, shards):
+    # Pre-pass: distinct station names in the part of each shard (start, end, offset, rows committed) still to
+    # be loaded. Only the station column of each line is split off and decoded.
+    names = set()
+    with open(filename, 'rb') as f:
+        for shardStart, shardEnd, offset, rowsCommitted in shards:
+            f.seek(offset)
+            while offset < shardEnd:
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                names.add(line.split(b'\t', STATION_COL + 1)[STATION_COL])
+    return {name.decode() for name in names}
 
 
 def load_genes(con):
     genes = {}
+    cur = con.cursor()
+    cur.execute('SELECT gene_id, ecotype_id FROM genes')
+    for geneId, ecotypeId in cur.fetchall():
+        genes[geneId] = ecotypeId # gene_id: ecotype_id
+    return genes
 
 
 def load_stations(con):
@@ -72,62 +299,307 @@ def load_stations(con):
     return stations
 
 
-def main():
+def gene_read_row(record, stationId, genes=None):
+    # Row for the gene_reads table. If genes ({gene_id: ecotype_id}) is given, the row is for the clustered
+    # layout, and is None for genes not in the table.
+    geneReadNum = record[GENE_READNUM_COL].split('/')[-1]
+    (geneId, readNumber) = geneReadNum.split('_')
 
-    if len(sys.argv) != 2:
-        exit('Usage: populate.py INPUT.TSV')
+    # gc_content can't be 100 in db
+    gcContent = record[GC_COL]
+    if float(gcContent) == 100:
+        gcContent = '99.9'
 
-    filename = sys.argv[1]
+    if genes is not None:
+        ecotypeId = genes.get(int(geneId))
+        if ecotypeId is None:
+            return None
+        return (ecotypeId, stationId, int(geneId), int(readNumber), int(record[READ_LEN_COL]), gcContent)
+    return (int(geneId), int(readNumber), stationId, int(record[READ_LEN_COL]), gcContent)
 
-    # Connect to MySQL DB
-    con = connect(
-        database=os.getenv('MYSQL_DB'),
-        user=os.getenv('MYSQL_USER'),
-        password=os.getenv('MYSQL_PASS'),
-    )
 
-    # Load existing Stations into memory
-    sys.stdout.write('Loading Stations: ')
-    stations = load_stations(con)
-    print("%s initial stations" % len(stations))
+def connect_db(method):
+    return backend.connect_db(local_infile=(method == 'load'))
 
-    # Process .tsv file
-    print('Processing '+filename)
-    sqlValues = []
-    for line in open(filename, 'r'):
+
+def shard_ranges(filename, jobs):
+    # Split the file into `jobs` byte ranges [start, end), each starting at the beginning of a line
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, jobs):
+            f.seek(max(size * i // jobs, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_lines(filename, start, end):
+    # Lines of the file starting within the byte range [start, end), as (offset just past the line, line)
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            yield offset, line.decode()
+
+
+def load_shard(filename, shard, stations, method, batchSize, counters=None):
+    # Insert the gene reads of one shard (start, end, offset, rows committed) of the file, using its own
+    # connection, from the shard's checkpointed offset on. Each committed batch advances the shard's checkpoint.
+    # stations ({name: id}) is the cache resolved by main for the whole file.
+    # Returns (rows read, rows inserted), and also adds them, the batches and the seconds spent inserting them to the
+    # shared counters (see shard_counters) if given.
+    (shardStart, shardEnd, offset, rowsCommitted) = shard
+    fileName = os.path.abspath(filename)
+    con = connect_db(method)
+
+    # The clustered gene_reads layout needs each read's ecotype, and has no foreign key to catch unknown genes
+    genes = load_genes(con) if schema.is_clustered(con) else None
+
+    tmpFile = None
+    if method == 'load':
+        tmpFile = tempfile.NamedTemporaryFile('w', prefix='gene_reads_', suffix='.tsv')
+
+    rowCount = 0
+    insertedCount = 0
+
+    def flush(rows, offset):
+        # Sorting each batch by the unique (or, clustered, primary) key means concurrent writers take row locks
+        # in the same order
+        rows.sort()
+        checkpoint = (fileName, shardStart, offset, rowsCommitted + rowCount + len(rows))
+        insertStart = time.monotonic()
+        inserted = insert_batch(con, method, rows, tmpFile, checkpoint)
+        if counters is not None:
+            for name, value in (
+                ('rows', len(rows)), ('inserted', inserted), ('batches', 1),
+                ('insert_seconds', time.monotonic() - insertStart),
+            ):
+                with counters[name].get_lock():
+                    counters[name].value += value
+        return inserted
+
+    rows = []
+    for offset, line in read_lines(filename, offset, shardEnd):
         record = line.strip().split('\t')
-        geneReadNum = record[GENE_READNUM_COL].split('/')[-1]
         station = record[STATION_COL]
-        (geneId, readNumber) = geneReadNum.split('_')
-        readNumber = str(int(readNumber))
 
-        # Check Station
-        if station not in stations.keys():
-            stations = load_stations(con)
-            if station not in stations.keys():
-                stationId = insert_station(con, station)
-                stations[station] = stationId
+        # Check Station. The pre-pass resolved every station of the file, so this only happens if the file
+        # changed since.
+        if station not in stations:
+            stations.update(resolve_stations(con, [station]))
 
         # Set stationId whether or not station was present
-        stationId = stations[station]
+        row = gene_read_row(record, stations[station], genes)
+        if row is not None:
+            rows.append(row)
+        if len(rows) == batchSize:
+            insertedCount += flush(rows, offset)
+            rowCount += len(rows)
+            rows = []
+
+    if len(rows) != 0:
+        insertedCount += flush(rows, offset)
+        rowCount += len(rows)
+
+    if tmpFile is not None:
+        tmpFile.close()
+    con.close()
+    return rowCount, insertedCount
+
+
+def shard_worker(filename, shard, stations, method, batchSize, counters):
+    # Several writers can't share one line of progress dots; the coordinator prints aggregated progress instead
+    global PROGRESS
+    PROGRESS = 0
+    load_shard(filename, shard, stations, method, batchSize, counters)
+
 
-        # gc_content can't be 100 in db
-        if float(record[GC_COL]) == 100:
-            record[GC_COL] = '99.9'
+def shard_counters():
+    # Totals shared by every writer of a run
+    return {
+        'rows': multiprocessing.Value('q', 0), 'inserted': multiprocessing.Value('q', 0),
+        'batches': multiprocessing.Value('q', 0), 'insert_seconds': multiprocessing.Value('d', 0),
+    }
 
-        sqlValues.append(
-            "(\'%s\', \'%s\', \'%s\', \'%s\', \'%s\')" % (
-                geneId, readNumber, stationId, record[READ_LEN_COL], record[GC_COL]
-            )
+
+def load_parallel(filename, shards, stations, method, batchSize, counters):
+    # Run one writer process per shard, printing aggregated progress until they are all done
+    workers = [
+        multiprocessing.Process(target=shard_worker, args=(filename, shard, stations, method, batchSize, counters))
+        for shard in shards
+    ]
+    print('Running %s writers' % len(workers))
+    for worker in workers:
+        worker.start()
+
+    startTime = time.monotonic()
+    while any(worker.is_alive() for worker in workers):
+        ended = multiprocessing.connection.wait(
+            [worker.sentinel for worker in workers if worker.is_alive()], timeout=PROGRESS_INTERVAL
         )
-        if len(sqlValues) == POOL_SIZE:
-            summary = insert_gene_reads(con, sqlValues)
-            sqlValues = []
+        # Reap writers that have ended, so they no longer count as alive
+        for worker in workers:
+            if worker.sentinel in ended:
+                worker.join()
+        elapsed = time.monotonic() - startTime
+        print('[T+%8d s] %s rows read, %s inserted (%.0f rows/s)' % (
+            elapsed, counters['rows'].value, counters['inserted'].value,
+            counters['rows'].value / elapsed if elapsed else 0))
 
-    if len(sqlValues) != 0:
-        insert_gene_reads(con, sqlValues)
-    con.close()
+    # The load is partial: exit non-zero (after main has rebuilt any deferred indexes)
+    failed = [worker for worker in workers if worker.exitcode != 0]
+    if failed:
+        exit('%s of %s writers failed, after %s rows read and %s inserted. '
+             'Run again with --resume to load the rest.' % (
+                 len(failed), len(workers), counters['rows'].value, counters['inserted'].value))
+
+    return counters['rows'].value, counters['inserted'].value
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='''
+        Populate the gene_reads table from the biopython .tsv output.
+        The input's new stations are inserted before its reads.
+    ''')
+    parser.add_argument('input_filename', metavar='INPUT.TSV',
+            help='The biopython output .tsv')
+    parser.add_argument('--method', choices=('insert', 'executemany', 'load'), default='insert',
+            help='insert: string-formatted INSERT IGNOREs of %s rows (default). '
+                 'executemany: parameterized INSERT IGNORE batches. '
+                 'load: LOAD DATA LOCAL INFILE batches (requires local_infile on the server).' % POOL_SIZE)
+    parser.add_argument('--batch-size', type=int,
+            help='Rows per batch and commit. Defaults to %s for insert, %s for executemany and load.' % (
+                POOL_SIZE, BULK_BATCH_SIZE))
+    parser.add_argument('--defer-indexes', action='store_true',
+            help='Drop the non-unique gene_reads indexes and their foreign keys during the load, and rebuild '
+                 'them afterwards. Rows are not checked against foreign keys while they are dropped. '
+                 'Do not use while other loaders are running.')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+            help='Split the input into N byte ranges, loaded in parallel by N writer connections (default 1)')
+    parser.add_argument('--resume', action='store_true',
+            help='Continue from the last committed batch of each shard recorded in the ingest_ledger table, '
+                 'instead of loading the whole file again. The shards of the original run are kept.')
+    parser.add_argument('--metrics', metavar='FILE',
+            help='Write per-phase timers and counters to FILE: Prometheus text if it ends in .prom, otherwise '
+                 'JSON lines, appended')
+    parser.add_argument('--profile', action='store_true',
+            help='Run under cProfile and tracemalloc, and write both reports next to the --metrics FILE, or to '
+                 'the working directory. Writer processes of --jobs are not profiled.')
+
+    return parser.parse_args()
+
+
+def populate(args):
+    runMetrics = metrics.Metrics('populate', args.metrics)
+
+    filename = args.input_filename
+    batchSize = args.batch_size or (POOL_SIZE if args.method == 'insert' else BULK_BATCH_SIZE)
+
+    # Connect to the DB (see backend.py)
+    con = connect_db(args.method)
+    if args.method == 'load' and backend.dialect(con) not in backend.LOAD_BACKENDS:
+        print('%s can\'t load files, using --method executemany' % backend.dialect(con))
+        args.method = 'executemany'
+    if args.jobs > 1 and backend.dialect(con) != 'mysql':
+        print('%s has a single writer, using --jobs 1' % backend.dialect(con))
+        args.jobs = 1
+
+    # Shards of the file to load, as (start, end, offset, rows committed). Resume from the ledger if asked to.
+    ensure_ledger(con)
+    fileName = os.path.abspath(filename)
+    fileSize = os.path.getsize(filename)
+    shards = load_checkpoints(con, fileName, fileSize) if args.resume else None
+    if shards is None:
+        shards = [(start, end, start, 0) for start, end in shard_ranges(filename, args.jobs)]
+        reset_checkpoints(con, fileName, fileSize, shards)
+    else:
+        print('Resuming from checkpoint: %s of %s bytes, %s rows already committed' % (
+            sum(offset - start for start, end, offset, rows in shards), fileSize,
+            sum(rows for start, end, offset, rows in shards)))
+
+    shards = [shard for shard in shards if shard[2] < shard[1]]
+    if not shards:
+        print('Nothing to be done!')
+        exit()
+
+    # Load existing Stations into memory, then collect the distinct stations of the input and insert the new
+    # ones in one batch. Every writer shares the resulting ids.
+    phaseStart = time.monotonic()
+    sys.stdout.write('Loading Stations: ')
+    stations = load_stations(con)
+    print("%s initial stations" % len(stations))
+    newStations = scan_stations(filename, shards) - set(stations)
+    if newStations:
+        print('Inserting %s new stations' % len(newStations))
+        stations.update(resolve_stations(con, newStations))
+    runMetrics.count('stations_inserted', len(newStations))
+    runMetrics.add_time('stations', time.monotonic() - phaseStart)
+
+    if args.defer_indexes and schema.is_clustered(con):
+        print('gene_reads has the clustered layout, which has no secondary indexes to defer')
+        args.defer_indexes = False
+    if args.defer_indexes and backend.dialect(con) != 'mysql':
+        print('--defer-indexes only applies to MySQL')
+        args.defer_indexes = False
+    if args.defer_indexes:
+        phaseStart = time.monotonic()
+        print('Dropping secondary indexes')
+        drop_secondary_indexes(con)
+        runMetrics.add_time('indexes', time.monotonic() - phaseStart)
+
+    # Process .tsv file
+    print('Processing '+filename)
+    startTime = time.monotonic()
+    counters = shard_counters()
+    try:
+        if len(shards) > 1 and backend.dialect(con) == 'mysql':
+            rowCount, insertedCount = load_parallel(filename, shards, stations, args.method, batchSize, counters)
+        else:
+            # One shard, or the shards of a resumed run on an embedded database, loaded in turn
+            rowCount = insertedCount = 0
+            for shard in shards:
+                (shardRows, shardInserted) = load_shard(
+                    filename, shard, stations, args.method, batchSize, counters
+                )
+                rowCount += shardRows
+                insertedCount += shardInserted
+        runMetrics.add_time('load', time.monotonic() - startTime)
+    finally:
+        if args.defer_indexes:
+            phaseStart = time.monotonic()
+            print('\nRebuilding secondary indexes')
+            restore_secondary_indexes(con)
+            runMetrics.add_time('indexes', time.monotonic() - phaseStart)
+
+    elapsed = time.monotonic() - startTime
     print()
+    print('%s rows read, %s inserted in %.1f s (%.0f rows/s)' % (
+        rowCount, insertedCount, elapsed, rowCount / elapsed if elapsed else 0))
+    con.close()
+
+    # Time spent inserting is summed over the writers, so with --jobs it can exceed the load time
+    for counter, name in (
+        ('rows', 'rows_read'), ('inserted', 'rows_inserted'), ('batches', 'batches'), ('insert_seconds', 'insert_seconds')
+    ):
+        runMetrics.count(name, counters[counter].value)
+    runMetrics.set('rows_per_second', rowCount / elapsed if elapsed else 0)
+    runMetrics.set('inserted_rows_per_second', insertedCount / elapsed if elapsed else 0)
+    runMetrics.close()
+
+
+def main():
+    args = parse_args()
+    profileDir = os.path.dirname(os.path.abspath(args.metrics)) if args.metrics else os.getcwd()
+    with metrics.profile(args.profile, profileDir, 'populate'):
+        populate(args)
 
 
 if __name__ == "__main__":
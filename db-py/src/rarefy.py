@@ -4,121 +4,564 @@
 #
 # Pull data from database and calculate coverage per ecotype per station per gene.
 # Stations that have a summed read_length less than the defined THRESHOLD value are ignored.
-
-# NOTE: This version queries each depth, each station -- so it uses less memory, but is SLOWER.
-# This should only be used on very large ecotypes, if the other version uses too much memory.
+#
+# Stations are read in pools. The pools are sized from each station's read count, so that the reads of a pool fit
+# within --memory-budget: small stations are read many at a time, and a huge station is read on its own. Reads are
+# streamed from the server and packed straight into typed numpy arrays, never into a DataFrame.
+#
+# --mode expected replaces the sampling with the exact expected coverage at each depth (and optionally its variance),
+# computed from one aggregation of each station's reads rather than one sample per replicate. --mode nested samples
+# every depth of a replicate from one random order of the station's reads.
 
 import argparse
+import backend
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime as dt
-from mysql.connector import connect
+import matrix_output
+import metrics
+from multiprocessing import shared_memory
+import numpy as np
 import os
 import pandas as pd
-from pathvalidate import (sanitize_filename as sfn, sanitize_filepath as sfp)
 import pytz
+import queue
+from read_cache import (
+    CACHE_DIR, cache_path, cache_pool_arrays, ensure_cache, gene_lookup, read_fingerprint, station_fingerprints
+)
+import result_store
+import schema
 import sys
+import threading
+import time
+import zlib
 
 OUTPUT_DIR = '/app/output'
-POOL_SIZE = 30
 TZ = pytz.timezone('US/Pacific')
 
+# Upper bound on the number of random sort keys held in memory at once while sampling.
+SAMPLE_CHUNK_CELLS = 2 ** 25
 
-def df_from_query(con, ecotypeId, stationPool):
-    station_ids_string = '(%s)' % ', '.join(str(x) for x in stationPool.keys())
+# Default --memory-budget, in MiB
+MEMORY_BUDGET = 2048
 
-    # Simpler query through genes table
-    return pd.read_sql('''
-        SELECT gr.gene_id, gr.station_id, gr.read_length FROM gene_reads gr
-        LEFT JOIN genes g ON g.gene_id = gr.gene_id
-        LEFT JOIN ecotypes e ON e.id = g.ecotype_id
-        WHERE 1=1
-            AND g.ecotype_id = %s
-            AND gr.station_id IN %s
-        ''' % (ecotypeId, station_ids_string),
-                       con=con
-                       )
+# Estimated peak bytes per read of a pool: the fetched columns, the sort order, the pool arrays and their shared
+# memory copy. Summaries also have a count per row.
+POOL_BYTES_PER_READ = 40
+SUMMARY_POOL_BYTES_PER_READ = 56
 
+# Rows fetched from the server per round trip
+FETCH_SIZE = 100000
 
-def populate_output_table(df, ecotype_id, sample_depth, station_id, station_name, gene_lengths, replicates):
-    output_series = {}
-    for replicate in replicates:
-        output_series[replicate] = pd.Series(index=gene_lengths.index)
-        output_series[replicate].values[:] = 0
-        station_df = df[df.station_id == station_id]
-        station_read_count = len(station_df.index)
+# Default --prefetch: station pools fetched ahead, in the background, while the current pool is computed
+PREFETCH = 1
 
-    del df
+# Output "replicates" of --mode expected: the expected coverage, and with --variance its variance
+EXPECTED_OUTPUTS = ('mean', 'variance')
 
-    # If stationReadCount < sampleDepth, zerofill the station
-    if station_read_count < sample_depth:
-        sys.stdout.write('\t!%s' % str(sample_depth))
+# Columns fetched for each read, or each (station, gene, read_length) summary, and their types
+READ_COLUMNS = (('ecotype_id', np.uint16), ('gene_id', np.uint32), ('station_id', np.uint16), ('read_length', np.uint32))
+SUMMARY_COLUMNS = READ_COLUMNS + (('read_count', np.int64),)
 
-        return output_series
 
-    for replicate in replicates:
-        # Random sampling of this station's gene_reads
-        sample_df = station_df.sample(n=sample_depth)
+def pool_query(ecotypeIds, stationPool, clustered=False, summary=False):
+    ecotype_ids_string = '(%s)' % ', '.join(str(x) for x in ecotypeIds)
+    station_ids_string = '(%s)' % ', '.join(str(x) for x in stationPool.keys())
+    reads, ecotype_column = schema.reads_by_ecotype(clustered)
+
+    if summary:
+        # Number of reads of each length for each station / gene, aggregated server side
+        return '''
+            SELECT %s, gr.gene_id, gr.station_id, gr.read_length, COUNT(*) FROM %s
+            WHERE 1=1
+                AND %s IN %s
+                AND gr.station_id IN %s
+            GROUP BY %s, gr.station_id, gr.gene_id, gr.read_length
+            ''' % (ecotype_column, reads, ecotype_column, ecotype_ids_string, station_ids_string, ecotype_column)
+
+    # Simpler query through genes table, or straight from gene_reads if it has ecotype_id
+    return '''
+        SELECT %s, gr.gene_id, gr.station_id, gr.read_length FROM %s
+        WHERE 1=1
+            AND %s IN %s
+            AND gr.station_id IN %s
+        ''' % (ecotype_column, reads, ecotype_column, ecotype_ids_string, station_ids_string)
 
-        # Sums of the `read_length` column for each gene for this station
-        gene_read_length_sums = sample_df.groupby('gene_id')['read_length'].sum().reset_index(name='sum') \
-            .set_index('gene_id')
 
-        # The number of gene_reads for this gene in this station
-        unique_gene_count = sample_df['gene_id'].nunique()
+def fetch_columns(con, sql, columns, expected_rows):
+    # Run a query and pack its rows into one typed array per column, as a dict.
+    # A columnar backend (DuckDB) hands the columns over as arrays directly. Otherwise, the connector's default
+    # cursor is unbuffered, so rows are pulled from the server FETCH_SIZE at a time, and only one chunk of them is
+    # ever held as Python objects. Arrays start at expected_rows and grow if needed.
+    fetched = backend.fetch_arrays(con, sql)
+    if fetched is not None:
+        return {name: np.asarray(array, dtype=dtype) for (name, dtype), array in zip(columns, fetched)}
 
-        del sample_df
+    arrays = {name: np.empty(max(expected_rows, 1), dtype=dtype) for name, dtype in columns}
+    row_count = 0
+    cur = con.cursor()
+    cur.execute(sql)
+    while True:
+        rows = cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunk = np.array(rows, dtype=np.int64).reshape(-1, len(columns))
+        if row_count + len(chunk) > len(arrays[columns[0][0]]):
+            capacity = max(2 * len(arrays[columns[0][0]]), row_count + len(chunk))
+            for name, dtype in columns:
+                grown = np.empty(capacity, dtype=dtype)
+                grown[:row_count] = arrays[name][:row_count]
+                arrays[name] = grown
+        for i, (name, dtype) in enumerate(columns):
+            arrays[name][row_count:row_count + len(chunk)] = chunk[:, i]
+        row_count += len(chunk)
+        del rows, chunk
+    cur.close()
+    return {name: array[:row_count] for name, array in arrays.items()}
 
-        # Join sums of read lengths with gene reference lengths, so it has two columns: sum and length
-        grls = gene_read_length_sums.join(gene_lengths, how='right')
-        grls.fillna(0, downcast='infer', inplace=True)
 
-        del gene_read_length_sums
+def station_read_counts(con, ecotypeIds, clustered=False, summary=False):
+    # {station_id: rows a pool query will return for the station}, to size the pools with.
+    # For summaries that is the number of distinct (gene, read_length) pairs.
+    reads, ecotype_column = schema.reads_by_ecotype(clustered)
+    where = '%s IN (%s)' % (ecotype_column, ', '.join(str(x) for x in ecotypeIds))
+    cur = con.cursor()
+    if summary:
+        cur.execute('''
+            SELECT station_id, COUNT(*) FROM (
+                SELECT DISTINCT gr.station_id, gr.gene_id, gr.read_length FROM %s WHERE %s
+            ) summaries
+            GROUP BY station_id
+            ''' % (reads, where))
+    else:
+        cur.execute('SELECT gr.station_id, COUNT(*) FROM %s WHERE %s GROUP BY gr.station_id' % (reads, where))
+    counts = {int(station_id): int(count) for station_id, count in cur.fetchall()}
+    cur.close()
+    return counts
 
-        # Populate the output dataframe's stationName column with the calculated coverage
-        output_series[replicate] = grls['sum'] / grls['length']
-        output_series[replicate] = output_series[replicate].round(4)
 
-        del grls
+def station_pools(stations, read_counts, bytes_per_read, memory_budget):
+    # Split stations ({id: name}), in order, into pools whose estimated memory use fits within memory_budget bytes.
+    # A station too big for the budget on its own gets a pool to itself.
+    pools = []
+    pool = {}
+    pool_bytes = 0
+    for station_id, station_name in stations.items():
+        station_bytes = read_counts.get(station_id, 0) * bytes_per_read
+        if pool and pool_bytes + station_bytes > memory_budget:
+            pools.append(pool)
+            pool = {}
+            pool_bytes = 0
+        if station_bytes > memory_budget:
+            sys.stderr.write('WARNING: station %s needs about %d MiB, more than the memory budget\n' % (
+                station_name, station_bytes // 2 ** 20))
+        pool[station_id] = station_name
+        pool_bytes += station_bytes
+    if pool:
+        pools.append(pool)
+    return pools
+
+
+def station_arrays(reads, gene_index):
+    # Compact (gene index, read_length) arrays for reads given as gene_id and read_length columns.
+    # Reads whose gene is not in gene_index are still sampled, but are counted in an extra trailing bucket.
+    gene_idx = gene_index.get_indexer(reads['gene_id']).astype(np.int32)
+    gene_idx[gene_idx < 0] = len(gene_index)
+    read_lengths = np.asarray(reads['read_length'], dtype=np.uint32)
+    return gene_idx, read_lengths
+
+
+def replicate_rngs(seed, ecotype_id, station_id, sample_depth, replicates):
+    # One independent random stream per (ecotype, station, depth, replicate), so a seed reproduces each replicate
+    # regardless of which other ecotypes, stations, depths or replicates are run alongside it.
+    return [
+        np.random.default_rng(np.random.SeedSequence(
+            seed,
+            spawn_key=(
+                int(ecotype_id), int(station_id), int(sample_depth), zlib.crc32(str(replicate).encode())
+            )
+        ))
+        for replicate in replicates
+    ]
+
+
+def nested_rngs(seed, ecotype_id, station_id, replicates):
+    # One random stream per (ecotype, station, replicate) for --mode nested, shared by every depth. The spawn keys
+    # are shorter than replicate_rngs', so the streams are distinct from theirs.
+    return [
+        np.random.default_rng(np.random.SeedSequence(
+            seed, spawn_key=(int(ecotype_id), int(station_id), zlib.crc32(str(replicate).encode()))
+        ))
+        for replicate in replicates
+    ]
+
+
+def sample_read_length_sums(gene_idx, read_lengths, n_genes, sample_depth, rngs):
+    # Draw sample_depth reads without replacement once per rng, and sum the read lengths per gene.
+    # Returns an array of shape (len(rngs), n_genes).
+    read_count = len(gene_idx)
+    sums = np.zeros((len(rngs), n_genes))
+    chunk_size = max(1, SAMPLE_CHUNK_CELLS // max(read_count, 1))
+
+    for start in range(0, len(rngs), chunk_size):
+        chunk_rngs = rngs[start:start + chunk_size]
+        keys = np.empty((len(chunk_rngs), read_count))
+        for row, rng in enumerate(chunk_rngs):
+            rng.random(out=keys[row])
+
+        # The sample_depth reads with the smallest random keys form a uniform sample without replacement
+        selected = np.argpartition(keys, sample_depth - 1, axis=1)[:, :sample_depth]
+        del keys
+
+        # Offset each replicate's gene indices so a single bincount sums every replicate at once
+        offsets = np.arange(len(chunk_rngs))[:, np.newaxis] * (n_genes + 1)
+        bins = np.bincount(
+            (gene_idx[selected] + offsets).ravel(),
+            weights=read_lengths[selected].ravel(),
+            minlength=len(chunk_rngs) * (n_genes + 1),
+        )
+        sums[start:start + len(chunk_rngs)] = bins.reshape(len(chunk_rngs), n_genes + 1)[:, :n_genes]
+
+    return sums
+
+
+def sample_summary_read_length_sums(gene_idx, read_lengths, counts, n_genes, sample_depth, rngs):
+    # Same as sample_read_length_sums, for reads summarized as `counts` reads of each (gene, read_length).
+    # Drawing sample_depth of them without replacement is a multivariate hypergeometric draw over the summaries,
+    # so individual reads never need to be materialized.
+    sums = np.zeros((len(rngs), n_genes))
+    for row, rng in enumerate(rngs):
+        drawn = rng.multivariate_hypergeometric(counts, sample_depth)
+        sums[row] = np.bincount(gene_idx, weights=drawn * read_lengths, minlength=n_genes + 1)[:n_genes]
+    return sums
+
+
+def rarefy_station(gene_idx, read_lengths, lengths, ecotype_id, station_id, sample_depth, replicates, seed,
+                   counts=None):
+    # Coverage of each gene for one station at one depth, as an array of shape (len(replicates), len(lengths)).
+    # If counts is given, each (gene_idx, read_length) stands for that many reads.
+    # Returns None if the station has fewer reads than the sample depth.
+    read_count = len(gene_idx) if counts is None else counts.sum()
+    if read_count < sample_depth:
+        return None
+
+    # Random sampling of this station's gene_reads, all replicates at once
+    rngs = replicate_rngs(seed, ecotype_id, station_id, sample_depth, replicates)
+    if counts is None:
+        gene_read_length_sums = sample_read_length_sums(gene_idx, read_lengths, len(lengths), sample_depth, rngs)
+    else:
+        gene_read_length_sums = sample_summary_read_length_sums(
+            gene_idx, read_lengths, counts, len(lengths), sample_depth, rngs
+        )
+
+    # Coverage is the sum of sampled read lengths over the gene's reference length
+    return np.round(gene_read_length_sums / lengths, 4)
+
+
+def rarefy_station_nested(gene_idx, read_lengths, lengths, ecotype_id, station_id, sample_depths, replicates, seed):
+    # Coverage of each gene for one station at every depth, with the depths nested: each replicate draws a single
+    # random order of the station's reads, and each depth samples the first `depth` reads of it, so a deeper sample
+    # contains every shallower one. Per-gene read length sums are accumulated from one cut point to the next.
+    # Only the reads up to the deepest depth are ever put in order.
+    # Returns {sample_depth: array of shape (len(replicates), len(lengths)), or None if the station has fewer reads}.
+    read_count = len(gene_idx)
+    cuts = sorted(sample_depth for sample_depth in set(sample_depths) if sample_depth <= read_count)
+    coverage = {sample_depth: None for sample_depth in sample_depths}
+    if not cuts:
+        return coverage
+
+    sums = np.zeros((len(cuts), len(replicates), len(lengths)))
+    for row, rng in enumerate(nested_rngs(seed, ecotype_id, station_id, replicates)):
+        keys = rng.random(read_count)
+        # The reads with the cuts[-1] smallest random keys, in key order: a uniformly random ordered prefix
+        prefix = np.argpartition(keys, cuts[-1] - 1)[:cuts[-1]] if cuts[-1] < read_count else np.arange(read_count)
+        prefix = prefix[np.argsort(keys[prefix], kind='stable')]
+        del keys
+
+        running = np.zeros(len(lengths) + 1)
+        previous = 0
+        for i, cut in enumerate(cuts):
+            running += np.bincount(
+                gene_idx[prefix[previous:cut]], weights=read_lengths[prefix[previous:cut]], minlength=len(lengths) + 1
+            )
+            sums[i, row] = running[:len(lengths)]
+            previous = cut
+
+    for i, cut in enumerate(cuts):
+        coverage[cut] = np.round(sums[i] / lengths, 4)
+    return coverage
+
+
+def expected_coverage(gene_idx, read_lengths, lengths, sample_depths, variance=False, counts=None):
+    # Exact expected coverage of each gene for one station, at every depth, under sampling without replacement,
+    # from a single aggregation of the station's reads: each of the N reads is drawn with probability depth / N, so
+    # the expected read length sum of a gene is depth / N times its full read length sum. With variance, the
+    # hypergeometric variance of that sum, p(1 - p) / (N - 1) * (N * sum(l^2) - sum(l)^2) with p = depth / N, is added
+    # as a second row, also divided by the gene length (squared).
+    # If counts is given, each (gene_idx, read_length) stands for that many reads.
+    # Returns {sample_depth: array of shape (1 or 2, len(lengths)), or None if the station has fewer reads}.
+    weights = np.ones(len(gene_idx)) if counts is None else counts.astype(np.float64)
+    read_count = int(weights.sum())
+    length_sums = np.bincount(gene_idx, weights=weights * read_lengths, minlength=len(lengths) + 1)[:len(lengths)]
+    if variance:
+        squared_sums = np.bincount(
+            gene_idx, weights=weights * np.square(read_lengths, dtype=np.float64), minlength=len(lengths) + 1
+        )[:len(lengths)]
+        # Clipped at 0, as the difference can come out slightly negative in floating point
+        spread = np.maximum(read_count * squared_sums - np.square(length_sums), 0)
+
+    coverage = {}
+    for sample_depth in sample_depths:
+        if read_count < sample_depth:
+            coverage[sample_depth] = None
+            continue
+        p = sample_depth / read_count
+        rows = [np.round(p * length_sums / lengths, 4)]
+        if variance:
+            rows.append(p * (1 - p) / (read_count - 1) * spread / np.square(lengths, dtype=np.float64)
+                        if read_count > 1 else np.zeros(len(lengths)))
+        coverage[sample_depth] = np.stack(rows)
+    return coverage
+
+
+def sort_reads(reads):
+    # Sort fetched columns by ecotype, then station, so each ecotype's station is a contiguous slice.
+    # Within a station, reads are put in (gene_id, read_length) order, so a seed draws the same sample whatever
+    # order the rows arrive in.
+    order = np.lexsort((reads['read_length'], reads['gene_id'], reads['station_id'], reads['ecotype_id']))
+    for name in reads:
+        reads[name] = reads[name][order]
+    return reads
+
+
+def pool_arrays(reads, gene_index):
+    # Arrays of one ecotype's sorted reads (see sort_reads) of a station pool.
+    # Returns gene_idx, read_lengths, counts (None unless the reads are summaries) and {station_id: (start, end)}.
+    gene_idx, read_lengths = station_arrays(reads, gene_index)
+    station_col = reads['station_id']
+    station_ids = np.unique(station_col)
+    starts = np.searchsorted(station_col, station_ids, side='left')
+    ends = np.searchsorted(station_col, station_ids, side='right')
+    station_ranges = {int(i): (int(s), int(e)) for i, s, e in zip(station_ids, starts, ends)}
+    counts = reads['read_count'] if 'read_count' in reads else None
+    return gene_idx, read_lengths, counts, station_ranges
+
+
+def share_arrays(gene_idx, read_lengths, counts=None):
+    # Copy a pool's read arrays into one shared memory block for the worker processes
+    size = gene_idx.nbytes + read_lengths.nbytes + (counts.nbytes if counts is not None else 0)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+    np.ndarray(gene_idx.shape, dtype=np.int32, buffer=shm.buf)[:] = gene_idx
+    np.ndarray(read_lengths.shape, dtype=np.uint32, buffer=shm.buf, offset=gene_idx.nbytes)[:] = read_lengths
+    if counts is not None:
+        np.ndarray(
+            counts.shape, dtype=np.int64, buffer=shm.buf, offset=gene_idx.nbytes + read_lengths.nbytes
+        )[:] = counts
+    return shm
+
+
+# Per-process state of a rarefaction worker: gene lengths by ecotype id, and the currently attached shared memory block
+_worker = {}
+
+
+def init_worker(lengths):
+    _worker['lengths'] = lengths
+    _worker['shm'] = None
+
+
+def attach_shared_arrays(shm_name, read_count, has_counts):
+    shm = _worker['shm']
+    if shm is None or shm.name != shm_name:
+        if shm is not None:
+            shm.close()
+        # Workers share the parent's resource tracker, and the parent unlinks the block once the pool is done
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker['shm'] = shm
+
+    gene_idx = np.ndarray((read_count,), dtype=np.int32, buffer=shm.buf)
+    read_lengths = np.ndarray((read_count,), dtype=np.uint32, buffer=shm.buf, offset=gene_idx.nbytes)
+    counts = None
+    if has_counts:
+        counts = np.ndarray(
+            (read_count,), dtype=np.int64, buffer=shm.buf, offset=gene_idx.nbytes + read_lengths.nbytes
+        )
+    return gene_idx, read_lengths, counts
+
+
+def rarefy_job(shm_name, read_count, has_counts, start, end, ecotype_id, station_id, sample_depth, replicates, seed):
+    # rarefy_station in a worker process. Returns its result, and the seconds it took.
+    gene_idx, read_lengths, counts = attach_shared_arrays(shm_name, read_count, has_counts)
+    sample_start = time.monotonic()
+    coverage = rarefy_station(
+        gene_idx[start:end], read_lengths[start:end], _worker['lengths'][ecotype_id], ecotype_id, station_id,
+        sample_depth, replicates, seed, counts[start:end] if counts is not None else None
+    )
+    return coverage, time.monotonic() - sample_start
 
-    sys.stdout.write('\t %s' % str(sample_depth))
 
-    return output_series
+def rarefy_nested_job(shm_name, read_count, start, end, ecotype_id, station_id, sample_depths, replicates, seed):
+    # rarefy_station_nested in a worker process. Returns its result, and the seconds it took.
+    gene_idx, read_lengths, counts = attach_shared_arrays(shm_name, read_count, False)
+    sample_start = time.monotonic()
+    coverage = rarefy_station_nested(
+        gene_idx[start:end], read_lengths[start:end], _worker['lengths'][ecotype_id], ecotype_id, station_id,
+        sample_depths, replicates, seed
+    )
+    return coverage, time.monotonic() - sample_start
+
+
+def fetch_pool(con, source, runs, station_pool, clustered=False, expected_rows=0):
+    # Reads of a pool of stations for every ecotype being run, concatenated into one set of arrays.
+    # The database is queried once for all ecotypes, and the rows are split by ecotype here.
+    # Returns gene_idx, read_lengths, counts (None unless source is summary) and
+    # {(ecotype_id, station_id): (start, end)}.
+    pieces = []  # (ecotype_id, gene_idx, read_lengths, counts, station_ranges)
+    if source == 'cache':
+        for run in runs:
+            gene_idx, read_lengths, station_ranges = cache_pool_arrays(run['cache'], station_pool, run['lookup'])
+            pieces.append((run['id'], gene_idx, read_lengths, None, station_ranges))
+    else:
+        columns = SUMMARY_COLUMNS if source == 'summary' else READ_COLUMNS
+        sql = pool_query([run['id'] for run in runs], station_pool, clustered, source == 'summary')
+        reads = sort_reads(fetch_columns(con, sql, columns, expected_rows))
+        ecotype_col = reads['ecotype_id']
+        for run in runs:
+            start = np.searchsorted(ecotype_col, run['id'], side='left')
+            end = np.searchsorted(ecotype_col, run['id'], side='right')
+            gene_idx, read_lengths, counts, station_ranges = pool_arrays(
+                {name: array[start:end] for name, array in reads.items()}, run['gene_lengths'].index
+            )
+            pieces.append((run['id'], gene_idx, read_lengths, counts, station_ranges))
+        del reads, ecotype_col
+
+    pool_ranges = {}
+    position = 0
+    for ecotype_id, gene_idx, read_lengths, counts, station_ranges in pieces:
+        for station_id, (start, end) in station_ranges.items():
+            pool_ranges[ecotype_id, station_id] = (position + start, position + end)
+        position += len(gene_idx)
+
+    return (
+        np.concatenate([piece[1] for piece in pieces]),
+        np.concatenate([piece[2] for piece in pieces]),
+        np.concatenate([piece[3] for piece in pieces]) if source == 'summary' else None,
+        pool_ranges,
+    )
 
 
-def print_time_info(start_time, prev_time):
+def fetched_pools(con, source, runs, pools, clustered, read_counts, prefetch, run_metrics=None):
+    # Fetch each station pool in turn. Yields (station pool, fetch_pool result, seconds spent fetching it, seconds
+    # waited for it). With prefetch > 0, pools are fetched by a background thread, on its own connection, up to
+    # `prefetch` pools ahead, so the next pool is read while the current one is computed.
+    # Rows fetched, the bytes of their arrays and, from MySQL, the bytes transferred are counted in run_metrics.
+    def fetch(con, station_pool):
+        fetch_start = time.monotonic()
+        sent = backend.bytes_sent(con) if run_metrics is not None and source != 'cache' else None
+        pool = fetch_pool(
+            con, source, runs, station_pool, clustered,
+            sum(read_counts.get(station_id, 0) for station_id in station_pool)
+        )
+        if run_metrics is not None:
+            run_metrics.count('pools')
+            run_metrics.count('rows_fetched', len(pool[0]))
+            run_metrics.count('fetched_bytes', sum(array.nbytes for array in pool[:3] if array is not None))
+            if sent is not None:
+                run_metrics.count('transferred_bytes', backend.bytes_sent(con) - sent)
+        return station_pool, pool, time.monotonic() - fetch_start
+
+    if prefetch <= 0:
+        for station_pool in pools:
+            station_pool, pool, fetch_seconds = fetch(con, station_pool)
+            yield station_pool, pool, fetch_seconds, fetch_seconds
+        return
+
+    fetched = queue.Queue(prefetch)
+
+    def fetch_all():
+        fetch_con = connect_db() if source != 'cache' else None
+        try:
+            for station_pool in pools:
+                fetched.put(fetch(fetch_con, station_pool))
+        except BaseException as e:
+            fetched.put(e)
+        finally:
+            if fetch_con is not None:
+                fetch_con.close()
+
+    threading.Thread(target=fetch_all, daemon=True).start()
+    for i in range(len(pools)):
+        wait_start = time.monotonic()
+        item = fetched.get()
+        if isinstance(item, BaseException):
+            raise item
+        yield item + (time.monotonic() - wait_start,)
+
+
+def connect_db():
+    return backend.connect_db()
+
+
+def print_time_info(start_time, fetch_wait):
+    # Elapsed time, and time spent waiting for the station's pool to be fetched (only for the first station of a pool)
     station_time = dt.now(TZ)
     total_elapsed_seconds = round((station_time - start_time).total_seconds())
-    elapsed_since_station = round((station_time - prev_time).total_seconds(), 1)
-    sys.stdout.write('\t[T+%s s]\t[^%s s]' % (
+    sys.stdout.write('\t[T+%s s]\t[fetch %s s]' % (
         str(total_elapsed_seconds).rjust(8, ' '),
-        str(elapsed_since_station).rjust(7, ' '),
+        ('%.1f' % fetch_wait).rjust(7, ' '),
     ))
     return station_time
 
 
-def main():
-    # Parse command line arguments
+def parse_args():
     parser = argparse.ArgumentParser(
         description='''
             Pull data from database and calculate coverage per ecotype per station per gene.
             Ecotype-Stations that have gene reads less than the sample depth value are ignored.
             Since this involves a random sampling, these calculations will be performed multiple times, once per
-            replicate.
+            replicate. With --mode expected, the exact expected coverage is computed instead, without sampling.
         ''',
-        usage='rarefy.py [-h] ECOTYPE --replicates REPLICANT [REPLICANT ...] --depths DEPTH [DEPTH ...]'
+        usage='rarefy.py [-h] {ECOTYPE | --ecotypes ECOTYPE [ECOTYPE ...] | --all-ecotypes} '
+              '{--replicates REPLICANT [REPLICANT ...] | --mode expected [--variance]} --depths DEPTH [DEPTH ...]'
     )
     parser.add_argument(
         'ecotype',
         metavar='ECOTYPE',
+        nargs='?',
         help='The ecotype to be analyzed'
     )
-    flag_req = parser.add_argument_group(title='required flag arguments')
-    flag_req.add_argument(
+    parser.add_argument(
+        '--ecotypes',
+        metavar='ECOTYPE',
+        nargs='+',
+        help='Several ecotypes to be analyzed in a single pass over the gene reads'
+    )
+    parser.add_argument(
+        '--all-ecotypes',
+        action='store_true',
+        help='Analyze every ecotype in the database in a single pass over the gene reads'
+    )
+    parser.add_argument(
+        '--mode',
+        choices=('sample', 'nested', 'expected'),
+        default='sample',
+        help='sample (default): draw each replicate by random sampling, independently at each depth. '
+             'nested: draw one random order of each station\'s reads per replicate, and sample every depth from '
+             'its first reads, so deeper samples contain the shallower ones. '
+             'expected: compute the exact expected coverage at each depth from one pass over each station\'s '
+             'reads, written as the "mean" replicate'
+    )
+    parser.add_argument(
+        '--variance',
+        action='store_true',
+        help='With --mode expected, also write the variance of the coverage under the hypergeometric model, as '
+             'the "variance" replicate'
+    )
+    parser.add_argument(
         '--replicates',
-        required=True,
         metavar='REPLICANT',
         nargs='+',
-        help='Series of replicate names used as file suffixes'
+        help='Series of replicate names used as file suffixes. Required, unless --mode expected'
     )
+    flag_req = parser.add_argument_group(title='required flag arguments')
     flag_req.add_argument(
         '--depths',
         required=True,
@@ -127,37 +570,128 @@ def main():
         nargs='+',
         help='Sample depths to be considered'
     )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='Seed for the random sampling. A random seed is chosen, and printed, if not given'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        metavar='N',
+        help='Number of worker processes computing stations / depths in parallel (default 1)'
+    )
+    parser.add_argument(
+        '--source',
+        choices=('db', 'cache', 'summary'),
+        default='db',
+        help='Read gene reads from the database (default), or from a columnar cache exported by read_cache.py. '
+             'The cache is (re)built first if it is missing or out of date. '
+             'summary fetches per station / gene / read_length read counts from the database instead of raw reads'
+    )
+    parser.add_argument(
+        '--format',
+        choices=matrix_output.FORMATS,
+        default='tsv',
+        help='Output format (default tsv). npz writes all replicates of a depth as one stacked array'
+    )
+    parser.add_argument(
+        '--memory-budget',
+        type=int,
+        default=MEMORY_BUDGET,
+        metavar='MIB',
+        help='Approximate memory, in MiB, for the reads of a pool of stations read at once (default %s). '
+             'Pools are sized from each station\'s read count to fit' % MEMORY_BUDGET
+    )
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=PREFETCH,
+        metavar='N',
+        help='Station pools fetched ahead in the background while the current pool is computed (default %s). '
+             'Each one can take up to --memory-budget. 0 fetches and computes in turn' % PREFETCH
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Keep each station\'s results in %s/%s, and only compute stations whose reads changed since their '
+             'results were stored (or that have none). The output matrices are still written in full' % (
+                 OUTPUT_DIR, result_store.STORE_DIR)
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=CACHE_DIR,
+        help='Directory of the read cache (default %s)' % CACHE_DIR
+    )
+    parser.add_argument(
+        '--metrics',
+        metavar='FILE',
+        help='Write per-phase timers and counters to FILE: Prometheus text if it ends in .prom, otherwise JSON '
+             'lines, appended, with a line per station and depth computed'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Run under cProfile and tracemalloc, and write both reports to %s' % OUTPUT_DIR
+    )
 
     args = parser.parse_args()
 
-    # Check output directory
-    if not (os.access(OUTPUT_DIR, os.W_OK) and os.path.isdir(OUTPUT_DIR)):
-        exit('Problem with output directory %s. Ensure it exists and is writeable.' % OUTPUT_DIR)
-
-    print('### %s ###' % args.ecotype)
-
-    # Connect to MySQL DB
-    con = connect(
-        database=os.getenv('MYSQL_DB'),
-        user=os.getenv('MYSQL_USER'),
-        password=os.getenv('MYSQL_PASS'),
-    )
+    if sum([args.ecotype is not None, args.ecotypes is not None, args.all_ecotypes]) != 1:
+        parser.error('give exactly one of ECOTYPE, --ecotypes or --all-ecotypes')
+
+    if args.mode == 'expected':
+        if args.replicates:
+            parser.error('--mode expected has no replicates')
+        args.replicates = list(EXPECTED_OUTPUTS if args.variance else EXPECTED_OUTPUTS[:1])
+    elif not args.replicates:
+        parser.error('--replicates is required, unless --mode expected')
+    elif args.variance:
+        parser.error('--variance only applies to --mode expected')
+    if args.mode == 'nested' and args.source == 'summary':
+        parser.error('--mode nested orders individual reads, so it needs --source db or cache')
+    if args.incremental and args.mode != 'expected' and args.seed is None:
+        parser.error('--incremental only reuses results sampled with the same seed, so it needs --seed')
+
+    return args
+
+
+def rarefy(args):
+    run_metrics = metrics.Metrics('rarefy', args.metrics)
+    phase_start = time.monotonic()
+    # Expected coverage involves no randomness, so its results are stored under seed 0
+    seed = 0 if args.mode == 'expected' else args.seed if args.seed is not None else np.random.SeedSequence().entropy
+
+    # Connect to the DB (see backend.py)
+    con = connect_db()
     cur = con.cursor()
+    clustered = schema.is_clustered(con)
 
     # Fetch ecotypes, verify input
     print('Fetching Ecotypes')
     cur.execute('SELECT id, name FROM ecotypes')
     ecotypes = {name: id for id, name in cur.fetchall()}
 
-    if args.ecotype not in ecotypes:
-        exit('Ecotype "%s" not found in database. Ecotypes found: %s' % (args.ecotype, ', '.join([*ecotypes])))
+    ecotype_names = list(ecotypes) if args.all_ecotypes else (args.ecotypes or [args.ecotype])
+    for ecotype in ecotype_names:
+        if ecotype not in ecotypes:
+            exit('Ecotype "%s" not found in database. Ecotypes found: %s' % (ecotype, ', '.join([*ecotypes])))
 
-    ecotype_id = ecotypes[args.ecotype]
+    print('### %s ###' % ', '.join(ecotype_names))
+    if args.mode == 'expected':
+        print('Expected coverage%s' % (' and variance' if args.variance else ''))
+    else:
+        print('Seed: %s' % seed)
 
-    # Length of genes based on reference sequence
+    # Length of genes based on reference sequence, for all ecotypes at once
     print('Fetching Gene Lengths')
-    gene_lengths = pd.read_sql('SELECT gene_id, length FROM genes WHERE ecotype_id = %s' % ecotype_id, con=con) \
-        .set_index('gene_id')
+    cur.execute(
+        'SELECT gene_id, length, ecotype_id FROM genes WHERE ecotype_id IN (%s)' % ', '.join(
+            str(ecotypes[ecotype]) for ecotype in ecotype_names
+        )
+    )
+    all_gene_lengths = pd.DataFrame(cur.fetchall(), columns=['gene_id', 'length', 'ecotype_id'])
 
     # Fetch stations
     print('Fetching Stations')
@@ -165,69 +699,259 @@ def main():
     stations = {id: name for id, name in cur.fetchall()}
 
     max_station_name_length = max(len(x) for x in stations.values())
+    station_columns = {station_id: column for column, station_id in enumerate(stations)}
+
+    # Everything needed to rarefy each ecotype
+    runs = []
+    for ecotype in ecotype_names:
+        run = {'name': ecotype, 'id': ecotypes[ecotype]}
+        run['gene_lengths'] = all_gene_lengths[all_gene_lengths.ecotype_id == run['id']] \
+            .drop(columns='ecotype_id').set_index('gene_id')
+        run['lengths'] = run['gene_lengths']['length'].to_numpy()
+
+        if args.source == 'cache':
+            run['cache'] = ensure_cache(con, ecotype, run['id'], args.cache_dir)
+            run['lookup'] = gene_lookup(run['cache'], run['gene_lengths'].index)
+
+        # Stage one (station, replicate, gene) coverage array per depth on disk; stations are in `stations` order
+        run['output_tables'] = {}
+        for sample_depth in args.depths:
+            run['output_tables'][sample_depth] = matrix_output.open_staging(
+                OUTPUT_DIR, ecotype, sample_depth, len(stations), len(args.replicates), len(run['lengths'])
+            )
+        runs.append(run)
+    del all_gene_lengths
+    run_metrics.add_time('setup', time.monotonic() - phase_start)
+
+    # With --incremental, fill in the stored results of stations whose reads haven't changed, and only compute the rest
+    done = set()  # (ecotype_id, station_id, sample_depth) already in the output tables
+    store_dir = os.path.join(OUTPUT_DIR, result_store.STORE_DIR)
+    sampler = args.mode if args.mode != 'sample' else 'summary' if args.source == 'summary' else 'reads'
+    if args.incremental:
+        phase_start = time.monotonic()
+        print('Checking Stored Results')
+        for run in runs:
+            if args.source == 'cache':
+                run['fingerprints'] = read_fingerprint(cache_path(args.cache_dir, run['name']))
+            else:
+                run['fingerprints'] = station_fingerprints(con, run['id'])
+            run['genes_checksum'] = result_store.genes_checksum(run['gene_lengths'])
+            for station_id in stations:
+                for sample_depth in args.depths:
+                    found, coverage = result_store.load_result(
+                        result_store.result_path(store_dir, run['name'], sampler, seed, sample_depth, station_id),
+                        run['fingerprints'].get(station_id, (0, 0)), run['genes_checksum'], args.replicates
+                    )
+                    if found:
+                        done.add((run['id'], station_id, sample_depth))
+                        if coverage is not None:
+                            run['output_tables'][sample_depth][station_columns[station_id]] = coverage
+        print('Reusing %s of %s stored station results' % (len(done), len(runs) * len(stations) * len(args.depths)))
+        run_metrics.count('results_reused', len(done))
+        run_metrics.add_time('incremental', time.monotonic() - phase_start)
+    todo_stations = {
+        station_id: station_name for station_id, station_name in stations.items()
+        if any((run['id'], station_id, sample_depth) not in done for run in runs for sample_depth in args.depths)
+    }
+
+    # Size the station pools from each station's read count (summed over the ecotypes)
+    phase_start = time.monotonic()
+    print('Counting Station Reads')
+    if args.source == 'cache':
+        read_counts = {}
+        for run in runs:
+            for station_id, (start, end) in run['cache']['ranges'].items():
+                read_counts[station_id] = read_counts.get(station_id, 0) + end - start
+    else:
+        read_counts = station_read_counts(con, [run['id'] for run in runs], clustered, args.source == 'summary')
+    pools = station_pools(
+        todo_stations, read_counts,
+        SUMMARY_POOL_BYTES_PER_READ if args.source == 'summary' else POOL_BYTES_PER_READ,
+        args.memory_budget * 2 ** 20
+    )
+    print('%s rows in %s stations, read in %s pools' % (
+        sum(read_counts.get(station_id, 0) for station_id in todo_stations), len(todo_stations), len(pools)))
+    run_metrics.add_time('count', time.monotonic() - phase_start)
 
-    # Generate blank dataframes
-    output_tables = {}
-    for sample_depth in args.depths:
-        output_tables[sample_depth] = {}
-        for rep in args.replicates:
-            output_tables[sample_depth][rep] = pd.DataFrame(index=gene_lengths.index)
+    # Expected coverage is a single aggregation per station, so it is computed in this process
+    executor = None
+    if args.workers > 1 and args.mode != 'expected':
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers, initializer=init_worker,
+            initargs=({run['id']: run['lengths'] for run in runs},)
+        )
 
-    start_time = previous_station_time = dt.now(TZ)
+    start_time = dt.now(TZ)
 
-    station_pool = {}  # id: name
-    stations_run_count = 0
     sys.stdout.write('[%s]\n' % start_time)
     station_index = 0
-    for station_id, station_name in stations.items():
-
-        # Add to stationPool
-        station_pool[station_id] = station_name
-
-        # Perform calculations per station per depth, reset stationPool
-        if (len(station_pool) == POOL_SIZE) or (stations_run_count + len(station_pool) == len(stations)):
-            df = df_from_query(con, ecotype_id, station_pool)
-
-            for station_pool_id, station_pool_name in station_pool.items():
-                station_index += 1
-
-                # Print which station we're on
-                sys.stdout.write('\n(%4d/%4d)' % (station_index, len(stations)))
-
-                # Print out elapsed time information
-                previous_station_time = print_time_info(start_time, previous_station_time)
-                sys.stdout.write('\t%s' % station_pool_name.ljust(max_station_name_length, ' '))
-
-                # Do the calculating
+    total_fetch = total_fetch_wait = total_compute = 0
+    for station_pool, pool, fetch_seconds, fetch_wait in fetched_pools(
+        con, args.source, runs, pools, clustered, read_counts, args.prefetch, run_metrics
+    ):
+        gene_idx, read_lengths, counts, pool_ranges = pool
+        del pool
+        total_fetch += fetch_seconds
+        total_fetch_wait += fetch_wait
+
+        # Hand every ecotype / station / depth of the pool to the workers before collecting results in order
+        futures = {}
+        if executor is not None:
+            shm = share_arrays(gene_idx, read_lengths, counts)
+            for station_pool_id in station_pool:
+                for run in runs:
+                    start, end = pool_ranges.get((run['id'], station_pool_id), (0, 0))
+                    if args.mode == 'nested':
+                        # One job for all depths of the station
+                        if any((run['id'], station_pool_id, sample_depth) not in done for sample_depth in args.depths):
+                            futures[run['id'], station_pool_id] = executor.submit(
+                                rarefy_nested_job, shm.name, len(gene_idx), start, end, run['id'], station_pool_id,
+                                args.depths, args.replicates, seed
+                            )
+                        continue
+                    for sample_depth in args.depths:
+                        if (run['id'], station_pool_id, sample_depth) in done:
+                            continue
+                        futures[run['id'], station_pool_id, sample_depth] = executor.submit(
+                            rarefy_job, shm.name, len(gene_idx), counts is not None, start, end, run['id'],
+                            station_pool_id, sample_depth, args.replicates, seed
+                        )
+
+        for station_pool_id, station_pool_name in station_pool.items():
+            station_index += 1
+            compute_start = time.monotonic()
+
+            # Print which station we're on
+            sys.stdout.write('\n(%4d/%4d)' % (station_index, len(todo_stations)))
+
+            # Print out elapsed time information
+            print_time_info(start_time, fetch_wait)
+            fetch_wait = 0
+            sys.stdout.write('\t%s' % station_pool_name.ljust(max_station_name_length, ' '))
+
+            # Do the calculating
+            for run in runs:
+                if len(runs) > 1:
+                    sys.stdout.write('\t%s' % run['name'])
+
+                start, end = pool_ranges.get((run['id'], station_pool_id), (0, 0))
+                station_results = None
                 for sample_depth in args.depths:
-
-                    replicate_depth_station = populate_output_table(
-                        df, ecotype_id, sample_depth, station_pool_id, station_pool_name, gene_lengths, args.replicates
+                    # Stored result already in the output tables
+                    if (run['id'], station_pool_id, sample_depth) in done:
+                        sys.stdout.write('\t=%s' % str(sample_depth))
+                        continue
+
+                    if args.mode != 'sample':
+                        # Nested and expected coverage come for every depth of the station at once, computed when
+                        # the first depth is needed
+                        sample_seconds = 0
+                        if station_results is None and executor is not None:
+                            station_results, sample_seconds = futures.pop((run['id'], station_pool_id)).result()
+                        elif station_results is None:
+                            sample_start = time.monotonic()
+                            if args.mode == 'nested':
+                                station_results = rarefy_station_nested(
+                                    gene_idx[start:end], read_lengths[start:end], run['lengths'], run['id'],
+                                    station_pool_id, args.depths, args.replicates, seed
+                                )
+                            else:
+                                station_results = expected_coverage(
+                                    gene_idx[start:end], read_lengths[start:end], run['lengths'], args.depths,
+                                    args.variance, counts[start:end] if counts is not None else None
+                                )
+                            sample_seconds = time.monotonic() - sample_start
+                        coverage = station_results[sample_depth]
+                    elif executor is not None:
+                        coverage, sample_seconds = futures.pop((run['id'], station_pool_id, sample_depth)).result()
+                    else:
+                        sample_start = time.monotonic()
+                        coverage = rarefy_station(
+                            gene_idx[start:end], read_lengths[start:end], run['lengths'], run['id'],
+                            station_pool_id, sample_depth, args.replicates, seed,
+                            counts[start:end] if counts is not None else None
+                        )
+                        sample_seconds = time.monotonic() - sample_start
+                    run_metrics.event(
+                        'station', ecotype=run['name'], station=station_pool_name, depth=sample_depth,
+                        rows=end - start, skipped=coverage is None, sample_seconds=sample_seconds,
+                        seconds_per_replicate=sample_seconds / len(args.replicates) if coverage is not None else None
                     )
-
-                    # Put the calculated values in our output tables
-                    for replicate, station_series in replicate_depth_station.items():
-                        output_tables[sample_depth][replicate][station_pool_name] = station_series
-                        del station_series
-            del df
-            stations_run_count += len(station_pool)
-            station_pool = {}
+                    if coverage is not None:
+                        run_metrics.count('results_computed')
+                        run_metrics.count('sample_seconds', sample_seconds)
+                        # A nested replicate is drawn once, for all depths
+                        if args.mode == 'sample' or (args.mode == 'nested' and sample_seconds):
+                            run_metrics.count('replicates_sampled', len(args.replicates))
+
+                    # If stationReadCount < sampleDepth, leave the station zerofilled
+                    if coverage is None:
+                        sys.stdout.write('\t!%s' % str(sample_depth))
+                    else:
+                        sys.stdout.write('\t %s' % str(sample_depth))
+
+                        # Put the calculated values in our output tables
+                        run['output_tables'][sample_depth][station_columns[station_pool_id]] = coverage
+
+                    if args.incremental:
+                        result_store.save_result(
+                            result_store.result_path(
+                                store_dir, run['name'], sampler, seed, sample_depth, station_pool_id
+                            ),
+                            run['fingerprints'].get(station_pool_id, (0, 0)), run['genes_checksum'],
+                            args.replicates, coverage
+                        )
+                    del coverage
+
+            compute_seconds = time.monotonic() - compute_start
+            total_compute += compute_seconds
+            sys.stdout.write('\t[compute %.1f s]' % compute_seconds)
+
+        if executor is not None:
+            shm.close()
+            shm.unlink()
+        del gene_idx, read_lengths, counts
+
+    if executor is not None:
+        executor.shutdown()
 
     print()
-    for sample_depth in args.depths:
-        for replicate in args.replicates:
-            file_out_name = sfp(
-                OUTPUT_DIR + '/' + sfn(args.ecotype) + '_' + str(sample_depth) + '_' + sfn(replicate) + '.tsv'
+    print('Fetching took %.1f s, of which %.1f s was waited for; computing took %.1f s' % (
+        total_fetch, total_fetch_wait, total_compute))
+    run_metrics.add_time('fetch', total_fetch)
+    run_metrics.add_time('fetch_wait', total_fetch_wait)
+    run_metrics.add_time('compute', total_compute)
+    if run_metrics.counters.get('replicates_sampled'):
+        run_metrics.set(
+            'seconds_per_replicate', run_metrics.counters['sample_seconds'] / run_metrics.counters['replicates_sampled']
+        )
+
+    phase_start = time.monotonic()
+    for run in runs:
+        for sample_depth in args.depths:
+            matrix_output.write_matrices(
+                run['output_tables'][sample_depth], OUTPUT_DIR, run['name'], sample_depth, args.replicates,
+                run['gene_lengths'].index, list(stations.values()), args.format
             )
-            print('Writing to file: ' + file_out_name)
-            file_out = open(file_out_name, 'w')
-            output_tables[sample_depth][replicate].to_csv(file_out, sep='\t')
-        del output_tables[sample_depth]
-
-    del output_tables
+            del run['output_tables'][sample_depth]
+            matrix_output.remove_staging(OUTPUT_DIR, run['name'], sample_depth)
+    run_metrics.add_time('write', time.monotonic() - phase_start)
 
     cur.close()
     con.close()
+    run_metrics.close()
+
+
+def main():
+    args = parse_args()
+
+    # Check output directory
+    if not (os.access(OUTPUT_DIR, os.W_OK) and os.path.isdir(OUTPUT_DIR)):
+        exit('Problem with output directory %s. Ensure it exists and is writeable.' % OUTPUT_DIR)
+    matrix_output.check_format(args.format)
+
+    with metrics.profile(args.profile, OUTPUT_DIR, 'rarefy'):
+        rarefy(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+# read_cache.py
+#
+# Export each ecotype's gene reads from the database to a columnar cache that rarefy.py can memory-map
+# (`rarefy.py --source cache`) instead of querying MySQL.
+#
+# The cache for an ecotype is a directory of .npy files, with reads sorted by station, then gene_id and read_length:
+#   station_ids.npy     uint16, the stations with reads for this ecotype, ascending
+#   station_offsets.npy int64, reads of station_ids[i] are at [station_offsets[i], station_offsets[i + 1])
+#   gene_ids.npy        uint32
+#   read_lengths.npy    uint16, or uint32 if any read is longer than 65535
+#   fingerprint.json    per-station row count and checksum of gene_reads when the cache was built
+#
+# The cache is rebuilt only when the fingerprint in the database no longer matches.
+
+import argparse
+import backend
+import json
+import numpy as np
+import os
+from pathvalidate import sanitize_filename as sfn
+import schema
+import shutil
+import sys
+
+CACHE_DIR = '/app/output/cache'
+CACHE_VERSION = 1
+
+# Rows fetched from the server per round trip while exporting
+FETCH_SIZE = 100000
+
+
+# Checksum of a station's reads, in each backend's SQL. SQLite has no bitwise aggregate, so it sums a hash instead.
+STATION_CHECKSUMS = {
+    'mysql': "BIT_XOR(CRC32(CONCAT_WS(',', gr.gene_id, gr.read_number, gr.read_length)))",
+    'duckdb': 'BIT_XOR(HASH(gr.gene_id, gr.read_number, gr.read_length) & 4294967295)',
+    'sqlite': 'SUM((gr.gene_id * 2654435761 + gr.read_number * 40503 + gr.read_length) % 4294967296)',
+}
+
+
+def station_fingerprints(con, ecotype_id):
+    # {station_id: (row count, checksum)} of the ecotype's gene_reads, computed by the database
+    reads, ecotype_column = schema.reads_by_ecotype(schema.is_clustered(con))
+    cur = con.cursor()
+    cur.execute('''
+        SELECT gr.station_id, COUNT(*), %s
+        FROM %s
+        WHERE %s = %%s
+        GROUP BY gr.station_id
+        ''' % (STATION_CHECKSUMS[backend.dialect(con)], reads, ecotype_column), (ecotype_id,))
+    fingerprints = {int(station_id): (int(count), int(checksum)) for station_id, count, checksum in cur.fetchall()}
+    cur.close()
+    return fingerprints
+
+
+def fetch_chunks(cur, fetch_size=FETCH_SIZE):
+    # Stream an executed query's (station_id, gene_id, read_length) rows as uint32 arrays of shape (n, 3)
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            return
+        yield np.array(rows, dtype=np.uint32).reshape(-1, 3)
+
+
+def cache_path(cache_dir, ecotype):
+    return os.path.join(cache_dir, sfn(ecotype))
+
+
+def read_fingerprint(path):
+    # Stored {station_id: (row count, checksum)}, or None if there is no usable cache at path
+    try:
+        with open(os.path.join(path, 'fingerprint.json')) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if stored.get('version') != CACHE_VERSION:
+        return None
+    return {int(station_id): tuple(value) for station_id, value in stored['stations'].items()}
+
+
+def export_cache(con, ecotype_id, path):
+    # Write the ecotype's reads to a cache directory at path. Reads are streamed from the server and scattered
+    # straight into their station's slice of memory-mapped output files, so memory use doesn't grow with the
+    # ecotype. Returns the fingerprint the cache was built from.
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    # The fingerprint and the export have to see the same rows
+    con.commit()
+    con.start_transaction(consistent_snapshot=True, readonly=True)
+    fingerprints = station_fingerprints(con, ecotype_id)
+
+    station_ids = np.array(sorted(fingerprints), dtype=np.uint16)
+    counts = np.array([fingerprints[station_id][0] for station_id in station_ids], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    read_count = int(offsets[-1])
+
+    # Slot of each station id in station_ids, and the next free position in each station's slice
+    slots = np.full(int(station_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+    slots[station_ids] = np.arange(len(station_ids))
+    cursors = offsets[:-1].copy()
+
+    # Read lengths are written as uint32 first, and narrowed once their maximum is known
+    gene_ids = open_array(os.path.join(tmp_path, 'gene_ids.npy'), np.uint32, read_count)
+    wide_lengths = open_array(os.path.join(tmp_path, 'read_lengths.uint32.npy'), np.uint32, read_count)
+    max_length = 0
+
+    reads, ecotype_column = schema.reads_by_ecotype(schema.is_clustered(con))
+    cur = con.cursor()
+    cur.execute('''
+        SELECT gr.station_id, gr.gene_id, gr.read_length FROM %s
+        WHERE %s = %%s
+        ''' % (reads, ecotype_column), (ecotype_id,))
+    for chunk in fetch_chunks(cur):
+        chunk = chunk[np.argsort(chunk[:, 0], kind='stable')]
+        unique_slots, first, chunk_counts = np.unique(slots[chunk[:, 0]], return_index=True, return_counts=True)
+
+        # Position of each read: its station's next free position plus its rank within the station in this chunk
+        positions = np.repeat(cursors[unique_slots] - first, chunk_counts) + np.arange(len(chunk))
+        gene_ids[positions] = chunk[:, 1]
+        wide_lengths[positions] = chunk[:, 2]
+        cursors[unique_slots] += chunk_counts
+        max_length = max(max_length, int(chunk[:, 2].max()))
+    cur.close()
+    con.rollback()
+
+    # Put each station's reads in the (gene_id, read_length) order used by rarefy.pool_arrays
+    for i in range(len(station_ids)):
+        start, end = offsets[i], offsets[i + 1]
+        order = np.lexsort((wide_lengths[start:end], gene_ids[start:end]))
+        gene_ids[start:end] = gene_ids[start:end][order]
+        wide_lengths[start:end] = wide_lengths[start:end][order]
+
+    if max_length <= np.iinfo(np.uint16).max:
+        read_lengths = open_array(os.path.join(tmp_path, 'read_lengths.npy'), np.uint16, read_count)
+        for start in range(0, read_count, FETCH_SIZE):
+            read_lengths[start:start + FETCH_SIZE] = wide_lengths[start:start + FETCH_SIZE]
+        del read_lengths, wide_lengths
+        os.remove(os.path.join(tmp_path, 'read_lengths.uint32.npy'))
+    else:
+        del wide_lengths
+        os.rename(
+            os.path.join(tmp_path, 'read_lengths.uint32.npy'), os.path.join(tmp_path, 'read_lengths.npy')
+        )
+    del gene_ids
+
+    np.save(os.path.join(tmp_path, 'station_ids.npy'), station_ids)
+    np.save(os.path.join(tmp_path, 'station_offsets.npy'), offsets)
+    with open(os.path.join(tmp_path, 'fingerprint.json'), 'w') as f:
+        json.dump({
+            'version': CACHE_VERSION,
+            'ecotype_id': ecotype_id,
+            'stations': {str(station_id): list(value) for station_id, value in fingerprints.items()},
+        }, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return fingerprints
+
+
+def open_array(filename, dtype, length):
+    # A writable memory-mapped .npy file. Empty arrays can't be memory-mapped, so they are saved directly.
+    if length == 0:
+        np.save(filename, np.zeros(0, dtype=dtype))
+        return np.zeros(0, dtype=dtype)
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(length,))
+
+
+def load_cache(path):
+    # Memory-map a cache directory. Returns a dict of its arrays, plus {station_id: (start, end)} as 'ranges'.
+    cache = {
+        name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        for name in ('station_ids', 'station_offsets', 'gene_ids', 'read_lengths')
+    }
+    offsets = cache['station_offsets']
+    cache['ranges'] = {
+        int(station_id): (int(offsets[i]), int(offsets[i + 1])) for i, station_id in enumerate(cache['station_ids'])
+    }
+    return cache
+
+
+def gene_lookup(cache, gene_index):
+    # Array mapping each cached gene_id to its position in gene_index. Genes not in gene_index map to
+    # len(gene_index), the trailing bucket used by rarefy.station_arrays.
+    max_gene_id = max(int(gene_index.max()) if len(gene_index) else 0, int(cache['gene_ids'].max(initial=0)))
+    lookup = np.full(max_gene_id + 1, len(gene_index), dtype=np.int32)
+    lookup[gene_index.to_numpy()] = np.arange(len(gene_index), dtype=np.int32)
+    return lookup
+
+
+def ensure_cache(con, ecotype, ecotype_id, cache_dir=CACHE_DIR):
+    # Load the ecotype's cache, (re)building it first if the database's fingerprint doesn't match
+    path = cache_path(cache_dir, ecotype)
+    if read_fingerprint(path) != station_fingerprints(con, ecotype_id):
+        print('Exporting %s reads to %s' % (ecotype, path))
+        export_cache(con, ecotype_id, path)
+    else:
+        print('Using cached %s reads in %s' % (ecotype, path))
+    return load_cache(path)
+
+
+def cache_pool_arrays(cache, station_ids, lookup):
+    # The cached reads of a pool of stations, as (gene_idx, read_lengths, {station_id: (start, end)}),
+    # laid out the same way as rarefy.pool_arrays
+    gene_idx = []
+    read_lengths = []
+    station_ranges = {}
+    position = 0
+    for station_id in station_ids:
+        if station_id not in cache['ranges']:
+            continue
+        start, end = cache['ranges'][station_id]
+        gene_idx.append(lookup[cache['gene_ids'][start:end]])
+        read_lengths.append(np.asarray(cache['read_lengths'][start:end], dtype=np.uint32))
+        station_ranges[station_id] = (position, position + end - start)
+        position += end - start
+
+    if not gene_idx:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint32), station_ranges
+    return np.concatenate(gene_idx), np.concatenate(read_lengths), station_ranges
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Export the gene reads of each given ecotype to a columnar cache for rarefy.py --source cache.
+        Caches that are already up to date with the database are left alone.
+    ''')
+    parser.add_argument('ecotypes', metavar='ECOTYPE', nargs='+', help='The ecotypes to be exported')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Cache directory (default %s)' % CACHE_DIR)
+    args = parser.parse_args()
+
+    # Connect to the DB (see backend.py)
+    con = backend.connect_db()
+    cur = con.cursor()
+    cur.execute('SELECT id, name FROM ecotypes')
+    ecotypes = {name: id for id, name in cur.fetchall()}
+    cur.close()
+
+    for ecotype in args.ecotypes:
+        if ecotype not in ecotypes:
+            sys.stderr.write('Ecotype "%s" not found in database, skipping.\n' % ecotype)
+            continue
+        ensure_cache(con, ecotype, ecotypes[ecotype], args.cache_dir)
+
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
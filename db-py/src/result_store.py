@@ -0,0 +1,79 @@
+# result_store.py
+#
+# Store of per-station rarefaction results for `rarefy.py --incremental`.
+#
+# Each station's coverage at a depth is kept in its own file, along with the fingerprint (row count and checksum, see
+# read_cache.station_fingerprints) of the station's reads and a checksum of the ecotype's genes when it was computed:
+#   STORE_DIR/ECOTYPE/SAMPLER_SEED/DEPTH/STATION_ID.npz
+# holding `coverage` (replicate, gene) float64, `replicates`, `fingerprint` and `genes`. Stations with fewer reads than
+# the depth are stored without coverage, as `skipped`. The sampler is `reads` for --source db and cache, which give
+# the same results, and `summary` for --source summary.
+#
+# A stored result is reused only while the station's reads and the ecotype's genes are unchanged, and only if it has
+# every replicate asked for. Replicates are drawn independently, so results for some replicates are valid whatever
+# other replicates were run alongside them.
+
+import numpy as np
+import os
+from pathvalidate import sanitize_filename as sfn
+import zlib
+
+STORE_DIR = 'results'
+
+
+def genes_checksum(gene_lengths):
+    # Checksum of an ecotype's gene ids and lengths, which give the columns of its coverage
+    ids = np.ascontiguousarray(gene_lengths.index.to_numpy(dtype=np.int64))
+    lengths = np.ascontiguousarray(gene_lengths['length'].to_numpy(dtype=np.int64))
+    return zlib.crc32(lengths.tobytes(), zlib.crc32(ids.tobytes()))
+
+
+def result_path(store_dir, ecotype, sampler, seed, sample_depth, station_id):
+    return os.path.join(store_dir, sfn(ecotype), '%s_%s' % (sampler, seed), str(sample_depth), '%s.npz' % station_id)
+
+
+def read_result(path):
+    try:
+        with np.load(path) as stored:
+            return {name: stored[name] for name in stored.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def load_result(path, fingerprint, genes, replicates):
+    # (True, coverage of the given replicates, or None if the station was skipped) if a usable result is stored,
+    # otherwise (False, None)
+    stored = read_result(path)
+    if stored is None or tuple(stored['fingerprint']) != tuple(fingerprint) or int(stored['genes']) != genes:
+        return False, None
+    if stored['skipped']:
+        return True, None
+
+    rows = {str(replicate): row for row, replicate in enumerate(stored['replicates'])}
+    if any(str(replicate) not in rows for replicate in replicates):
+        return False, None
+    return True, stored['coverage'][[rows[str(replicate)] for replicate in replicates]]
+
+
+def save_result(path, fingerprint, genes, replicates, coverage):
+    # Store a station's coverage (None if it was skipped), keeping any other replicates already stored for the
+    # same reads and genes
+    replicates = [str(replicate) for replicate in replicates]
+    stored = read_result(path)
+    if coverage is not None and stored is not None and not stored['skipped'] \
+            and tuple(stored['fingerprint']) == tuple(fingerprint) and int(stored['genes']) == genes:
+        keep = [row for row, replicate in enumerate(stored['replicates']) if str(replicate) not in replicates]
+        replicates = [str(stored['replicates'][row]) for row in keep] + replicates
+        coverage = np.concatenate((stored['coverage'][keep], coverage))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(
+        tmp_path,
+        coverage=np.zeros((0, 0), dtype=np.float64) if coverage is None else np.asarray(coverage, dtype=np.float64),
+        replicates=np.array(replicates if coverage is not None else []),
+        fingerprint=np.array(fingerprint, dtype=np.int64),
+        genes=np.array(genes, dtype=np.int64),
+        skipped=np.array(coverage is None),
+    )
+    os.replace(tmp_path, path)
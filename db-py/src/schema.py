@@ -0,0 +1,52 @@
+# schema.py
+#
+# gene_reads can have either of two layouts (see db-init/sql):
+#   create-tables.sql             surrogate id; a read's ecotype is found through genes
+#   create-tables-clustered.sql   ecotype_id stored in gene_reads, clustered on
+#                                 (ecotype_id, station_id, gene_id, read_number) and partitioned by ecotype
+# The scripts check which one the database has with is_clustered, and adapt their queries and rows.
+
+# Row order of gene_reads rows, in each layout
+GENE_READS_COLUMNS = ('gene_id', 'read_number', 'station_id', 'read_length', 'gc_content')
+CLUSTERED_GENE_READS_COLUMNS = ('ecotype_id', 'station_id', 'gene_id', 'read_number', 'read_length', 'gc_content')
+
+# gene_reads in the clustered layout, as in db-init/sql/create-tables-clustered.sql, under the given table name
+CLUSTERED_GENE_READS_DDL = '''
+    CREATE TABLE IF NOT EXISTS `%s` (
+        `ecotype_id` SMALLINT UNSIGNED NOT NULL,
+        `station_id` SMALLINT UNSIGNED NOT NULL,
+        `gene_id` MEDIUMINT UNSIGNED NOT NULL,
+        `read_number` INT UNSIGNED NOT NULL,
+        `contig_id` SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+        `read_length` SMALLINT UNSIGNED NOT NULL,
+        `gc_content` DECIMAL(4,2) NOT NULL,
+        PRIMARY KEY (`ecotype_id`, `station_id`, `gene_id`, `read_number`)
+    )
+    ENGINE = InnoDB
+    DEFAULT CHARACTER SET = utf8mb4
+    COLLATE = utf8mb4_0900_ai_ci
+    PARTITION BY KEY (`ecotype_id`) PARTITIONS 16
+'''
+
+
+def is_clustered(con, table='gene_reads'):
+    # Whether the table has the clustered layout, i.e. an ecotype_id column
+    cur = con.cursor()
+    cur.execute('SELECT * FROM %s LIMIT 0' % table)
+    columns = [column[0] for column in cur.description]
+    cur.fetchall()
+    cur.close()
+    return 'ecotype_id' in columns
+
+
+def reads_by_ecotype(clustered):
+    # (FROM clause, ecotype column) for queries selecting gene_reads (as gr) by ecotype. Without the clustered
+    # layout this goes through genes (as g).
+    if clustered:
+        return 'gene_reads gr', 'gr.ecotype_id'
+    return 'gene_reads gr JOIN genes g ON g.gene_id = gr.gene_id', 'g.ecotype_id'
+
+
+def row_columns(row):
+    # Columns of a gene_reads row, told apart by its length
+    return CLUSTERED_GENE_READS_COLUMNS if len(row) == len(CLUSTERED_GENE_READS_COLUMNS) else GENE_READS_COLUMNS
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# synthetic.py
+#
+# Seeded synthetic dataset for benchmark.py, at a configurable scale, in the input formats of each pipeline step:
+#   genes.tsv          [gene_id \t length \t ecotype], for import-genes-ecotypes.py
+#   fastas/GENE.fa     anvio's per-gene read fastas, for the biopython step and populate-fastas.py
+#   fasta-table.tsv    the biopython table of the same reads (as fastasToTab.py would write it), for populate.py
+#
+# Genes are spread over the ecotypes, and their abundance is skewed (log-normal), so a few genes get most of the
+# reads. Each station gets reads_per_station reads on average (between half and one and a half times as many), so
+# shallow stations are skipped at the larger depths, as in real data. The same arguments always give the same files.
+
+import argparse
+import numpy as np
+import os
+
+GENES_FILE = 'genes.tsv'
+FASTA_DIR = 'fastas'
+TABLE_FILE = 'fasta-table.tsv'
+
+GENE_LENGTHS = (300, 3000)
+READ_LENGTHS = (50, 250)
+GENES_PER_CONTIG = 10
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def station_name(station):
+    return 'ST%04d' % station
+
+
+def ecotype_name(ecotype):
+    return 'ECO%02d' % ecotype
+
+
+def generate(output_dir, stations=20, genes=200, ecotypes=2, reads_per_station=10000, seed=1, fastas=True):
+    # Write the dataset to output_dir. Returns its sizes, and the path of each file.
+    rng = np.random.default_rng(seed)
+    gene_ids = np.arange(1, genes + 1)
+    gene_lengths = rng.integers(GENE_LENGTHS[0], GENE_LENGTHS[1] + 1, genes)
+    gene_ecotypes = rng.integers(1, ecotypes + 1, genes)
+    abundance = rng.lognormal(0, 1, genes)
+
+    # Reads as (gene index, station), ordered by gene then station, as each gene's fasta lists them
+    station_reads = rng.integers(reads_per_station // 2, reads_per_station * 3 // 2 + 1, stations)
+    read_stations = np.repeat(np.arange(1, stations + 1), station_reads)
+    read_genes = rng.choice(genes, size=len(read_stations), p=abundance / abundance.sum())
+    order = np.lexsort((read_stations, read_genes))
+    read_genes, read_stations = read_genes[order], read_stations[order]
+    read_lengths = rng.integers(READ_LENGTHS[0], READ_LENGTHS[1] + 1, len(read_genes))
+    read_reverse = rng.random(len(read_genes)) < 0.5
+    gene_starts = np.searchsorted(read_genes, np.arange(genes + 1))
+
+    os.makedirs(output_dir, exist_ok=True)
+    genes_path = os.path.join(output_dir, GENES_FILE)
+    with open(genes_path, 'w') as f:
+        for gene_id, length, ecotype in zip(gene_ids, gene_lengths, gene_ecotypes):
+            f.write('%s\t%s\t%s\n' % (gene_id, length, ecotype_name(ecotype)))
+
+    fasta_dir = os.path.join(output_dir, FASTA_DIR)
+    if fastas:
+        os.makedirs(fasta_dir, exist_ok=True)
+    table_path = os.path.join(output_dir, TABLE_FILE)
+    with open(table_path, 'w') as table:
+        for gene in range(genes):
+            start, end = gene_starts[gene], gene_starts[gene + 1]
+            if start == end:
+                continue
+            gene_id = gene_ids[gene]
+            contig = 'contig_%05d' % (gene // GENES_PER_CONTIG)
+            fasta_path = os.path.join(fasta_dir, '%s.fa' % gene_id)
+
+            # One random sequence per read, all cut from a single draw of the gene's bases
+            lengths = read_lengths[start:end]
+            bases = BASES[rng.integers(0, 4, lengths.sum())]
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            gc_counts = np.add.reduceat((bases == ord('G')) | (bases == ord('C')), offsets[:-1])
+            sequences = bases.tobytes().decode()
+
+            fasta = open(fasta_path, 'w') if fastas else None
+            for read_number, (station, length, reverse, gc_count) in enumerate(zip(
+                read_stations[start:end].tolist(), lengths.tolist(), read_reverse[start:end].tolist(),
+                gc_counts.tolist()
+            )):
+                # Row of faToTab.py: path_description with '|' as tabs and the field names dropped, then length and GC
+                table.write('%s_%08d\t%s\t%s\t%s\t%s\t%s\n' % (
+                    fasta_path[:-len('.fa')], read_number, station_name(station), reverse, contig, length,
+                    gc_count * 100.0 / length))
+                if fasta is not None:
+                    fasta.write('>%08d|sample_id:%s|reverse:%s|contig_name:%s\n%s\n' % (
+                        read_number, station_name(station), reverse, contig,
+                        sequences[offsets[read_number]:offsets[read_number + 1]]))
+            if fasta is not None:
+                fasta.close()
+
+    return {
+        'stations': stations,
+        'genes': genes,
+        'ecotypes': ecotypes,
+        'reads': len(read_genes),
+        'seed': seed,
+        'genes_file': genes_path,
+        'fasta_dir': fasta_dir if fastas else None,
+        'table_file': table_path,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+        Write a seeded synthetic dataset: genes.tsv, one fasta of reads per gene, and the biopython table of
+        those reads.
+    ''')
+    parser.add_argument('output_dir', metavar='OUTPUT_DIR')
+    parser.add_argument('--stations', type=int, default=20, help='Number of stations (default 20)')
+    parser.add_argument('--genes', type=int, default=200, help='Number of genes (default 200)')
+    parser.add_argument('--ecotypes', type=int, default=2, help='Number of ecotypes (default 2)')
+    parser.add_argument('--reads-per-station', type=int, default=10000,
+            help='Average number of reads per station (default 10000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default 1)')
+    parser.add_argument('--no-fastas', action='store_true', help='Only write genes.tsv and the table')
+    args = parser.parse_args()
+
+    dataset = generate(
+        args.output_dir, args.stations, args.genes, args.ecotypes, args.reads_per_station, args.seed,
+        not args.no_fastas
+    )
+    print('%s reads of %s genes in %s stations written to %s' % (
+        dataset['reads'], dataset['genes'], dataset['stations'], args.output_dir))
+
+
+if __name__ == '__main__':
+    main()